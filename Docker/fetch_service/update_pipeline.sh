@@ -1,8 +1,11 @@
 #/bin/bash
 
 #==============================================================================
-# This script runs the required python scripts for updating the dataset
+# This script runs the data pipeline for updating the dataset
 
-python3 /app/get_data.py --data_path "/app/data/"
-python3 /app/process_JH_data.py --data_path "/app/data/"
-python3 /app/build_features.py --data_path "/app/data/"
\ No newline at end of file
+# Formats in which processed datasets are written
+OUTPUT_FORMATS=${OUTPUT_FORMATS:-csv}
+
+# Fetch, process, build features and publish in one process.
+# Stages whose inputs did not change since the last run are skipped.
+python3 /app/src/pipeline.py --data_path "/app/data/" --output_format $OUTPUT_FORMATS
@@ -7,4 +7,19 @@ setup(
     description='Applied Data Science on COVID-19 data',
     author='Faizudeen Olanrewaju Kajogbola',
     license='MIT',
+    entry_points={
+        'console_scripts': [
+            'covid-get-data=src.data.get_data:main',
+            'covid-process-jh=src.data.process_JH_data:main',
+            'covid-build-features=src.features.build_features:main',
+            'covid-train-model=src.models.train_model:main',
+            'covid-predict-model=src.models.predict_model:main',
+            'covid-backtest=src.models.backtest:main',
+            'covid-publish=src.data.publish:main',
+            'covid-pipeline=src.pipeline:main',
+            'covid-dashboard=src.visualization.visualize:main',
+            'covid-serve=src.visualization.serve:main',
+            'covid-benchmark=src.benchmark:main',
+        ],
+    },
 )
@@ -0,0 +1,36 @@
+""" Lazy imports of the names exported by the src packages
+"""
+import importlib
+
+
+def lazy_exports(name, mapping):
+    """ Module-level __getattr__ and __all__ of a package with lazy exports
+
+    A name is imported from the module defining it on first access, so
+    importing the package does not import numpy, pandas, ... before they
+    are needed.
+
+    Parameters:
+    ----------
+    name: string
+        __name__ of the package
+    mapping: dict
+        public name -> module defining it
+
+    Returns:
+    -------
+    getattr: function
+        __getattr__ of the package
+    all: list of strings
+        __all__ of the package
+    """
+
+    def __getattr__(attribute):
+        if(attribute not in mapping):
+            raise AttributeError(
+                "module {0!r} has no attribute {1!r}".format(name, attribute)
+            )
+
+        return getattr(importlib.import_module(mapping[attribute]), attribute)
+
+    return __getattr__, list(mapping)
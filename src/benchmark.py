@@ -0,0 +1,649 @@
+# Imports
+import os, sys, io, json, time, shutil, platform, resource, tempfile
+import tracemalloc
+import contextlib, multiprocessing, statistics, warnings
+from datetime import datetime
+
+import argparse
+
+# numpy, pandas and the stage modules are only imported in the processes
+# running the cases. Spawned processes start with the peak RSS of this process,
+# which therefore stays small
+from src.data.storage import TIME_SERIES, DATASET_NAMES, time_series_path
+
+# Sizes of the synthetic time series as (regions, days), from the global file
+# up to the county-level US file
+SIZES= {
+    "small": (50, 100),
+    "global": (289, 1143),
+    "US": (3342, 1143),
+}
+
+# Benchmarked cases, in the order in which they run
+CASES= [
+    "store_relational_model", "calc_filtered_data", "calc_doubling_rate",
+    "build_features_panel", "build_rollups", "ncdc_parse", "update_fig",
+    "update_fig_cached", "update_fig_payload",
+]
+
+# Cases which do not depend on the size of the synthetic data
+FIXTURE_CASES= ["ncdc_parse"]
+
+# Cases returning serialized responses, whose total size is recorded
+PAYLOAD_CASES= ["update_fig_payload"]
+
+# Metrics shown by the dashboard, every update_fig run draws each of them
+METRICS= [
+    "confirmed", "confirmed_filtered", "confirmed_DR", "confirmed_filtered_DR"
+]
+
+#==============================================================================
+# COMMAND LINE ARGUMENTS
+# Create parser object
+cl_parser= argparse.ArgumentParser(
+    description="Time and memory-profile the pipeline stages and the \
+        dashboard callback on synthetic Johns Hopkins data."
+)
+
+# ARGUMENTS
+# Sizes
+cl_parser.add_argument(
+    "--sizes", action="store", nargs="+", default=["small"],
+    choices=list(SIZES),
+    help="Sizes of the synthetic time series, see SIZES"
+)
+cl_parser.add_argument(
+    "--regions", action="store", type=int, default=None,
+    help="Number of regions of an additional custom size (requires --days)"
+)
+cl_parser.add_argument(
+    "--days", action="store", type=int, default=None,
+    help="Number of days of an additional custom size (requires --regions)"
+)
+# Cases
+cl_parser.add_argument(
+    "--cases", action="store", nargs="+", default=CASES, choices=CASES,
+    help="Cases to run"
+)
+cl_parser.add_argument(
+    "--repeat", action="store", type=int, default=3,
+    help="Number of timed runs per case"
+)
+# Time series, see process_JH_data.py
+cl_parser.add_argument(
+    "--time_series", action="store", nargs="+",
+    default=[
+        "global:confirmed", "global:deaths", "global:recovered",
+        "US:confirmed", "US:deaths"
+    ],
+    help="Time series ingested by store_relational_model as scope:metric"
+)
+cl_parser.add_argument(
+    "--workers", action="store", type=int, default=None,
+    help="Number of processes reading time series in store_relational_model"
+)
+# NCDC page
+cl_parser.add_argument(
+    "--ncdc_fixture", action="store", default="references/ncdc_page.html",
+    help="Saved NCDC page parsed by the ncdc_parse case"
+)
+# Paths
+cl_parser.add_argument(
+    "--work_path", action="store", default=None,
+    help="Folder for the synthetic datasets, a temporary folder which is \
+        removed afterwards if not given"
+)
+cl_parser.add_argument(
+    "--output", action="store", default="reports/benchmark.json",
+    help="JSON file to which the results are written"
+)
+# Baseline
+cl_parser.add_argument(
+    "--baseline", action="store", default=None,
+    help="Results of a previous run to compare against, exits with status 1 \
+        if a case got slower or bigger than --tolerance"
+)
+cl_parser.add_argument(
+    "--tolerance", action="store", type=float, default=0.2,
+    help="Allowed relative increase of time and peak memory over the baseline"
+)
+
+
+#==============================================================================
+def synthetic_time_series(n_regions, n_days, scope="global",
+        metric="confirmed", seed=0):
+    """ Synthetic Johns Hopkings time series in the layout of the raw files
+
+    Cumulative counts follow a randomly scaled and shifted logistic curve
+    per region, with Poisson noise on the daily increments. The same seed
+    gives the same regions and curves for every metric, deaths and
+    recovered are fractions of the confirmed cases. In the "global" layout
+    the first two thirds of the regions are countries, the others are
+    states of the first countries, so some countries have to be aggregated.
+
+    Parameters:
+    ----------
+    n_regions: int
+        number of rows
+    n_days: int
+        number of date columns, starting 1/22/20
+    scope: string
+        "global" or "US", see TIME_SERIES
+    metric: string
+        "confirmed", "deaths" or "recovered"
+    seed: int
+        seed of the random number generator
+
+    Returns:
+    -------
+    df_raw: pandas DataFrame
+        one row per region, one column per date
+    """
+    import numpy as np
+    import pandas as pd
+
+    rng= np.random.default_rng(seed)
+
+    # Logistic curve per region
+    days= np.arange(n_days)
+    size= rng.lognormal(8, 2, n_regions)
+    midpoint= rng.uniform(0.2, 0.8, n_regions)*n_days
+    steepness= rng.uniform(0.02, 0.1, n_regions)
+    curve= size/(1 + np.exp(-steepness*(days.reshape(-1, 1) - midpoint)))
+
+    # Non-negative noisy increments keep the counts cumulative
+    increments= rng.poisson(np.diff(curve, axis=0, prepend=0).clip(0))
+    counts= increments.cumsum(axis=0).T
+    if(metric == "deaths"):
+        counts= (counts*0.02).astype(np.int64)
+    elif(metric == "recovered"):
+        counts= (counts*0.9).astype(np.int64)
+
+    dates= pd.date_range("2020-01-22", periods=n_days)
+    date_cols= [
+        "{0}/{1}/{2:%y}".format(date.month, date.day, date) for date in dates
+    ]
+
+    if(scope == "US"):
+        n_states= min(n_regions, 58)
+        df_raw= pd.DataFrame({
+            "UID": 84000000 + np.arange(n_regions),
+            "iso2": "US",
+            "iso3": "USA",
+            "code3": 840,
+            "FIPS": 1000.0 + np.arange(n_regions),
+            "Admin2": ["County {0}".format(idx) for idx in range(n_regions)],
+            "Province_State": [
+                "State {0}".format(idx % n_states) for idx in range(n_regions)
+            ],
+            "Country_Region": "US",
+            "Lat": rng.uniform(25, 49, n_regions),
+            "Long_": rng.uniform(-125, -67, n_regions),
+        })
+        df_raw["Combined_Key"]= df_raw.Admin2 + ", " + \
+            df_raw.Province_State + ", US"
+        if(metric == "deaths"):
+            df_raw["Population"]= rng.integers(1000, 10**7, n_regions)
+    else:
+        n_countries= max(1, n_regions*2//3)
+        df_raw= pd.DataFrame({
+            "Province/State": [
+                np.nan if idx < n_countries else "State {0}".format(idx)
+                for idx in range(n_regions)
+            ],
+            "Country/Region": [
+                "Country {0}".format(idx % n_countries)
+                for idx in range(n_regions)
+            ],
+            "Lat": rng.uniform(-60, 70, n_regions),
+            "Long": rng.uniform(-180, 180, n_regions),
+        })
+
+    return pd.concat([df_raw, pd.DataFrame(counts, columns=date_cols)], axis=1)
+
+
+#==============================================================================
+def write_synthetic_data(data_path, n_regions, n_days, seed=0):
+    """ Write synthetic versions of all time series files into a data folder
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder, files are written where get_data.py puts them
+    n_regions, n_days, seed:
+        see synthetic_time_series
+
+    Returns:
+    -------
+    """
+    os.makedirs(data_path + "processed", exist_ok=True)
+    for scope, series in TIME_SERIES.items():
+        for metric, file_name in series:
+            path= time_series_path(data_path, file_name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            synthetic_time_series(
+                n_regions, n_days, scope=scope, metric=metric, seed=seed
+            ).to_csv(path, index=False)
+
+
+#==============================================================================
+def prepare_datasets(data_path, n_regions, n_days, workers=None):
+    """ Write synthetic time series, the relational dataset, the feature set
+    and the rollups """
+    from src.data.process_JH_data import store_relational_model
+    from src.data.storage import write_processed
+    from src.features.build_features import build_features_panel, \
+        build_rollups, prepare_relational
+
+    write_synthetic_data(data_path, n_regions, n_days)
+    with contextlib.redirect_stdout(io.StringIO()):
+        datasets= store_relational_model(
+            data_path, time_series=[
+                "global:" + metric for metric, _ in TIME_SERIES["global"]
+            ],
+            workers=workers
+        )
+    pd_JH_rel= prepare_relational(datasets["global"])
+    write_processed(
+        build_features_panel(pd_JH_rel), data_path, "COVID_final_set"
+    )
+    write_processed(build_rollups(pd_JH_rel), data_path, "COVID_rollup_set")
+
+
+#==============================================================================
+def case_function(case, data_path, options):
+    """ Load the input of a case and return the function to be timed
+
+    Returns:
+    -------
+    func: callable
+        function without arguments running the case once
+    rows: int
+        number of input rows or table rows
+    """
+    from src.data.storage import read_processed
+
+    if(case == "store_relational_model"):
+        from src.data.process_JH_data import store_relational_model
+        def func():
+            return store_relational_model(
+                data_path, time_series=options["time_series"],
+                workers=options["workers"]
+            )
+        rows= None
+
+    elif(case in ["calc_filtered_data", "calc_doubling_rate",
+            "build_features_panel", "build_rollups"]):
+        from src.features import build_features
+        df_input= build_features.prepare_relational(
+            read_processed(data_path, DATASET_NAMES["global"])
+        )
+        calc= getattr(build_features, case)
+        def func():
+            return calc(df_input)
+        rows= len(df_input)
+
+    elif(case == "ncdc_parse"):
+        from src.data.national import parse_ncdc_table
+        with open(options["ncdc_fixture"], "rb") as fixture:
+            content= fixture.read()
+        def func():
+            return parse_ncdc_table(content)
+        rows= len(func())
+
+    elif(case in ["update_fig", "update_fig_cached", "update_fig_payload"]):
+        from src.visualization.cache import TraceCache
+        from src.visualization.visualize import build_figure, region_positions
+        df_rollups= read_processed(data_path, "COVID_rollup_set")
+        current= {
+            "rollups": df_rollups, "positions": region_positions(df_rollups),
+            "version": "benchmark"
+        }
+        # Countries with the most states
+        df_final= read_processed(data_path, "COVID_final_set")
+        countries= list(
+            df_final.groupby("country", observed=True)["state"].nunique()
+            .nlargest(3).index
+        )
+
+        trace_cache= None
+        if(case in ["update_fig_cached", "update_fig_payload"]):
+            trace_cache= TraceCache(data_path + "cache/benchmark.sqlite")
+            trace_cache.invalidate(current["version"])
+
+        def func():
+            return [
+                build_figure(current, trace_cache, countries, visual_name)
+                for visual_name in METRICS
+            ]
+        rows= len(current["rollups"])
+
+        if(case == "update_fig_payload"):
+            # Cached figures at the default resolution, serialized as Dash does
+            from src.visualization.payload import MAX_POINTS, \
+                serialize_figure, use_fast_json
+            use_fast_json()
+            def func():
+                return [
+                    serialize_figure(build_figure(
+                        current, trace_cache, countries, visual_name,
+                        max_points=MAX_POINTS
+                    ))
+                    for visual_name in METRICS
+                ]
+
+    else:
+        raise ValueError("Unknown benchmark case: {0}".format(case))
+
+    return func, rows
+
+
+#==============================================================================
+def peak_rss():
+    """ Peak RSS of this process and its finished child processes in bytes """
+    peak= max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    if(sys.platform != "darwin"):
+        peak*= 1024
+
+    return peak
+
+
+#==============================================================================
+def measure_case(case, data_path, options, repeat=3):
+    """ Time a case and profile its memory, run in a fresh process
+
+    After a first run, which imports modules used on first call and fills
+    the trace cache, the case runs repeat times for timing, then once more
+    under tracemalloc.
+    The traced peak covers Python and numpy allocations of this process
+    during the call only; the peak RSS also covers loading the input and,
+    for store_relational_model, the worker processes.
+
+    Returns:
+    -------
+    result: dict
+        "rows", "seconds" per run, "traced_peak_bytes", "peak_rss_bytes" and,
+        for PAYLOAD_CASES, the total size of the responses "payload_bytes"
+    """
+    # Output and warnings of the stages would be repeated for every run
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        func, rows= case_function(case, data_path, options)
+        output= func()
+
+        seconds= []
+        for _ in range(repeat):
+            start= time.perf_counter()
+            func()
+            seconds.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        func()
+        _, traced_peak= tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    result= {
+        "rows": rows, "seconds": seconds,
+        "traced_peak_bytes": traced_peak, "peak_rss_bytes": peak_rss()
+    }
+    if(case in PAYLOAD_CASES):
+        result["payload_bytes"]= sum(len(payload) for payload in output)
+
+    return result
+
+
+#==============================================================================
+def isolated_worker(conn, func, args):
+    """ Send the result of a function, or its error, through a pipe """
+    try:
+        conn.send((True, func(*args)))
+    except Exception as error:
+        conn.send((False, "{0}: {1}".format(type(error).__name__, error)))
+    finally:
+        conn.close()
+
+
+#==============================================================================
+def run_isolated(func, args):
+    """ Run a function in a freshly spawned process and return its result
+
+    A plain (non-daemonic) process is used rather than a process pool, so
+    the function may start worker processes of its own.
+    """
+    spawn= multiprocessing.get_context("spawn")
+    parent_conn, child_conn= spawn.Pipe(duplex=False)
+    process= spawn.Process(
+        target=isolated_worker, args=(child_conn, func, args)
+    )
+    process.start()
+    child_conn.close()
+
+    try:
+        ok, result= parent_conn.recv()
+    except EOFError:
+        ok= False
+        result= "process exited with code {0}".format(process.exitcode)
+    process.join()
+
+    if(not ok):
+        raise RuntimeError(result)
+
+    return result
+
+
+#==============================================================================
+def run_benchmarks(sizes, cases=CASES, repeat=3, work_path=None,
+        time_series=["global:confirmed"], workers=None,
+        ncdc_fixture="references/ncdc_page.html"):
+    """ Run every case on synthetic data of every size
+
+    The synthetic data of a size is written and processed once; every case
+    then loads its input and runs in its own freshly spawned process, so
+    memory peaks do not carry over from one case to the next. This process
+    does not import pandas itself.
+
+    Parameters:
+    ----------
+    sizes: dict
+        (regions, days) per size name, see SIZES
+    cases: list of strings
+        cases to run, see CASES
+    repeat: int
+        number of timed runs per case
+    work_path: URI-like
+        folder for the synthetic data, a temporary folder if None
+    time_series: list of strings
+        time series ingested by store_relational_model as "scope:metric"
+    workers: int
+        number of processes reading time series in store_relational_model
+    ncdc_fixture: URI-like
+        saved NCDC page
+
+    Returns:
+    -------
+    results: list of dicts
+        "case", "size", "regions", "days", "repeat", "min_seconds",
+        "median_seconds" and the fields returned by measure_case
+    """
+    options= {
+        "time_series": time_series, "workers": workers,
+        "ncdc_fixture": ncdc_fixture
+    }
+    temporary= work_path is None
+    if(temporary):
+        work_path= tempfile.mkdtemp(prefix="covid_benchmark_")
+
+    def record(case, size, n_regions, n_days, data_path):
+        result= run_isolated(measure_case, (case, data_path, options, repeat))
+        result.update({
+            "case": case, "size": size, "regions": n_regions, "days": n_days,
+            "repeat": repeat, "min_seconds": min(result["seconds"]),
+            "median_seconds": statistics.median(result["seconds"])
+        })
+        results.append(result)
+        print(
+            "{0:>24} {1:>8}: {2:.4f}s min, {3:.4f}s median, traced peak "
+            "{4:.1f} MB, peak RSS {5:.1f} MB".format(
+                case, size, result["min_seconds"], result["median_seconds"],
+                result["traced_peak_bytes"]/1024**2,
+                result["peak_rss_bytes"]/1024**2
+            )
+        )
+        if("payload_bytes" in result):
+            print("{0:>24} {1:>8}: {2:.1f} kB of responses".format(
+                case, size, result["payload_bytes"]/1024
+            ))
+
+    results= []
+    try:
+        for case in cases:
+            if(case in FIXTURE_CASES):
+                record(case, "fixture", None, None, work_path)
+
+        for size, (n_regions, n_days) in sizes.items():
+            size_cases= [case for case in cases if case not in FIXTURE_CASES]
+            if(not size_cases):
+                break
+
+            data_path= os.path.join(work_path, size) + "/"
+            start= time.time()
+            run_isolated(
+                prepare_datasets, (data_path, n_regions, n_days, workers)
+            )
+            print("Prepared {0} regions x {1} days in {2:.2f}s.".format(
+                n_regions, n_days, time.time() - start
+            ))
+
+            for case in size_cases:
+                record(case, size, n_regions, n_days, data_path)
+
+    finally:
+        if(temporary):
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    return results
+
+
+#==============================================================================
+def package_versions():
+    """ Versions of the packages the benchmarks depend on """
+    from importlib import import_module
+
+    versions= {}
+    packages= ["numpy", "pandas", "scipy", "sklearn", "pyarrow", "bs4", "dash"]
+    for name in packages:
+        try:
+            versions[name]= getattr(import_module(name), "__version__", None)
+        except ImportError:
+            versions[name]= None
+
+    return versions
+
+
+#==============================================================================
+def write_results(results, path):
+    """ Write results with a description of the machine as JSON """
+    report= {
+        "created": datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "versions": package_versions(),
+        "results": results,
+    }
+
+    if(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+
+
+#==============================================================================
+def compare_results(results, baseline, tolerance=0.2):
+    """ Compare results against the results of a previous run
+
+    Cases are matched by case and size. Minimum time and peak RSS are
+    compared, since they are the least affected by other load on the machine.
+
+    Parameters:
+    ----------
+    results: list of dicts
+        as returned by run_benchmarks
+    baseline: dict
+        report as written by write_results
+    tolerance: float
+        allowed relative increase over the baseline
+
+    Returns:
+    -------
+    regressions: list of strings
+        "case size metric" of every value above the tolerance
+    """
+    previous= {
+        (each["case"], each["size"]): each for each in baseline["results"]
+    }
+
+    regressions= []
+    for result in results:
+        base= previous.get((result["case"], result["size"]))
+        if(base is None):
+            continue
+
+        ratios= {
+            metric:
+                result[metric]/base[metric] if base[metric] else float("nan")
+            for metric in ["min_seconds", "peak_rss_bytes"]
+        }
+        print("{0:>24} {1:>8}: time x{2:.2f}, peak RSS x{3:.2f}".format(
+            result["case"], result["size"], ratios["min_seconds"],
+            ratios["peak_rss_bytes"]
+        ))
+        for metric, ratio in ratios.items():
+            if(ratio > 1 + tolerance):
+                regressions.append("{0} {1} {2}".format(
+                    result["case"], result["size"], metric
+                ))
+
+    return regressions
+
+
+#==============================================================================
+def main(argv=None):
+    """ Entry point of the covid-benchmark command """
+    # Collect command-line arguments
+    cl_options= cl_parser.parse_args(argv)
+
+    sizes= {size: SIZES[size] for size in cl_options.sizes}
+    if((cl_options.regions is None) != (cl_options.days is None)):
+        cl_parser.error("--regions and --days must be given together")
+    if(cl_options.regions is not None):
+        sizes["{0}x{1}".format(cl_options.regions, cl_options.days)]= (
+            cl_options.regions, cl_options.days
+        )
+
+    results= run_benchmarks(
+        sizes, cases=cl_options.cases, repeat=cl_options.repeat,
+        work_path=cl_options.work_path, time_series=cl_options.time_series,
+        workers=cl_options.workers, ncdc_fixture=cl_options.ncdc_fixture
+    )
+    write_results(results, cl_options.output)
+    print("Results written to {0}.".format(cl_options.output))
+
+    if(cl_options.baseline is not None):
+        with open(cl_options.baseline) as baseline_file:
+            regressions= compare_results(
+                results, json.load(baseline_file),
+                tolerance=cl_options.tolerance
+            )
+        if(regressions):
+            print("Regressions: {0}.".format(", ".join(regressions)))
+            sys.exit(1)
+
+
+#==============================================================================
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+""" Fetching, processing, storing and publishing datasets
+
+Functions are imported from their modules on first access, so importing
+src.data does not import pandas, requests, ... before they are needed.
+"""
+from src._lazy import lazy_exports
+
+# Public name -> module defining it
+_EXPORTS= {
+    "FORMATS": "src.data.storage",
+    "TIME_SERIES": "src.data.storage",
+    "DATASET_NAMES": "src.data.storage",
+    "processed_path": "src.data.storage",
+    "time_series_path": "src.data.storage",
+    "read_processed": "src.data.storage",
+    "write_processed": "src.data.storage",
+    "ProcessedWriter": "src.data.storage",
+    "compact_schema": "src.data.storage",
+    "read_settings": "src.data.storage",
+    "get_johns_hopkings": "src.data.get_data",
+    "get_current_nigeria": "src.data.get_data",
+    "SOURCES": "src.data.national",
+    "Source": "src.data.national",
+    "fetch_sources": "src.data.national",
+    "parse_html_table": "src.data.national",
+    "parse_ncdc_table": "src.data.national",
+    "append_snapshot": "src.data.history",
+    "record_scrape": "src.data.history",
+    "read_history": "src.data.history",
+    "compact_history": "src.data.history",
+    "history_relational": "src.data.history",
+    "reshape_time_series": "src.data.process_JH_data",
+    "store_relational_model": "src.data.process_JH_data",
+    "schema_report": "src.data.process_JH_data",
+    "publish_version": "src.data.publish",
+    "current_version": "src.data.publish",
+    "version_data_path": "src.data.publish",
+}
+
+__getattr__, __all__= lazy_exports(__name__, _EXPORTS)
@@ -1,21 +1,14 @@
 # Imports
-import os, subprocess, json
-
-# Environmental Variables
-from dotenv import load_dotenv
-
-import pandas as pd
-
-# HTTP Client
-import requests
-
-# For parsing and sifting through HTML
-from bs4 import BeautifulSoup
+import os, shutil, subprocess, time
 
 import argparse
 
-# Load environmental variables specified in .env
-load_dotenv()
+from src.data.storage import FORMATS, processed_path
+from src.data.national import SOURCES, fetch_sources
+from src.metrics import StageMetrics, files_size, metrics_path
+
+# Ref holding the latest Johns Hopkins snapshot in sparse mode
+SNAPSHOT_REF= "refs/remotes/origin/snapshot"
 
 #==============================================================================
 # COMMAND LINE ARGUMENTS
@@ -32,21 +25,210 @@ cl_parser.add_argument(
     help="Path to data folder"
 )
 
-# Collect command-line arguments
-cl_options= cl_parser.parse_args()
+# Johns Hopkins repository
+cl_parser.add_argument(
+    "--jh_remote", action="store",
+    default="https://github.com/CSSEGISandData/COVID-19.git",
+    help="URL of the Johns Hopkins repository"
+)
+# Ingestion mode
+cl_parser.add_argument(
+    "--jh_mode", action="store", default="sparse", choices=["sparse", "full"],
+    help="Fetch only the latest commit and the configured paths (sparse) or \
+        clone and pull the whole repository (full)"
+)
+# Paths checked out in sparse mode
+cl_parser.add_argument(
+    "--jh_paths", action="store", nargs="+",
+    default=["csse_covid_19_data/csse_covid_19_time_series"],
+    help="Repository folders checked out in sparse mode"
+)
+# Garbage collection
+cl_parser.add_argument(
+    "--jh_gc", action="store_true",
+    help="Keep only the latest snapshot after updating (sparse mode: \
+        replace the clone by a fresh one; full mode: prune unreachable \
+        objects)"
+)
+# Timeout
+cl_parser.add_argument(
+    "--git_timeout", action="store", type=int, default=600,
+    help="Seconds after which a git command is aborted"
+)
+# Output formats
+cl_parser.add_argument(
+    "--output_format", action="store", nargs="+", default=["csv"],
+    choices=FORMATS,
+    help="Formats in which processed datasets are written"
+)
+# National sources
+cl_parser.add_argument(
+    "--national_sources", action="store", nargs="*", default=list(SOURCES),
+    choices=list(SOURCES),
+    help="National data sources fetched concurrently, see national.SOURCES"
+)
+cl_parser.add_argument(
+    "--source_url", action="append", default=[], metavar="NAME=URL",
+    help="Fetch a national source from another URL, e.g. a local server \
+        serving saved pages"
+)
+cl_parser.add_argument(
+    "--http_timeout", action="store", type=float, default=30,
+    help="Seconds after which connecting to or reading from a national \
+        source is aborted"
+)
+cl_parser.add_argument(
+    "--http_retries", action="store", type=int, default=3,
+    help="Number of retries, with exponential backoff, per national source"
+)
+# Metrics
+cl_parser.add_argument(
+    "--metrics_path", action="store", default=None,
+    help="Prometheus textfile to which stage metrics are written \
+        (default: <data_path>metrics/get_data.prom)"
+)
+cl_parser.add_argument(
+    "--no_metrics", action="store_true",
+    help="Do not write stage metrics"
+)
+
+
+#==============================================================================
+def dir_size(path):
+    """ Total size of all files below a folder in bytes """
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path) for name in names
+    )
 
 
 #==============================================================================
-def get_johns_hopkings(data_path):
+def run_git(args, cwd, timeout=600):
+    """ Run a git command
+
+    Parameters:
+    ----------
+    args: list of strings
+        git arguments, e.g. ["fetch", "--depth", "1"]
+    cwd: URI-like
+        working directory
+    timeout: int
+        seconds after which the command is killed
+
+    Returns:
+    -------
+    result: dict
+        "ok", "stdout", "stderr" and "seconds" spent
+    """
+    start= time.time()
+    try:
+        git_proc= subprocess.run(
+            ["git"] + args, cwd=cwd,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout
+        )
+        result= {
+            "ok": git_proc.returncode == 0,
+            "stdout": git_proc.stdout.decode(errors="replace"),
+            "stderr": git_proc.stderr.decode(errors="replace")
+        }
+    # subprocess.run kills the process once the timeout expires
+    except subprocess.TimeoutExpired:
+        result= {
+            "ok": False, "stdout": "", 
+            "stderr": "git {0} timed out after {1} seconds".format(
+                args[0], timeout
+            )
+        }
+
+    result["seconds"]= time.time() - start
+    return result
+
+
+#==============================================================================
+def run_steps(steps, report, timeout=600):
+    """ Run git commands one after another until one fails
+
+    Parameters:
+    ----------
+    steps: list of tuples
+        (working directory, git arguments)
+    report: dict
+        "ok", "seconds" and "steps" are updated, see get_johns_hopkings
+    timeout: int
+        seconds after which a git command is aborted
+
+    Returns:
+    -------
+    ok: bool
+    """
+    for cmd_wd, args in steps:
+        result= run_git(args, cmd_wd, timeout=timeout)
+        report["seconds"]+= result["seconds"]
+        report["steps"].append({"args": args, "seconds": result["seconds"]})
+
+        if(not result["ok"]):
+            report["ok"]= False
+            print(
+                "Update operation on Johns Hopkins Dataset from GITHUB "
+                "failed...\n"
+            )
+            print("Error: " + result["stderr"])
+            return False
+
+    return True
+
+
+#==============================================================================
+def sparse_clone_steps(parent_wd, name, remote, paths):
+    """ Steps cloning the latest commit of remote, only paths checked out """
+    repo_wd= parent_wd + "/" + name
+
+    return [
+        (parent_wd, [
+            "clone", "--depth", "1", "--filter=blob:none", "--no-checkout",
+            remote, name
+        ]),
+        (repo_wd, ["sparse-checkout", "set"] + paths),
+        (repo_wd, ["checkout"]),
+    ]
+
+
+#==============================================================================
+def get_johns_hopkings(data_path,
+        remote="https://github.com/CSSEGISandData/COVID-19.git",
+        mode="sparse", paths=["csse_covid_19_data/csse_covid_19_time_series"],
+        gc=False, timeout=600):
     """ Update data from Johns Hopkings (GITHUB)
+
+    In "sparse" mode only the latest commit is fetched (--depth 1), blobs are 
+    only downloaded for the checked out paths (--filter=blob:none with a 
+    sparse checkout of paths). Updates fetch the remote HEAD into 
+    SNAPSHOT_REF and reset the checked out branch to it. git gc keeps every
+    object of a partial clone's (promisor) packs, reachable or not, so with 
+    gc the clone is replaced by a fresh sparse clone of the latest snapshot,
+    which also drops the history of a former full clone. In "full" mode the
+    whole repository is cloned and pulled, gc prunes unreachable objects.
     
     Parameters:
     ----------
     data_path: URI-like
         Path to data folder
+    remote: URI-like
+        URL of the Johns Hopkins repository
+    mode: string
+        "sparse" or "full"
+    paths: list of strings
+        repository folders checked out in sparse mode
+    gc: bool
+        prune objects which are no longer reachable after updating
+    timeout: int
+        seconds after which a git command is aborted
 
     Returns:
     -------
+    report: dict
+        "ok", bytes received (growth of the object store), "seconds" spent, 
+        size of the repository on disk and the steps run
     """
 
     # GIT CLONE
@@ -60,103 +242,156 @@ def get_johns_hopkings(data_path):
         # Create directory
         os.mkdir(data_path + "raw/JH_dataset")
 
-    # Check if Dataset doesn't already exist in filesystem
-    if(not os.path.exists(data_path + "raw/JH_dataset/COVID-19")):
-        # Command to clone dataset
-        cmd=  "git clone https://github.com/CSSEGISandData/COVID-19.git"
-        cmd_wd= data_path + "raw/JH_dataset"
+    parent_wd= data_path + "raw/JH_dataset"
+    repo_wd= data_path + "raw/JH_dataset/COVID-19"
+    cloned= os.path.exists(repo_wd)
+    objects_path= repo_wd + "/.git/objects"
+    objects_before= dir_size(objects_path) if cloned else 0
+
+    # Steps as (working directory, git arguments)
+    if(mode == "full" and not cloned):
+        steps= [(parent_wd, ["clone", remote, "COVID-19"])]
+
+    elif(mode == "full"):
+        steps= [(repo_wd, ["pull"])]
+
+    elif(not cloned):
+        steps= sparse_clone_steps(parent_wd, "COVID-19", remote, paths)
 
-    # Otherwise if Dataset repo has already been cloned, peform pull operation
     else:
-        cmd= "git pull"
-        cmd_wd= data_path + "raw/JH_dataset/COVID-19"
-
-    # Pull from Git repo
-    git_proc= subprocess.Popen(
-        cmd,
-        cwd=cmd_wd, shell=True, 
-        stdout= subprocess.PIPE, stderr= subprocess.PIPE
+        steps= [
+            (repo_wd, ["sparse-checkout", "set"] + paths),
+            (repo_wd, [
+                "fetch", "--depth", "1", "--filter=blob:none", "--no-tags", 
+                "origin", "+HEAD:" + SNAPSHOT_REF
+            ]),
+            (repo_wd, ["reset", "--hard", SNAPSHOT_REF]),
+        ]
+
+    report= {"ok": True, "seconds": 0.0, "steps": []}
+    run_steps(steps, report, timeout=timeout)
+
+    # Bytes fetched into the object store
+    report["bytes_received"]= max(dir_size(objects_path) - objects_before, 0) \
+        if os.path.exists(objects_path) else 0
+
+    # Drop history which is no longer reachable
+    if(report["ok"] and gc and mode == "sparse"):
+        fresh_wd, old_wd= repo_wd + ".gc", repo_wd + ".old"
+        for path in [fresh_wd, old_wd]:
+            if(os.path.exists(path)):
+                shutil.rmtree(path)
+
+        steps= sparse_clone_steps(parent_wd, "COVID-19.gc", remote, paths)
+        if(run_steps(steps, report, timeout)):
+            report["bytes_received"]+= dir_size(fresh_wd + "/.git/objects")
+            # The old clone is only removed once the fresh one is in place
+            os.rename(repo_wd, old_wd)
+            os.rename(fresh_wd, repo_wd)
+            shutil.rmtree(old_wd)
+
+    elif(report["ok"] and gc):
+        run_steps([
+            (repo_wd, ["reflog", "expire", "--expire=now", "--all"]),
+            (repo_wd, ["gc", "--prune=now", "--quiet"])
+        ], report, timeout)
+
+    report["repo_bytes"]= dir_size(repo_wd) if os.path.exists(repo_wd) else 0
+
+    print(
+        "Johns Hopkins update: {0:.1f}s, {1} bytes received, "
+        "repository {2} bytes.".format(
+            report["seconds"], report["bytes_received"], report["repo_bytes"]
+        )
     )
 
-    proc_timeout= 600
-    try:
-        (git_proc_out, git_proc_err)= git_proc.communicate(timeout=proc_timeout)
-    except TimeoutError:
-        print("Update operation on Johns Hopkins Dataset from GITHUB failed...\n")
-
-    print("Output: " + str(git_proc_out))
-    print("Error: " + str(git_proc_err))
+    return report
 
 
 
 #==============================================================================
-def get_current_nigeria(data_path):
+def get_current_nigeria(data_path, formats=["csv"], timeout=30, retries=3):
     """ Update data from Nigeria Centre for Disease Control (NCDC)
 
-    Update data from NCDC via webscraping
+    Update data from NCDC via webscraping, see national.fetch_sources
     
     Parameters:
     ----------
     data_path: URI-like
         Path to data folder
+    formats: list of strings
+        formats in which the dataset is written, see storage.FORMATS
+    timeout: float
+        seconds after which connecting or reading is aborted
+    retries: int
+        number of retries
 
     Returns:
     -------
+    report: dict
+        see national.fetch_source
     """
-    # WEB SCRAPING
-    # Pull page on COVID-19
-    page= requests.get("https://covid19.ncdc.gov.ng/")
-    # Parse HTML
-    parsed_page= BeautifulSoup(page.content, 'html.parser')
-    # Pull Table
-    html_table= parsed_page.find('table')
-    # Pull table rows
-    table_rows= html_table.find_all('tr')
-
-    # Table Header
-    table_header= dict()
-    # Table data
-    table_data=[]
-
-    # Loop through table rows
-    for idx,row in enumerate(table_rows):
-        # Table headers in first row
-        if(idx==0):
-            # Pull column headers
-            col_headers= row.find_all('th')
-            # Make a dictionary of column headers
-            table_headers= { idx:col_header.get_text(strip=True) for idx,col_header in enumerate(col_headers) }
-        
-        # Table data
-        # Get row columns
-        row_cols= row.find_all('td')
-        # Get data body into list
-        row_data= [ col.get_text(strip=True) for col in row_cols ]
-        # Append col to row list
-        table_data.append(row_data)
-
-        # Make data into Pandas Frame
-    pd_table= pd.DataFrame(table_data)
-    # Remove empty rows
-    pd_table= pd_table.dropna()
-    # Insert column names
-    pd_table= pd_table.rename(columns=table_headers)
-
-    # Drop column "No. of Cases (on admission)"
-    pd_table= pd_table.drop(["No. of Cases (on admission)"], axis=1)
-    # Rename "No. of Cases (Lab Confirmed)"
-    pd_table= pd_table.rename(
-        columns={"No. of Cases (Lab Confirmed)": "No. of Cases"}
+    report= fetch_sources(
+        data_path, [SOURCES["NCDC"]], formats=formats, timeout=timeout,
+        retries=retries
+    )[0]
+    if(report["status"] == "failed"):
+        raise RuntimeError(report["error"])
+
+    return report
+
+
+#==============================================================================
+def main(argv=None):
+    """ Entry point of the covid-get-data command """
+    # Environmental Variables
+    from dotenv import load_dotenv
+    # Load environmental variables specified in .env
+    load_dotenv()
+
+    # Collect command-line arguments
+    cl_options= cl_parser.parse_args(argv)
+
+    stage_metrics= StageMetrics("get_data")
+    stage_metrics.start("fetch")
+
+    jh_report= get_johns_hopkings(
+        cl_options.data_path, remote=cl_options.jh_remote,
+        mode=cl_options.jh_mode, paths=cl_options.jh_paths,
+        gc=cl_options.jh_gc, timeout=cl_options.git_timeout
+    )
+    urls= dict(each.split("=", 1) for each in cl_options.source_url)
+    national_reports= fetch_sources(
+        cl_options.data_path, 
+        [
+            SOURCES[name]._replace(url=urls.get(name, SOURCES[name].url))
+            for name in cl_options.national_sources
+        ],
+        formats=cl_options.output_format, timeout=cl_options.http_timeout,
+        retries=cl_options.http_retries
     )
 
-    # UPDATE DATASET
-    pd_table.to_csv(
-        data_path + "processed/NCDC.csv", sep=";", 
+    failed= not jh_report["ok"] or \
+        any(each["status"] == "failed" for each in national_reports)
+    updated= [each for each in national_reports if each["status"] == "updated"]
+    stage_metrics.finish(
+        "fetch", status="failed" if failed else "ran",
+        rows_out=sum(each["rows"] for each in updated),
+        bytes_read=jh_report["bytes_received"] + sum(
+            each["bytes_received"] for each in national_reports
+        ),
+        bytes_written=files_size([
+            processed_path(cl_options.data_path, each["name"], fmt)
+            for each in updated for fmt in cl_options.output_format
+        ])
     )
-    print("Updated data for all {0} states in Nigeria.".format(pd_table.shape[0]))
+    if(not cl_options.no_metrics):
+        stage_metrics.write_textfile(
+            cl_options.metrics_path or
+            metrics_path(cl_options.data_path, "get_data")
+        )
 
 
 #==============================================================================
 if __name__ == "__main__":
-    get_johns_hopkings(cl_options.data_path)
-    get_current_nigeria(cl_options.data_path)
+    main()
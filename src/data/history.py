@@ -0,0 +1,325 @@
+# Imports
+import os, json, hashlib
+from datetime import datetime
+
+from src.data.storage import processed_path, read_processed, write_processed
+
+# Snapshots appended before the log is compacted into the history dataset
+COMPACT_EVERY= 30
+
+# Key columns of a snapshot, all other columns are integer counts
+KEY_COLUMNS= ["date", "state"]
+
+
+#==============================================================================
+def history_name(name):
+    """ Name of the history dataset of a source, e.g. "NCDC_history" """
+    return name + "_history"
+
+
+#==============================================================================
+def log_path(data_path, name):
+    """ Path of the log of snapshots appended since the last compaction """
+    return data_path + "history/" + name + "/log.csv"
+
+
+#==============================================================================
+def state_path(data_path, name):
+    """ Path of the file holding the digest of the last snapshot, the log size
+    and the day of the last scrape """
+    return data_path + "history/" + name + "/state.json"
+
+
+#==============================================================================
+def history_format():
+    """ Columnar format of the history datasets, csv without pyarrow """
+    try:
+        import pyarrow
+        return "feather"
+    except ImportError:
+        return "csv"
+
+
+#==============================================================================
+def read_state(data_path, name):
+    """ Digest of the last snapshot, number of snapshots in the log and day of
+    the last scrape ("last_seen", None if unknown) """
+    state= {"digest": None, "logged": 0, "last_seen": None}
+    try:
+        with open(state_path(data_path, name)) as state_file:
+            state.update(json.load(state_file))
+    except (FileNotFoundError, ValueError):
+        pass
+
+    return state
+
+
+#==============================================================================
+def write_state(data_path, name, state):
+    """ Atomically replace the state file """
+    tmp_path= state_path(data_path, name) + ".tmp"
+    with open(tmp_path, "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_path, state_path(data_path, name))
+
+
+#==============================================================================
+def ncdc_snapshot(pd_table):
+    """ Typed snapshot of the NCDC table
+
+    Parameters:
+    ----------
+    pd_table: pandas DataFrame
+        as returned by national.parse_ncdc_table
+
+    Returns:
+    -------
+    df_snapshot: pandas DataFrame
+        "state" and integer columns "confirmed", "discharged" and "deaths"
+    """
+    import pandas as pd
+
+    columns= {
+        "States Affected": "state", "No. of Cases": "confirmed",
+        "No. Discharged": "discharged", "No. of Deaths": "deaths"
+    }
+    df_snapshot= pd_table[list(columns)].rename(columns=columns)
+    df_snapshot= df_snapshot.reset_index(drop=True)
+
+    for col in ["confirmed", "discharged", "deaths"]:
+        # Thousands are separated by commas, cells which are not numbers
+        # count as 0
+        df_snapshot[col]= pd.to_numeric(
+            df_snapshot[col].str.replace(",", "", regex=False), errors="coerce"
+        ).fillna(0).astype("int64")
+
+    return df_snapshot
+
+
+#==============================================================================
+def append_snapshot(data_path, name, df_snapshot, scraped=None, fmt=None,
+        compact_every=COMPACT_EVERY):
+    """ Append a snapshot to the history of a source
+
+    A snapshot with the same values as the previous one is dropped, only
+    the day of the scrape is recorded (see record_scrape). Others are
+    appended to a small csv log, which is compacted into the history
+    dataset every compact_every snapshots.
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    name: string
+        name of the source, e.g. "NCDC"
+    df_snapshot: pandas DataFrame
+        one row per state, integer counts, see ncdc_snapshot
+    scraped: datetime
+        time of the scrape, now (UTC) if None
+    fmt: string
+        format of the history dataset, see history_format
+    compact_every: int
+        number of logged snapshots after which the log is compacted
+
+    Returns:
+    -------
+    appended: bool
+        False if the snapshot did not change
+    """
+    state= read_state(data_path, name)
+    scraped= scraped or datetime.utcnow()
+    day= scraped.strftime("%Y-%m-%d")
+
+    df_snapshot= df_snapshot.sort_values("state").reset_index(drop=True)
+    digest= hashlib.sha256(
+        df_snapshot.to_csv(index=False).encode()
+    ).hexdigest()
+    if(digest == state["digest"]):
+        record_scrape(data_path, name, scraped)
+        return False
+
+    # Day of the scrape as first column
+    df_snapshot.insert(0, "date", day)
+
+    path= log_path(data_path, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df_snapshot.to_csv(
+        path, sep=";", index=False, mode="a", header=not os.path.exists(path)
+    )
+
+    state.update({
+        "digest": digest, "logged": state["logged"] + 1,
+        "last_seen": max(state["last_seen"] or day, day)
+    })
+    write_state(data_path, name, state)
+
+    if(state["logged"] >= compact_every):
+        compact_history(data_path, name, fmt=fmt)
+
+    return True
+
+
+#==============================================================================
+def record_scrape(data_path, name, scraped=None):
+    """ Record the day of a scrape, also if the page or snapshot is unchanged
+
+    Unchanged snapshots are not stored, so without this the history would
+    end at the last change instead of the last scrape, see history_relational.
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    name: string
+        name of the source, e.g. "NCDC"
+    scraped: datetime
+        time of the scrape, now (UTC) if None
+    """
+    state= read_state(data_path, name)
+    day= (scraped or datetime.utcnow()).strftime("%Y-%m-%d")
+    if(state["last_seen"] is not None and state["last_seen"] >= day):
+        return
+
+    os.makedirs(os.path.dirname(state_path(data_path, name)), exist_ok=True)
+    state["last_seen"]= day
+    write_state(data_path, name, state)
+
+
+#==============================================================================
+def read_log(data_path, name):
+    """ Snapshots appended since the last compaction, None if there are none
+    """
+    import pandas as pd
+
+    path= log_path(data_path, name)
+    if(not os.path.exists(path)):
+        return None
+
+    df_log= pd.read_csv(path, sep=";", dtype={"state": object})
+    df_log["date"]= df_log["date"].astype("datetime64[ns]")
+
+    return df_log
+
+
+#==============================================================================
+def read_history(data_path, name, fmt=None):
+    """ All snapshots of a source, one row per (scrape date, state)
+
+    Reads the compacted history dataset once, memory-mapped for feather,
+    plus the log of snapshots appended since. Of several snapshots of one
+    day, the last one is kept.
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    name: string
+        name of the source, e.g. "NCDC"
+    fmt: string
+        format of the history dataset, see history_format
+
+    Returns:
+    -------
+    df_history: pandas DataFrame
+        "date", "state" and integer counts, sorted by date and state
+    """
+    import pandas as pd
+
+    fmt= fmt or history_format()
+    parts= []
+    if(os.path.exists(processed_path(data_path, history_name(name), fmt))):
+        parts.append(read_processed(data_path, history_name(name), fmt=fmt))
+
+    df_log= read_log(data_path, name)
+    if(df_log is not None):
+        parts.append(df_log)
+
+    if(not parts):
+        raise FileNotFoundError(
+            "No history of {0} in {1}".format(name, data_path)
+        )
+
+    df_history= pd.concat(parts, ignore_index=True)
+    df_history= df_history.drop_duplicates(KEY_COLUMNS, keep="last")
+
+    return df_history.sort_values(KEY_COLUMNS).reset_index(drop=True)
+
+
+#==============================================================================
+def compact_history(data_path, name, fmt=None):
+    """ Merge the log into the history dataset and start a new log
+
+    The history dataset is replaced atomically, the log is only removed
+    after that, so an interrupted compaction loses nothing.
+
+    Returns:
+    -------
+    rows: int
+        number of rows of the history dataset
+    """
+    fmt= fmt or history_format()
+    if(read_log(data_path, name) is None):
+        return None
+
+    df_history= read_history(data_path, name, fmt=fmt)
+    write_processed(df_history, data_path, history_name(name), formats=[fmt])
+
+    os.remove(log_path(data_path, name))
+    state= read_state(data_path, name)
+    state["logged"]= 0
+    write_state(data_path, name, state)
+
+    return df_history.shape[0]
+
+
+#==============================================================================
+def history_relational(data_path, name, country="Nigeria", fmt=None):
+    """ History of a source as a relational dataset for the feature code
+
+    Days between scrapes carry the counts of the previous scrape forward,
+    so every state has one row per day and the result can be passed to
+    calc_filtered_data, calc_doubling_rate or build_features_panel. The
+    last snapshot is carried forward to the last scrape, see record_scrape.
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    name: string
+        name of the source, e.g. "NCDC"
+    country: string
+        value of the "country" column
+    fmt: string
+        format of the history dataset, see history_format
+
+    Returns:
+    -------
+    df_rel: pandas DataFrame
+        "index", "date", "state", "country" and the counts as float,
+        sorted by date as prepare_relational does
+    """
+    import pandas as pd
+
+    df_history= read_history(data_path, name, fmt=fmt)
+    counts= [col for col in df_history.columns if col not in KEY_COLUMNS]
+
+    # Dense (date x state) grid up to the last scrape, one pivot per count
+    last= df_history["date"].max()
+    last_seen= read_state(data_path, name)["last_seen"]
+    if(last_seen is not None):
+        last= max(last, pd.Timestamp(last_seen))
+    dates= pd.date_range(df_history["date"].min(), last, freq="D")
+    states= df_history["state"].unique()
+    df_rel= pd.DataFrame(
+        index=pd.MultiIndex.from_product([dates, states], names=KEY_COLUMNS)
+    )
+    for col in counts:
+        panel= df_history.pivot(index="date", columns="state", values=col)
+        panel= panel.reindex(dates).ffill()
+        panel= panel.stack(dropna=False).reindex(df_rel.index)
+        df_rel[col]= panel.astype("float64")
+
+    df_rel= df_rel.reset_index()
+    df_rel.insert(2, "country", country)
+
+    return df_rel.reset_index()
@@ -0,0 +1,327 @@
+# Imports
+import os, json, time, collections
+from concurrent.futures import ThreadPoolExecutor
+
+from src.data.storage import processed_path, write_processed
+from src.data.history import append_snapshot, ncdc_snapshot, record_scrape
+
+# A national data source: the processed dataset "name" is extracted from the
+# page at "url" by "extractor", a function taking the page content (bytes)
+# and returning a pandas DataFrame. "snapshot" turns that DataFrame into a
+# typed snapshot which is appended to the history of the source, see
+# history.append_snapshot; sources without one keep no history
+Source= collections.namedtuple(
+    "Source", ["name", "url", "extractor", "snapshot"], defaults=[None]
+)
+
+# HTTP status codes which are retried with backoff
+RETRY_STATUS= [429, 500, 502, 503, 504]
+
+
+#==============================================================================
+def html_parser():
+    """ Fastest installed parser backend of BeautifulSoup
+
+    lxml is a C parser and several times faster than the pure-Python
+    html.parser, which is used if lxml is not installed.
+    """
+    try:
+        import lxml
+        return "lxml"
+    except ImportError:
+        return "html.parser"
+
+
+#==============================================================================
+def parse_html_table(content, index=0):
+    """ Extract a table of an HTML page, header cells become column names
+
+    Only the <table> elements of the page are parsed.
+
+    Parameters:
+    ----------
+    content: bytes or string
+        HTML page
+    index: int
+        position of the table among the tables of the page
+
+    Returns:
+    -------
+    pd_table: pandas DataFrame
+        one row per complete table row with cells as text, labelled by 
+        the position of the row in the table
+    """
+    # Imported here, scraping is the only part of this module which needs them
+    import pandas as pd
+    # For parsing and sifting through HTML
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    # Parse tables only
+    parsed_page= BeautifulSoup(
+        content, html_parser(), parse_only=SoupStrainer("table")
+    )
+    html_table= parsed_page.find_all("table")[index]
+
+    # Column names from the header cells of the first row
+    table_rows= html_table.find_all("tr")
+    table_headers= [
+        col.get_text(strip=True) for col in table_rows[0].find_all("th")
+    ]
+    # Data cells of every row
+    table_data= [
+        [col.get_text(strip=True) for col in row.find_all("td")]
+        for row in table_rows
+    ]
+
+    pd_table= pd.DataFrame(table_data)
+    # Remove header and incomplete rows
+    pd_table= pd_table.dropna()
+    pd_table= pd_table.rename(columns=dict(enumerate(table_headers)))
+
+    return pd_table
+
+
+#==============================================================================
+def parse_ncdc_table(content):
+    """ Parse the table of cases per state from the NCDC website
+
+    Parameters:
+    ----------
+    content: bytes or string
+        HTML of https://covid19.ncdc.gov.ng/
+
+    Returns:
+    -------
+    pd_table: pandas DataFrame
+        one row per state
+    """
+    pd_table= parse_html_table(content)
+
+    # Drop column "No. of Cases (on admission)"
+    pd_table= pd_table.drop(["No. of Cases (on admission)"], axis=1)
+    # Rename "No. of Cases (Lab Confirmed)"
+    pd_table= pd_table.rename(
+        columns={"No. of Cases (Lab Confirmed)": "No. of Cases"}
+    )
+
+    return pd_table
+
+
+# Registered sources, by dataset name
+SOURCES= {
+    "NCDC": Source(
+        "NCDC", "https://covid19.ncdc.gov.ng/", parse_ncdc_table, ncdc_snapshot
+    ),
+}
+
+
+#==============================================================================
+def http_session(pool_size=8, retries=3, backoff=0.5):
+    """ HTTP session with pooled connections and retries
+
+    Failed connections and the status codes in RETRY_STATUS are retried
+    with exponential backoff (backoff, 2*backoff, 4*backoff, ... seconds),
+    Retry-After headers are respected.
+
+    Parameters:
+    ----------
+    pool_size: int
+        number of connections kept open per host
+    retries: int
+        number of retries per request
+    backoff: float
+        backoff factor in seconds
+
+    Returns:
+    -------
+    session: requests.Session
+    """
+    # HTTP Client
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry= Retry(
+        total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUS,
+        raise_on_status=False
+    )
+    adapter= HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+
+    session= requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+#==============================================================================
+def validators_path(data_path):
+    """ Path of the file holding the ETag and Last-Modified of every source """
+    return data_path + "raw/national_validators.json"
+
+
+#==============================================================================
+def read_validators(data_path):
+    """ Validators of the last successful fetch per source, empty if none """
+    try:
+        with open(validators_path(data_path)) as validators_file:
+            return json.load(validators_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+#==============================================================================
+def write_validators(data_path, validators):
+    """ Atomically replace the validators file """
+    os.makedirs(data_path + "raw", exist_ok=True)
+    tmp_path= validators_path(data_path) + ".tmp"
+    with open(tmp_path, "w") as validators_file:
+        json.dump(validators, validators_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, validators_path(data_path))
+
+
+#==============================================================================
+def fetch_source(session, source, data_path, validators, formats=["csv"],
+        timeout=30):
+    """ Fetch, extract and store one source, run in a worker thread
+
+    A conditional request is sent with the validators of the last fetch;
+    if the page did not change (304), nothing is extracted or written.
+    Otherwise the dataset is replaced and a snapshot is appended to the
+    history of the source.
+
+    Parameters:
+    ----------
+    session: requests.Session
+        shared session, see http_session
+    source: Source
+        source to fetch
+    data_path: URI-like
+        Path to data folder
+    validators: dict
+        "etag" and "last_modified" of the last fetch of this source
+    formats: list of strings
+        formats in which the dataset is written, see storage.FORMATS
+    timeout: float
+        seconds after which connecting or reading is aborted
+
+    Returns:
+    -------
+    report: dict
+        "name", "status" ("updated", "not_modified" or "failed"), "rows",
+        "bytes_received", "seconds", new "validators", whether a "snapshot"
+        was appended and "error"
+    """
+    start= time.time()
+    report= {
+        "name": source.name, "status": "failed", "rows": None,
+        "bytes_received": 0, "validators": validators, "snapshot": False,
+        "error": None
+    }
+
+    headers= {}
+    # Without the dataset on disk the page must be extracted again
+    if(os.path.exists(processed_path(data_path, source.name, formats[0]))):
+        if(validators.get("etag")):
+            headers["If-None-Match"]= validators["etag"]
+        if(validators.get("last_modified")):
+            headers["If-Modified-Since"]= validators["last_modified"]
+
+    try:
+        page= session.get(source.url, headers=headers, timeout=timeout)
+        report["bytes_received"]= len(page.content)
+
+        if(page.status_code == 304):
+            report["status"]= "not_modified"
+            if(source.snapshot is not None):
+                record_scrape(data_path, source.name)
+        else:
+            page.raise_for_status()
+            pd_table= source.extractor(page.content)
+            write_processed(
+                pd_table.reset_index(), data_path, source.name, formats=formats
+            )
+            if(source.snapshot is not None):
+                report["snapshot"]= append_snapshot(
+                    data_path, source.name, source.snapshot(pd_table)
+                )
+            report.update({
+                "status": "updated", "rows": pd_table.shape[0],
+                "validators": {
+                    "etag": page.headers.get("ETag"),
+                    "last_modified": page.headers.get("Last-Modified")
+                }
+            })
+
+    except Exception as error:
+        report["error"]= "{0}: {1}".format(type(error).__name__, error)
+
+    report["seconds"]= time.time() - start
+
+    return report
+
+
+#==============================================================================
+def fetch_sources(data_path, sources=None, formats=["csv"], workers=8,
+        timeout=30, retries=3, backoff=0.5):
+    """ Fetch national data sources concurrently
+
+    All sources are fetched in a thread pool through one session with
+    pooled connections. A failing source does not stop the others.
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    sources: list of Source
+        sources to fetch, all registered SOURCES if None
+    formats: list of strings
+        formats in which the datasets are written, see storage.FORMATS
+    workers: int
+        number of sources fetched at the same time
+    timeout: float
+        seconds after which connecting or reading is aborted
+    retries, backoff:
+        see http_session
+
+    Returns:
+    -------
+    reports: list of dicts
+        see fetch_source, in the order of sources
+    """
+    if(sources is None):
+        sources= list(SOURCES.values())
+
+    validators= read_validators(data_path)
+    session= http_session(pool_size=workers, retries=retries, backoff=backoff)
+
+    with session, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures= [
+            executor.submit(
+                fetch_source, session, source, data_path,
+                validators.get(source.name, {}), formats, timeout
+            )
+            for source in sources
+        ]
+        reports= [future.result() for future in futures]
+
+    for report in reports:
+        validators[report["name"]]= report["validators"]
+        if(report["status"] == "failed"):
+            print("Update of {0} failed: {1}".format(
+                report["name"], report["error"]
+            ))
+        elif(report["status"] == "not_modified"):
+            print("{0} did not change ({1:.2f}s).".format(
+                report["name"], report["seconds"]
+            ))
+        else:
+            print("Updated {0}: {1} rows ({2:.2f}s).".format(
+                report["name"], report["rows"], report["seconds"]
+            ))
+
+    write_validators(data_path, validators)
+
+    return reports
@@ -1,19 +1,23 @@
 # Imports
-import os, subprocess, json
-from datetime import datetime
-
-# Environmental Variables
-from dotenv import load_dotenv
+import os, sys, time, resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
 
-# HTTP Client
-import requests
-# For parsing and sifting through HTML
-from bs4 import BeautifulSoup
-
 import argparse
 
+from src.data.storage import FORMATS, TIME_SERIES, DATASET_NAMES, \
+    ProcessedWriter, compact_schema, legacy_schema, processed_path, \
+    read_processed, time_series_path, write_processed
+from src.metrics import StageMetrics, count_rows, files_size, metrics_path
+
+# Key columns of the relational dataset per scope
+KEY_COLUMNS= {
+    "global": ["state", "country"], "US": ["state", "country", "county"]
+}
+
 #==============================================================================
 # COMMAND LINE ARGUMENTS
 # Create parser object
@@ -29,60 +33,635 @@ cl_parser.add_argument(
     help="Path to data folder"
 )
 
-# Collect command-line arguments
-cl_options= cl_parser.parse_args()
+# Output formats
+cl_parser.add_argument(
+    "--output_format", action="store", nargs="+", default=["csv"],
+    choices=FORMATS,
+    help="Formats in which processed datasets are written"
+)
+# Time series
+cl_parser.add_argument(
+    "--time_series", action="store", nargs="+",
+    default=[
+        "global:confirmed", "global:deaths", "global:recovered",
+        "US:confirmed", "US:deaths"
+    ],
+    help="Time series to ingest as scope:metric, see TIME_SERIES"
+)
+# Worker processes
+cl_parser.add_argument(
+    "--workers", action="store", type=int, default=None,
+    help="Number of processes reading time series concurrently \
+        (default: number of CPUs)"
+)
+# Streaming conversion
+cl_parser.add_argument(
+    "--memory_budget", action="store", type=float, default=None,
+    help="Convert time series in row blocks, keeping the long-format data \
+        in memory below this many MB (processes scopes one after another)"
+)
+# Memory report
+cl_parser.add_argument(
+    "--memory_report", action="store_true",
+    help="Report peak RSS of the in-memory and the streaming conversion of \
+        every scope instead of storing the datasets"
+)
+# Schema report
+cl_parser.add_argument(
+    "--schema_report", action="store_true",
+    help="Report the memory of the stored datasets in the compact schema and \
+        in the former schema (object names with 'no', 64-bit numbers) instead \
+        of storing the datasets"
+)
+# Partition parquet output
+cl_parser.add_argument(
+    "--partition_by_country", action="store_true",
+    help="Partition parquet datasets into one directory per country"
+)
+# Metrics
+cl_parser.add_argument(
+    "--metrics_path", action="store", default=None,
+    help="Prometheus textfile to which stage metrics are written \
+        (default: <data_path>metrics/process_JH_data.prom)"
+)
+cl_parser.add_argument(
+    "--no_metrics", action="store_true",
+    help="Do not write stage metrics"
+)
 
 
 #==============================================================================
-def store_relational_model(data_path):
-    """ Process Johns Hopkings data into a Relational dataset
+def reshape_time_series(raw_data_path, metric="confirmed", scope="global"):
+    """ Reshape a Johns Hopkings time series file into the relational schema
     
     Parameters:
     ----------
-    data_path: URI-like
-        Path to data folder
+    raw_data_path: URI-like
+        path to time series file
+    metric: string
+        name of the value column
+    scope: string
+        "global" or "US", see TIME_SERIES
 
     Returns:
     -------
+    rel_fr: pandas DataFrame
+        one row per (date, key columns) with the metric as value column; 
+        keys are categorical with nulls for missing names, entries without 
+        a value are dropped
     """
-    # Read data into dataframe
-    raw_data_path= data_path + "raw/JH_dataset/COVID-19/" + \
-        "csse_covid_19_data/csse_covid_19_time_series/" + \
-        "time_series_covid19_confirmed_global.csv"
     pd_raw= pd.read_csv(raw_data_path)
 
     # Create DataFrame
     rel_fr= pd.DataFrame(pd_raw)
 
-    # Discard Lat and Long columns
-    rel_fr= rel_fr.drop(["Lat", "Long"], axis=1)
+    if(scope == "US"):
+        # Discard identifiers, coordinates and population
+        rel_fr= rel_fr.drop(
+            [
+                "UID", "iso2", "iso3", "code3", "FIPS", "Lat", "Long_",
+                "Combined_Key", "Population"
+            ],
+            axis=1, errors="ignore"
+        )
+        rel_fr= rel_fr.rename(columns=key_renames(scope))
+    else:
+        # Discard Lat and Long columns
+        rel_fr= rel_fr.drop(["Lat", "Long"], axis=1)
+        # Rename columns for convienence
+        rel_fr= rel_fr.rename(
+            columns={"Province/State": "state", "Country/Region": "country"}
+            )
+
+    keys= KEY_COLUMNS[scope]
+    date_cols= [col for col in rel_fr.columns if col[0].isdigit()]
+    values= rel_fr[date_cols].to_numpy(dtype=np.float64)
+    n_rows, n_dates= values.shape
+
+    # Date by date: repeat every date for all rows, tile the keys by their
+    # codes
+    dates= pd.to_datetime(date_cols, format="%m/%d/%y").to_numpy()
+    long_fr= pd.DataFrame({"date": np.repeat(dates, n_rows)})
+    for key in keys:
+        names= pd.Categorical(rel_fr[key])
+        long_fr[key]= pd.Categorical.from_codes(
+            np.tile(names.codes, n_dates), names.categories
+        )
+    long_fr[metric]= values.T.ravel()
+
+    return long_fr[long_fr[metric].notna()].reset_index(drop=True)
+
+
+#==============================================================================
+def load_time_series(data_path, scope, metric, file_name):
+    """ Read and reshape one time series file, run in a worker process
+
+    Returns:
+    -------
+    result: tuple
+        (scope, metric, relational DataFrame, seconds spent)
+    """
+    start= time.time()
+    rel_fr= reshape_time_series(
+        time_series_path(data_path, file_name), metric=metric, scope=scope
+    )
+
+    return scope, metric, rel_fr, time.time() - start
+
+
+#==============================================================================
+def key_renames(scope):
+    """ Raw key column names of a scope and their relational names """
+    if(scope == "US"):
+        return {
+            "Province_State": "state", "Country_Region": "country",
+            "Admin2": "county"
+        }
+
+    return {"Province/State": "state", "Country/Region": "country"}
+
+
+#==============================================================================
+def read_keys(raw_data_path, scope):
+    """ Read only the key columns of a time series file """
+    renames= key_renames(scope)
+    df_keys= pd.read_csv(raw_data_path, usecols=list(renames.keys()))
+
+    return df_keys.rename(columns=renames)[KEY_COLUMNS[scope]]
+
+
+#==============================================================================
+def stream_relational_scope(data_path, scope, metrics, name, formats=["csv"],
+        memory_budget=256):
+    """ Convert the time series of a scope to long format in row blocks
+
+    The primary (first) time series is read in blocks of rows whose 
+    long-format representation fits into memory_budget and each block is 
+    appended to the output. Secondary time series with the same row order 
+    are read in lockstep; others are held as numeric wide arrays, which are 
+    small compared to their long-format object representation, and aligned 
+    by key. Rows are written region by region rather than date by date.
+    Dates of the primary time series missing in a secondary one get NaN 
+    values, as in the left join of relational_scope.
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    scope: string
+        "global" or "US", see TIME_SERIES
+    metrics: list of (metric, file name)
+        time series of the scope, the first defines the rows
+    name: string
+        name of the output dataset
+    formats: list of strings
+        formats in which the dataset is written, non-partitioned only
+    memory_budget: float
+        budget for the long-format data of a block in MB
+
+    Returns:
+    -------
+    rows: int
+        number of rows written
+    """
+    keys= KEY_COLUMNS[scope]
+    renames= key_renames(scope)
+    primary_metric, primary_file= metrics[0]
+    primary_path= time_series_path(data_path, primary_file)
+
+    # Date columns and block size from the header
+    header= pd.read_csv(primary_path, nrows=0).columns
+    date_cols= [col for col in header if col[0].isdigit()]
+    dates= pd.to_datetime(date_cols, format="%m/%d/%y").to_numpy()
+
+    # Long format bytes per wide row: date, keys and metrics, each 8 bytes,
+    # with room for the intermediate copies of a block
+    row_bytes= len(dates)*8*(1 + len(keys) + len(metrics))*4
+    block_rows= max(1, int(memory_budget*1024**2//row_bytes))
+
+    # Secondary time series: lockstep readers or wide arrays aligned by key
+    primary_keys= pd.MultiIndex.from_frame(read_keys(primary_path, scope))
+    secondary= []
+    for metric, file_name in metrics[1:]:
+        path= time_series_path(data_path, file_name)
+        metric_keys= pd.MultiIndex.from_frame(read_keys(path, scope))
+        # Dates of the primary time series which this one reports
+        metric_header= set(pd.read_csv(path, nrows=0).columns)
+        metric_cols= [col for col in date_cols if col in metric_header]
+        if(metric_keys.equals(primary_keys)):
+            reader= pd.read_csv(
+                path, usecols=metric_cols, dtype=np.float64,
+                chunksize=block_rows
+            )
+            secondary.append((metric, reader, None))
+        else:
+            values= pd.read_csv(path, usecols=metric_cols, dtype=np.float64)
+            values= values.reindex(columns=date_cols)
+            values.index= metric_keys
+            secondary.append((metric, None, values))
+
+    writer= ProcessedWriter(data_path, name, formats=formats)
+    primary_reader= pd.read_csv(
+        primary_path, usecols=list(renames.keys()) + date_cols,
+        chunksize=block_rows
+    )
+    for block in primary_reader:
+        block_keys= block[list(renames.keys())].rename(columns=renames)[keys]
+        n_rows= len(block)
+
+        # Repeat keys for every date, tile dates for every row
+        df_long= pd.DataFrame({"date": np.tile(dates, n_rows)})
+        for key in keys:
+            df_long[key]= np.repeat(block_keys[key].to_numpy(), len(dates))
+        df_long[primary_metric]= \
+            block[date_cols].to_numpy(dtype=np.float64).ravel()
+
+        for metric, reader, values in secondary:
+            if(reader is not None):
+                metric_block= next(reader).reindex(columns=date_cols)
+            else:
+                metric_block= values.reindex(
+                    pd.MultiIndex.from_frame(block_keys)
+                )
+            df_long[metric]= metric_block.to_numpy(dtype=np.float64).ravel()
+
+        # As in reshape_time_series, entries without a value are dropped
+        writer.write(df_long[df_long[primary_metric].notna()])
+
+    writer.close()
+
+    return writer.rows
+
+
+#==============================================================================
+def relational_scope(data_path, scope, metrics, name, formats=["csv"]):
+    """ Convert and join the time series of a scope in memory and write them
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    scope: string
+        "global" or "US", see TIME_SERIES
+    metrics: list of (metric, file name)
+        time series of the scope, the first defines the rows
+    name: string
+        name of the output dataset
+    formats: list of strings
+        formats in which the dataset is written
+
+    Returns:
+    -------
+    rows: int
+        number of rows written
+    """
+    rel_fr= None
+    for metric, file_name in metrics:
+        metric_fr= reshape_time_series(
+            time_series_path(data_path, file_name), metric=metric, scope=scope
+        )
+        if(rel_fr is None):
+            rel_fr= metric_fr
+        else:
+            rel_fr= pd.merge(
+                rel_fr, metric_fr, on=["date"] + KEY_COLUMNS[scope], how="left"
+            )
+
+    write_processed(rel_fr, data_path, name, formats=formats)
+
+    return rel_fr.shape[0]
+
+
+#==============================================================================
+def peak_rss_worker(func, args):
+    """ Run a function, return its result and the peak RSS of the process
+    in bytes """
+    result= func(*args)
+    peak_rss= resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    if(sys.platform != "darwin"):
+        peak_rss*= 1024
+
+    return result, peak_rss
+
+
+#==============================================================================
+def memory_report(data_path, time_series=["global:confirmed"],
+        formats=["csv"], memory_budget=256):
+    """ Compare peak RSS of the in-memory and the streaming conversion
+
+    Every conversion runs in a freshly started process, so peaks do not 
+    carry over. Output is written to "<dataset>_memory_report" and removed.
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    time_series: list of strings
+        time series to convert as "scope:metric", see TIME_SERIES
+    formats: list of strings
+        formats in which the datasets are written
+    memory_budget: float
+        budget of the streaming conversion in MB
+
+    Returns:
+    -------
+    report: list of dicts
+        scope, method, rows and peak RSS per conversion
+    """
+    requested= set(time_series)
+    spawn= multiprocessing.get_context("spawn")
+
+    report= []
+    for scope, series in TIME_SERIES.items():
+        metrics= [
+            (metric, file_name) for metric, file_name in series
+            if scope + ":" + metric in requested
+        ]
+        if(not metrics):
+            continue
+
+        name= DATASET_NAMES[scope] + "_memory_report"
+        runs= [
+            ("in-memory", relational_scope,
+                (data_path, scope, metrics, name, formats)),
+            ("streaming", stream_relational_scope, 
+                (data_path, scope, metrics, name, formats, memory_budget)),
+        ]
+        for method, func, args in runs:
+            with ProcessPoolExecutor(
+                    max_workers=1, mp_context=spawn) as executor:
+                rows, peak_rss= executor.submit(
+                    peak_rss_worker, func, args
+                ).result()
+
+            report.append({
+                "scope": scope, "method": method, "rows": rows,
+                "peak_rss": peak_rss
+            })
+            print("{0:>8} {1:>10}: {2} rows, peak RSS {3:.1f} MB".format(
+                scope, method, rows, peak_rss/1024**2
+            ))
+
+        for fmt in formats:
+            os.remove(processed_path(data_path, name, fmt))
+
+    return report
+
+
+#==============================================================================
+def schema_report(data_path, fmt="csv",
+        names=list(DATASET_NAMES.values()) +
+            ["COVID_final_set", "COVID_rollup_set"]):
+    """ Compare the memory of processed datasets in the compact and the
+    former schema
+
+    The former schema held names as Python strings with 'no' for missing
+    names and numbers as 64-bit values, see storage.legacy_schema.
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    fmt: string
+        format in which the datasets are read
+    names: list of strings
+        datasets to compare, those not stored are skipped
+
+    Returns:
+    -------
+    report: list of dicts
+        dataset, rows and bytes in the "legacy" and "compact" schema
+    """
+    report= []
+    for name in names:
+        if(not os.path.exists(processed_path(data_path, name, fmt))):
+            continue
+
+        df_compact= read_processed(data_path, name, fmt=fmt)
+        legacy= legacy_schema(df_compact).memory_usage(
+            index=False, deep=True
+        ).sum()
+        compact= df_compact.memory_usage(index=False, deep=True).sum()
+
+        report.append({
+            "dataset": name, "rows": len(df_compact), "legacy": legacy,
+            "compact": compact
+        })
+        print("{0}: {1} rows, {2:.1f} MB -> {3:.1f} MB ({4:.0%} less)".format(
+            name, len(df_compact), legacy/1024**2, compact/1024**2,
+            1 - compact/legacy
+        ))
+        print("    " + ", ".join(
+            "{0} {1}".format(col, dtype)
+            for col, dtype in df_compact.dtypes.items()
+        ))
+
+    return report
+
+
+#==============================================================================
+def store_relational_model(data_path, formats=["csv"], partition_by=None,
+        time_series=["global:confirmed"], workers=None, memory_budget=None):
+    """ Process Johns Hopkings data into Relational datasets
+
+    Time series files are read and reshaped concurrently in a process pool. 
+    The metrics of each scope are joined into one dataset with one column 
+    per metric: COVID_relational_full for "global", COVID_relational_US 
+    for "US". With a memory_budget, scopes are instead converted one after 
+    another in row blocks by stream_relational_scope. Datasets are in the
+    compact schema, see storage.compact_schema: provinces, states and 
+    counties without a name are null.
     
-    # Set NaN to 'no'. Important for indexing
-    rel_fr= rel_fr.fillna('no')
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    formats: list of strings
+        formats in which the dataset is written, see storage.FORMATS
+    partition_by: string
+        column by which parquet datasets are partitioned
+    time_series: list of strings
+        time series to ingest as "scope:metric", see TIME_SERIES
+    workers: int
+        number of worker processes, number of CPUs if None
+    memory_budget: float
+        budget of the streaming conversion in MB, None to convert in memory
 
-    # Rename columns for convienence
-    rel_fr= rel_fr.rename(
-        columns={"Province/State": "state", "Country/Region": "country"}
+    Returns:
+    -------
+    datasets: dict
+        relational DataFrame per scope, empty when streaming
+    """
+
+    # Files to read, keeping the order of TIME_SERIES within each scope
+    requested= set(time_series)
+    jobs= [
+        (scope, metric, file_name)
+        for scope, series in TIME_SERIES.items()
+        for metric, file_name in series
+        if scope + ":" + metric in requested
+    ]
+    unknown= requested - set(scope + ":" + metric for scope, metric, _ in jobs)
+    if(unknown):
+        raise ValueError(
+            "Unknown time series: {0}".format(", ".join(sorted(unknown)))
         )
-    # Index data by (state, country)
-    rel_fr= rel_fr.set_index(["state", "country"])
-    # Make dates row headers and state/country column headers
-    rel_fr= rel_fr.T
-    # Stack the data by dates and reset indices
-    rel_fr= rel_fr.stack(["state", "country"]).reset_index()
-    # Set new column names
-    rel_fr= rel_fr.rename(columns={"level_0": "date", 0:"confirmed"})
-
-    # Convert date to datetime type
-    rel_fr["date"]= rel_fr.date.astype("datetime64[ns]")
+
+    if(memory_budget is not None):
+        if(partition_by is not None):
+            raise ValueError(
+                "Partitioned datasets cannot be written in row blocks"
+            )
+
+        for scope in DATASET_NAMES:
+            metrics= [
+                (metric, file_name)
+                for each, metric, file_name in jobs if each == scope
+            ]
+            if(not metrics):
+                continue
+
+            start= time.time()
+            rows= stream_relational_scope(
+                data_path, scope, metrics, DATASET_NAMES[scope], 
+                formats=formats, memory_budget=memory_budget
+            )
+            print("Number of rows stored for {0}: {1} ({2:.2f}s).".format(
+                scope, rows, time.time() - start
+            ))
+
+        return {}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures= [
+            executor.submit(
+                load_time_series, data_path, scope, metric, file_name
+            )
+            for scope, metric, file_name in jobs
+        ]
+        results= [future.result() for future in futures]
+
+    for (_, _, file_name), (_, _, rel_fr, seconds) in zip(jobs, results):
+        print("Processed {0} in {1:.2f}s ({2} rows).".format(
+            file_name, seconds, rel_fr.shape[0]
+        ))
+
+    # Join metrics of each scope
+    datasets= {}
+    for scope, metric, rel_fr, _ in results:
+        if(scope not in datasets):
+            datasets[scope]= rel_fr
+        else:
+            datasets[scope]= pd.merge(
+                datasets[scope], rel_fr, on=["date"] + KEY_COLUMNS[scope],
+                how="left"
+            )
+    datasets= {
+        scope: compact_schema(rel_fr) for scope, rel_fr in datasets.items()
+    }
 
     # UPDATE DATASET
-    rel_fr.to_csv(
-        data_path + "processed/COVID_relational_full.csv", sep=";",index=False
-    )
-    print("Number of rows stored: {0}.".format(rel_fr.shape[0]))
+    for scope, rel_fr in datasets.items():
+        write_processed(
+            rel_fr, data_path, DATASET_NAMES[scope], 
+            formats=formats, partition_by=partition_by
+        )
+        print("Number of rows stored for {0}: {1}.".format(
+            scope, rel_fr.shape[0]
+        ))
+
+    return datasets
+
+
+#==============================================================================
+def process_counters(data_path, time_series, datasets, formats=["csv"]):
+    """ Rows and bytes read and written by store_relational_model
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    time_series: list of strings
+        time series ingested as "scope:metric", see TIME_SERIES
+    datasets: dict
+        as returned by store_relational_model, rows are counted in the csv 
+        files if empty (streaming)
+    formats: list of strings
+        formats in which the datasets were written
+
+    Returns:
+    -------
+    counters: dict
+        "rows_in" (wide rows), "rows_out", "bytes_read" and "bytes_written", 
+        see StageMetrics.finish
+    """
+    inputs= [
+        time_series_path(data_path, file_name)
+        for scope, series in TIME_SERIES.items()
+        for metric, file_name in series
+        if scope + ":" + metric in time_series
+    ]
+    scopes= set(each.split(":")[0] for each in time_series)
+    outputs= [
+        processed_path(data_path, DATASET_NAMES[scope], fmt)
+        for scope in scopes for fmt in formats
+    ]
+
+    if(datasets):
+        rows_out= sum(rel_fr.shape[0] for rel_fr in datasets.values())
+    elif("csv" in formats):
+        rows_out= sum(
+            count_rows(processed_path(data_path, DATASET_NAMES[scope], "csv"))
+            for scope in scopes
+        )
+    else:
+        rows_out= None
+
+    return {
+        "rows_in": sum(count_rows(path) for path in inputs),
+        "rows_out": rows_out,
+        "bytes_read": files_size(inputs), "bytes_written": files_size(outputs)
+    }
+
+
+#==============================================================================
+def main(argv=None):
+    """ Entry point of the covid-process-jh command """
+    # Collect command-line arguments
+    cl_options= cl_parser.parse_args(argv)
+
+    if(cl_options.schema_report):
+        schema_report(cl_options.data_path, fmt=cl_options.output_format[0])
+    elif(cl_options.memory_report):
+        memory_report(
+            cl_options.data_path, time_series=cl_options.time_series, 
+            formats=cl_options.output_format,
+            memory_budget=cl_options.memory_budget or 256
+        )
+    else:
+        stage_metrics= StageMetrics("process_JH_data")
+        stage_metrics.start("process")
+
+        datasets= store_relational_model(
+            cl_options.data_path, formats=cl_options.output_format,
+            partition_by="country" if cl_options.partition_by_country \
+                else None,
+            time_series=cl_options.time_series, workers=cl_options.workers,
+            memory_budget=cl_options.memory_budget
+        )
+
+        if(not cl_options.no_metrics):
+            stage_metrics.finish("process", **process_counters(
+                cl_options.data_path, cl_options.time_series, datasets,
+                cl_options.output_format
+            ))
+            stage_metrics.write_textfile(
+                cl_options.metrics_path or
+                metrics_path(cl_options.data_path, "process_JH_data")
+            )
 
 
 #==============================================================================
 if __name__ == "__main__":
-    store_relational_model(cl_options.data_path)
\ No newline at end of file
+    main()
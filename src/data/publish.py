@@ -0,0 +1,242 @@
+# Imports
+import os, shutil, json, hashlib
+from datetime import datetime
+
+import argparse
+
+from src.data.storage import EXTENSIONS, settings_path
+from src.data.national import SOURCES
+
+# Datasets which are published, including one per national source
+DATASETS= [
+    "COVID_relational_full", "COVID_final_set", "COVID_rollup_set",
+    "COVID_alignment_set", "COVID_forecast_set"
+] + list(SOURCES)
+
+
+#==============================================================================
+def versions_path(data_path):
+    """ Path to the folder holding published versions """
+    return data_path + "versions/"
+
+
+#==============================================================================
+def version_data_path(data_path, version):
+    """ Data path of a published version
+
+    A version folder mirrors the layout of the data folder, so the datasets
+    of a version can be read with
+    storage.read_processed(version_data_path(...), ...).
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    version: string
+        version id
+
+    Returns:
+    -------
+    path: URI-like
+    """
+    return versions_path(data_path) + version + "/"
+
+
+#==============================================================================
+def current_version(data_path):
+    """ Id of the currently published version, None if nothing was published
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+
+    Returns:
+    -------
+    version: string
+    """
+    try:
+        with open(versions_path(data_path) + "CURRENT") as pointer:
+            return pointer.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+#==============================================================================
+def read_manifest(data_path, version):
+    """ Manifest of a published version
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    version: string
+        version id
+
+    Returns:
+    -------
+    manifest: dict
+    """
+    path= version_data_path(data_path, version) + "manifest.json"
+    with open(path) as manifest_file:
+        return json.load(manifest_file)
+
+
+#==============================================================================
+def file_digest(path):
+    """ SHA-256 of a file or of all files below a folder """
+    digest= hashlib.sha256()
+    paths= [path]
+    if(os.path.isdir(path)):
+        paths= sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(path) for name in names
+        )
+
+    for each in paths:
+        with open(each, "rb") as data_file:
+            for block in iter(lambda: data_file.read(1024**2), b""):
+                digest.update(block)
+
+    return digest.hexdigest()
+
+
+#==============================================================================
+def link_or_copy(src, dst):
+    """ Hard-link a file, copy it if linking is not possible """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+#==============================================================================
+def publish_version(data_path, datasets=DATASETS, keep_versions=3):
+    """ Publish the current processed datasets as an immutable version
+
+    All files of the given datasets found in <data_path>processed/ are
+    hard-linked (copied if linking fails) into a new version folder, a
+    manifest is written, and the "CURRENT" pointer is atomically replaced.
+    Since processed files are always replaced rather than rewritten
+    (see storage.write_processed), linked files never change afterwards.
+    Readers following the pointer therefore never see a half-written dataset.
+    Version ids hold the creation time in microseconds and a digest of the
+    content; a version which already exists under the same id holds the
+    same datasets and is only pointed to again.
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    datasets: list of strings
+        names of the datasets to publish
+    keep_versions: int
+        number of most recent versions to keep, older ones are deleted
+
+    Returns:
+    -------
+    version: string
+        id of the new version
+    """
+
+    created= datetime.utcnow()
+    staging_path= versions_path(data_path) + \
+        ".staging-{0}/".format(os.getpid())
+    if(os.path.exists(staging_path)):
+        shutil.rmtree(staging_path)
+    os.makedirs(staging_path + "processed")
+
+    manifest= {"created": created.isoformat() + "Z", "datasets": {}}
+    for name in datasets:
+        for fmt, extension in EXTENSIONS.items():
+            src= data_path + "processed/" + name + extension
+            if(not os.path.exists(src)):
+                continue
+
+            dst= staging_path + "processed/" + name + extension
+            if(os.path.isdir(src)):
+                shutil.copytree(src, dst, copy_function=link_or_copy)
+            else:
+                link_or_copy(src, dst)
+
+            manifest["datasets"].setdefault(name, {})[fmt]= {
+                "path": "processed/" + name + extension,
+                "sha256": file_digest(dst)
+            }
+
+        # Settings the dataset was built with, see storage.read_settings
+        src= settings_path(data_path, name)
+        if(name in manifest["datasets"] and os.path.exists(src)):
+            link_or_copy(src, settings_path(staging_path, name))
+
+    # Version ids sort by creation time
+    content_digest= hashlib.sha256(
+        json.dumps(manifest["datasets"], sort_keys=True).encode()
+    ).hexdigest()
+    version= created.strftime("%Y%m%dT%H%M%S%fZ") + "-" + content_digest[:8]
+    manifest["version"]= version
+
+    with open(staging_path + "manifest.json", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    # Move version into place, then switch the pointer. The same id means
+    # the same content, published at the same time
+    version_path= version_data_path(data_path, version)
+    if(os.path.exists(version_path + "manifest.json")):
+        shutil.rmtree(staging_path)
+    else:
+        os.replace(staging_path, version_path)
+    pointer_tmp= versions_path(data_path) + "CURRENT.tmp"
+    with open(pointer_tmp, "w") as pointer:
+        pointer.write(version)
+        pointer.flush()
+        os.fsync(pointer.fileno())
+    os.replace(pointer_tmp, versions_path(data_path) + "CURRENT")
+
+    # Remove old versions
+    versions= sorted(
+        each for each in os.listdir(versions_path(data_path))
+        if not each.startswith(".") and os.path.exists(
+            version_data_path(data_path, each) + "manifest.json"
+        )
+    )
+    for old_version in versions[:-keep_versions]:
+        if(old_version != version):
+            shutil.rmtree(version_data_path(data_path, old_version))
+
+    return version
+
+
+#==============================================================================
+def main(argv=None):
+    """ Entry point of the covid-publish command """
+    # COMMAND LINE ARGUMENTS
+    # Create parser object
+    cl_parser= argparse.ArgumentParser(
+        description="Publish the processed datasets as an immutable version."
+    )
+
+    # ARGUMENTS
+    # Path to data folder
+    cl_parser.add_argument(
+        "--data_path", action="store", default="data/",
+        help="Path to data folder"
+    )
+    # Versions to keep
+    cl_parser.add_argument(
+        "--keep_versions", action="store", type=int, default=3,
+        help="Number of most recent versions to keep"
+    )
+
+    # Collect command-line arguments
+    cl_options= cl_parser.parse_args(argv)
+
+    version= publish_version(
+        cl_options.data_path, keep_versions=cl_options.keep_versions
+    )
+    print("Published version {0}.".format(version))
+
+
+#==============================================================================
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,487 @@
+# Imports
+import os, shutil, json
+
+# Supported formats of processed datasets
+FORMATS= ["csv", "feather", "parquet"]
+
+# File extension per format
+EXTENSIONS= {"csv": ".csv", "feather": ".feather", "parquet": ".parquet"}
+
+# Johns Hopkins time series per scope, as (metric, file name).
+# The first metric of a scope defines its rows, the others are joined onto it.
+TIME_SERIES= {
+    "global": [
+        ("confirmed", "time_series_covid19_confirmed_global.csv"),
+        ("deaths", "time_series_covid19_deaths_global.csv"),
+        ("recovered", "time_series_covid19_recovered_global.csv"),
+    ],
+    "US": [
+        ("confirmed", "time_series_covid19_confirmed_US.csv"),
+        ("deaths", "time_series_covid19_deaths_US.csv"),
+    ],
+}
+
+# Processed dataset per scope
+DATASET_NAMES= {"global": "COVID_relational_full", "US": "COVID_relational_US"}
+
+# Compact schema of the processed datasets, see compact_schema
+# Columns holding names, categorical with nulls for missing names
+NAME_COLUMNS= ["state", "country", "county", "level", "region", "model"]
+# Cumulative counts, int32 when complete and float64 (exact) when values are
+# missing
+COUNT_COLUMNS= ["confirmed", "deaths", "recovered"]
+# Placeholder of missing names in datasets written before the compact schema
+LEGACY_MISSING= "no"
+
+# Country to continent mapping shipped with the repository, used for the
+# rollups
+CONTINENTS_PATH= os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "references",
+    "continents.csv"
+)
+
+
+#==============================================================================
+def time_series_path(data_path, file_name):
+    """ Path to a Johns Hopkings time series file """
+    return data_path + "raw/JH_dataset/COVID-19/" + \
+        "csse_covid_19_data/csse_covid_19_time_series/" + file_name
+
+
+#==============================================================================
+def processed_path(data_path, name, fmt="csv"):
+    """ Path of a processed dataset
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    name: string
+        name of the dataset, e.g. "COVID_final_set"
+    fmt: string
+        "csv", "feather" or "parquet"
+
+    Returns:
+    -------
+    path: URI-like
+    """
+
+    return data_path + "processed/" + name + EXTENSIONS[fmt]
+
+
+#==============================================================================
+def settings_path(data_path, name):
+    """ Path of the settings a processed dataset was built with """
+    return data_path + "processed/" + name + ".settings.json"
+
+
+#==============================================================================
+def read_settings(data_path, name):
+    """ Settings stored with a processed dataset, None if there are none
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    name: string
+        name of the dataset, e.g. "COVID_final_set"
+
+    Returns:
+    -------
+    settings: dict
+        as passed to write_processed
+    """
+    try:
+        with open(settings_path(data_path, name)) as settings_file:
+            return json.load(settings_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+#==============================================================================
+def compact_names(values, categorical=True):
+    """ Names with nulls instead of the LEGACY_MISSING placeholder
+
+    Parameters:
+    ----------
+    values: pandas Series
+        names, as strings or categorical
+    categorical: bool
+        return a categorical, else strings
+
+    Returns:
+    -------
+    values: pandas Series
+    """
+    if(values.dtype.name == "category"):
+        if(LEGACY_MISSING in values.cat.categories):
+            values= values.cat.remove_categories([LEGACY_MISSING])
+        return values if categorical else values.astype(object)
+
+    # Columns without any name are read as floats
+    values= values.astype(object, copy=False)
+    if((values == LEGACY_MISSING).any()):
+        values= values.where(values != LEGACY_MISSING)
+
+    return values.astype("category") if categorical else values
+
+
+#==============================================================================
+def compact_schema(df_input):
+    """ Convert a dataset to the compact schema of processed datasets
+
+    Names (NAME_COLUMNS) become categoricals with real nulls, dictionary-
+    encoded in feather and parquet files; dates datetime64; complete, 
+    integral counts (COUNT_COLUMNS) and other integers int32; other floats 
+    float32. Counts with missing values stay float64, which holds them 
+    exactly. Columns which already match are not copied, so memory-mapped 
+    columns stay memory-mapped.
+
+    Parameters:
+    ----------
+    df_input: pandas DataFrame
+        dataset in any schema, e.g. as written before the compact schema
+
+    Returns:
+    -------
+    df_out: pandas DataFrame
+        df_input itself if all columns match
+    """
+    import numpy as np
+    import pandas as pd
+
+    int32= np.iinfo(np.int32)
+
+    def fits_int32(values):
+        return len(values) == 0 or \
+            (values.min() >= int32.min and values.max() <= int32.max)
+
+    changed= {}
+    for col in df_input.columns:
+        values= df_input[col]
+        dtype= values.dtype
+
+        if(col in NAME_COLUMNS):
+            if(dtype.name != "category" or \
+                    LEGACY_MISSING in values.cat.categories):
+                changed[col]= compact_names(values)
+
+        elif(col == "date"):
+            if(not pd.api.types.is_datetime64_any_dtype(dtype)):
+                changed[col]= pd.to_datetime(values)
+
+        elif(dtype.kind in "iu"):
+            if(dtype != np.int32 and fits_int32(values)):
+                changed[col]= values.astype(np.int32)
+
+        elif(dtype.kind == "f" and col in COUNT_COLUMNS):
+            whole= values.notna().all() and (values == np.floor(values)).all()
+            if(whole and fits_int32(values)):
+                changed[col]= values.astype(np.int32)
+            elif(dtype != np.float64):
+                changed[col]= values.astype(np.float64)
+
+        elif(dtype.kind == "f" and dtype != np.float32):
+            changed[col]= values.astype(np.float32)
+
+    if(not changed):
+        return df_input
+
+    df_out= df_input.copy(deep=False)
+    for col, values in changed.items():
+        df_out[col]= values
+
+    return df_out
+
+
+#==============================================================================
+def legacy_schema(df_input):
+    """ Convert a dataset to the schema used before compact_schema
+
+    Names as strings with LEGACY_MISSING for missing names, integers as 
+    int64 and floats as float64. Used to report the memory saved.
+    """
+    import numpy as np
+
+    df_out= df_input.copy()
+    for col in df_out.columns:
+        dtype= df_out[col].dtype
+        if(col in NAME_COLUMNS):
+            df_out[col]= df_out[col].astype(object).where(
+                df_out[col].notna(), LEGACY_MISSING
+            )
+        elif(dtype.kind in "iu"):
+            df_out[col]= df_out[col].astype(np.int64)
+        elif(dtype.kind == "f"):
+            df_out[col]= df_out[col].astype(np.float64)
+
+    return df_out
+
+
+#==============================================================================
+def to_arrow_table(df_input):
+    """ Convert a DataFrame into a typed Arrow table
+
+    Float columns are converted without turning NaN into nulls, so they can be
+    memory-mapped back into pandas without a copy. Names are strings, also 
+    in chunks where all of them are missing; categorical names are 
+    dictionary-encoded.
+
+    Parameters:
+    ----------
+    df_input: pandas DataFrame
+        input data
+
+    Returns:
+    -------
+    table: pyarrow Table
+    """
+    import pyarrow as pa
+
+    columns= []
+    for col in df_input.columns:
+        if(col in NAME_COLUMNS and df_input[col].dtype == object):
+            columns.append(
+                pa.array(df_input[col], type=pa.string(), from_pandas=True)
+            )
+        elif(df_input[col].dtype.kind == "f"):
+            columns.append(
+                pa.array(df_input[col].to_numpy(), from_pandas=False)
+            )
+        else:
+            columns.append(pa.array(df_input[col], from_pandas=True))
+
+    return pa.Table.from_arrays(columns, names=list(df_input.columns))
+
+
+#==============================================================================
+def remove_path(path):
+    """ Remove a file or directory if it exists """
+    if(os.path.isdir(path) and not os.path.islink(path)):
+        shutil.rmtree(path)
+    elif(os.path.lexists(path)):
+        os.remove(path)
+
+
+#==============================================================================
+def move_into_place(tmp_path, path):
+    """ Move a finished file or directory to path, replacing what is there
+
+    A file replacing a file is swapped atomically by os.replace. A directory
+    (partitioned parquet) cannot be swapped in one step: the previous one is
+    renamed aside first and removed after the new one is in place, so path
+    is only missing between two renames, and not while it is being deleted.
+    """
+    if(os.path.lexists(path) and \
+            (os.path.isdir(path) or os.path.isdir(tmp_path))):
+        old_path= path + ".old"
+        remove_path(old_path)
+        os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        remove_path(old_path)
+    else:
+        os.replace(tmp_path, path)
+
+
+#==============================================================================
+def write_processed(df_input, data_path, name, formats=["csv"],
+        partition_by=None, settings=None):
+    """ Write a processed dataset in one or more formats
+
+    The dataset is converted to the compact schema first, see compact_schema.
+    csv files are semicolon-separated as before. feather files are written
+    uncompressed so they can be memory-mapped. parquet datasets may be
+    partitioned into one directory per value of a column, e.g. "country".
+    Each file is written under a temporary name and then moved into place,
+    see move_into_place.
+
+    Parameters:
+    ----------
+    df_input: pandas DataFrame
+        dataset
+    data_path: URI-like
+        Path to data folder
+    name: string
+        name of the dataset, e.g. "COVID_final_set"
+    formats: list of strings
+        formats to write, see FORMATS
+    partition_by: string
+        column by which parquet datasets are partitioned
+    settings: dict
+        JSON-serializable settings the dataset was built with, see 
+        read_settings. Settings of a previous dataset are removed before
+        the files are replaced, so they never describe other data
+
+    Returns:
+    -------
+    """
+
+    df_input= compact_schema(df_input)
+    remove_path(settings_path(data_path, name))
+
+    for fmt in formats:
+        path= processed_path(data_path, name, fmt)
+        # Write next to the target and move into place, a memory-mapped file
+        # must not be overwritten while it is being read. A partitioned parquet
+        # dataset would be added to a directory left behind by a failed run
+        tmp_path= path + ".tmp"
+        remove_path(tmp_path)
+
+        if(fmt == "csv"):
+            df_input.to_csv(tmp_path, sep=";", index=False)
+
+        elif(fmt == "feather"):
+            from pyarrow import feather
+            feather.write_feather(
+                to_arrow_table(df_input), tmp_path, compression="uncompressed"
+            )
+
+        elif(fmt == "parquet"):
+            from pyarrow import parquet
+            table= to_arrow_table(df_input)
+            if(partition_by is None):
+                parquet.write_table(table, tmp_path)
+            else:
+                parquet.write_to_dataset(
+                    table, tmp_path, partition_cols=[partition_by]
+                )
+
+        else:
+            raise ValueError("Unknown dataset format: {0}".format(fmt))
+
+        move_into_place(tmp_path, path)
+
+    if(settings is not None):
+        tmp_path= settings_path(data_path, name) + ".tmp"
+        with open(tmp_path, "w") as settings_file:
+            json.dump(settings, settings_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, settings_path(data_path, name))
+
+
+#==============================================================================
+def read_processed(data_path, name, fmt="csv", columns=None, memory_map=True):
+    """ Read a processed dataset
+
+    feather files are memory-mapped: numeric columns are backed by the page
+    cache, so loading is cheap and pages are shared between processes reading
+    the same file. Datasets of every format, and those written before the
+    compact schema, are returned in the compact schema, see compact_schema.
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    name: string
+        name of the dataset, e.g. "COVID_final_set"
+    fmt: string
+        "csv", "feather" or "parquet"
+    columns: list of strings
+        columns to read, all columns if None
+    memory_map: bool
+        memory-map feather and parquet files
+
+    Returns:
+    -------
+    df_out: pandas DataFrame
+    """
+
+    import pandas as pd
+
+    path= processed_path(data_path, name, fmt)
+
+    if(fmt == "csv"):
+        df_out= pd.read_csv(path, sep=";", usecols=columns)
+        if("date" in df_out.columns):
+            df_out["date"]= df_out["date"].astype("datetime64[ns]")
+        return compact_schema(df_out)
+
+    if(fmt == "feather"):
+        from pyarrow import feather
+        table= feather.read_table(path, columns=columns, memory_map=memory_map)
+
+    elif(fmt == "parquet"):
+        from pyarrow import parquet
+        table= parquet.read_table(path, columns=columns, memory_map=memory_map)
+
+    else:
+        raise ValueError("Unknown dataset format: {0}".format(fmt))
+
+    df_out= table.to_pandas(split_blocks=True)
+
+    return compact_schema(df_out)
+
+
+#==============================================================================
+class ProcessedWriter:
+    """ Write a processed dataset incrementally, one chunk of rows at a time
+
+    Only non-partitioned formats are supported. All chunks must have the same
+    columns and dtypes. Missing names are written as nulls, but names are not
+    dictionary-encoded and numbers keep their dtypes, since these could 
+    differ between chunks; read_processed converts them to the compact 
+    schema. As with write_processed, files are written under a temporary name
+    and moved into place by close().
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    name: string
+        name of the dataset, e.g. "COVID_relational_full"
+    formats: list of strings
+        formats to write, see FORMATS
+    """
+
+    def __init__(self, data_path, name, formats=["csv"]):
+        self.paths= {
+            fmt: processed_path(data_path, name, fmt) for fmt in formats
+        }
+        self.writers= {}
+        self.rows= 0
+        # Leftovers of a failed run
+        for path in self.paths.values():
+            remove_path(path + ".tmp")
+
+    def write(self, df_chunk):
+        """ Append a chunk of rows """
+        df_chunk= df_chunk.assign(**{
+            col: compact_names(df_chunk[col], categorical=False)
+            for col in NAME_COLUMNS if col in df_chunk.columns
+        })
+        table= None
+        for fmt, path in self.paths.items():
+            tmp_path= path + ".tmp"
+
+            if(fmt == "csv"):
+                df_chunk.to_csv(
+                    tmp_path, sep=";", index=False,
+                    mode="w" if self.rows == 0 else "a", header=self.rows == 0
+                )
+                continue
+
+            if(table is None):
+                table= to_arrow_table(df_chunk)
+
+            if(fmt not in self.writers):
+                if(fmt == "feather"):
+                    import pyarrow as pa
+                    self.writers[fmt]= pa.ipc.new_file(tmp_path, table.schema)
+                elif(fmt == "parquet"):
+                    from pyarrow import parquet
+                    self.writers[fmt]= parquet.ParquetWriter(
+                        tmp_path, table.schema
+                    )
+                else:
+                    raise ValueError("Unknown dataset format: {0}".format(fmt))
+
+            self.writers[fmt].write_table(table)
+
+        self.rows+= len(df_chunk)
+
+    def close(self):
+        """ Finish all files and move them into place """
+        for writer in self.writers.values():
+            writer.close()
+
+        for path in self.paths.values():
+            move_into_place(path + ".tmp", path)
@@ -0,0 +1,28 @@
+""" Filtered timelines and doubling rates
+
+Functions are imported from their modules on first access, so importing
+src.features does not import numpy, pandas, ... before they are needed.
+"""
+from src._lazy import lazy_exports
+
+# Public name -> module defining it
+_EXPORTS= {
+    "prepare_relational": "src.features.build_features",
+    "build_features_panel": "src.features.build_features",
+    "build_features_groupby": "src.features.build_features",
+    "build_features_incremental": "src.features.build_features",
+    "feature_settings": "src.features.build_features",
+    "build_rollups": "src.features.build_features",
+    "threshold_offsets": "src.features.build_features",
+    "read_continents": "src.features.build_features",
+    "calc_filtered_data": "src.features.build_features",
+    "calc_smoothed_data": "src.features.build_features",
+    "Smoother": "src.features.smoothing",
+    "parse_smoothers": "src.features.smoothing",
+    "smooth_panel": "src.features.smoothing",
+    "calc_doubling_rate": "src.features.build_features",
+    "calc_doubling_rate_vectorized": "src.features.build_features",
+    "region_index": "src.features.build_features",
+}
+
+__getattr__, __all__= lazy_exports(__name__, _EXPORTS)
@@ -1,9 +1,14 @@
+import os
 import numpy as np
 import pandas as pd
-from sklearn import linear_model
-from scipy import signal
 import argparse
 
+from src.data.storage import FORMATS, CONTINENTS_PATH, processed_path, \
+    read_processed, read_settings, write_processed
+from src.metrics import StageMetrics, files_size, metrics_path
+from src.features.smoothing import FILTER, Smoother, parse_smoothers, \
+    smooth_panel, smoother_reach
+
 #==============================================================================
 # COMMAND LINE ARGUMENTS
 # Create parser object
@@ -17,11 +22,122 @@ cl_parser.add_argument(
     "--data_path", action="store", default="data/",
     help="Path to data folder"
 )
+# Feature building mode
+cl_parser.add_argument(
+    "--mode", action="store", default="panel", choices=["panel", "groupby"],
+    help="Compute features on a dense (dates x regions) array (panel) or \
+        per (state, country) group on the relational table (groupby)"
+)
+# Compare panel and groupby output
+cl_parser.add_argument(
+    "--check_panel", action="store_true",
+    help="Assert that panel mode produces the same output as groupby mode, \
+        with the vectorized and (for --dr_window 3 --dr_method linear) the \
+        per-group regression engine"
+)
+# Incremental mode
+cl_parser.add_argument(
+    "--incremental", action="store_true",
+    help="Only recompute rows of the previous COVID_final_set.csv whose \
+        windows touch new or revised data (panel mode)"
+)
+# Incremental mode lookback
+cl_parser.add_argument(
+    "--incremental_days", action="store", type=int, default=14,
+    help="Rebuild everything if data changed more than this number of days \
+        before the last date of the previous COVID_final_set.csv"
+)
+# Doubling rate engine
+cl_parser.add_argument(
+    "--dr_engine", action="store", default="vectorized",
+    choices=["vectorized", "regression"],
+    help="Compute doubling rates with rolling OLS over all regions at once \
+        (vectorized) or with a LinearRegression fit per window (regression)"
+)
+# Doubling rate window
+cl_parser.add_argument(
+    "--dr_window", action="store", type=int, default=3,
+    help="Number of days over which the doubling rate is estimated \
+        (vectorized engine only)"
+)
+# Doubling rate method
+cl_parser.add_argument(
+    "--dr_method", action="store", default="linear",
+    choices=["linear", "log"],
+    help="Estimate the doubling rate from a line fit on the counts (linear) \
+        or from the growth rate of a line fit on the log-counts (log) \
+        (vectorized engine only)"
+)
+# Input format
+cl_parser.add_argument(
+    "--input_format", action="store", default="csv", choices=FORMATS,
+    help="Format in which processed datasets are read"
+)
+# Output formats
+cl_parser.add_argument(
+    "--output_format", action="store", nargs="+", default=["csv"],
+    choices=FORMATS,
+    help="Formats in which processed datasets are written"
+)
+# Partition parquet output
+cl_parser.add_argument(
+    "--partition_by_country", action="store_true",
+    help="Partition parquet datasets into one directory per country"
+)
+# Smoothers
+cl_parser.add_argument(
+    "--smoother", action="append", default=[],
+    help="Additional smoothed column confirmed_<name> as \
+        name=kind:param=value,... with kind savgol (window, degree), \
+        ewma (span) or ma (window), \
+        e.g. ewma7=ewma:span=7; filtered=savgol:window=7,degree=2 changes \
+        the filter of the _filtered columns (repeatable)"
+)
+# Alignment thresholds
+cl_parser.add_argument(
+    "--align_thresholds", action="store", type=int, nargs="+", default=None,
+    help="Confirmed cases at which the rollup timelines are aligned, written \
+        to COVID_alignment_set (default: 100 1000 10000)"
+)
+# Continent of each country, for the rollups
+cl_parser.add_argument(
+    "--continents_path", action="store", default=None,
+    help="Semicolon-separated file mapping country to continent \
+        (default: references/continents.csv)"
+)
+# Metrics
+cl_parser.add_argument(
+    "--metrics_path", action="store", default=None,
+    help="Prometheus textfile to which stage metrics are written \
+        (default: <data_path>metrics/build_features.prom)"
+)
+cl_parser.add_argument(
+    "--no_metrics", action="store_true",
+    help="Do not write stage metrics"
+)
+
+# Linear Regression Model, created on first use
+reg= None
+
+# Aggregation levels of the rollup set, from finest to coarsest
+ROLLUP_LEVELS= ['country', 'continent', 'world']
+
+# Counts which are summed in the rollups, if present
+COUNT_COLUMNS= ['confirmed', 'deaths', 'recovered']
+
+# Confirmed cases at which the timelines of the regions are aligned
+ALIGN_THRESHOLDS= [100, 1000, 10000]
+
 
-# Collect command-line arguments
-cl_options= cl_parser.parse_args()
-# Create Linear Regression Model
-reg= linear_model.LinearRegression(fit_intercept= True)  
+def linear_regression():
+    """ Shared Linear Regression Model, sklearn is imported on first use """
+    global reg
+
+    if(reg is None):
+        from sklearn import linear_model
+        reg= linear_model.LinearRegression(fit_intercept= True)
+
+    return reg
 
 
 def get_doubling_rate_via_regression(in_array):
@@ -48,6 +164,7 @@ def get_doubling_rate_via_regression(in_array):
     X= np.arange(-1,2).reshape(-1,1)
 
     # Fit data
+    reg= linear_regression()
     reg.fit(X,y)
     intercept= reg.intercept_
     slope= reg.coef_
@@ -80,45 +197,93 @@ def rolling_regression(df_input, col="confirmed"):
     return result
 
 
-def savgol_filter(df_input, col='confirmed', window=5):
-    """ Filter data using savgol filter.
+def savgol_filter(df_input, col='confirmed', window=5, degree=1):
+    """ Filter data of one region using savgol filter.
+
+    Reference implementation of the 'savgol' smoother for groupby mode, 
+    written independently of smoothing.smooth_panel with the same rules: 
+    missing entries are filled with the previous entry (the next one at the 
+    start, 0 without any), series shorter than the window are fit as a 
+    whole and filtered values of missing entries are NaN.
 
     Parameters:
     ----------
     df_input: pandas DataFrame
-        input data
+        input data, sorted by date
     col: string
         key to column which holds data entries
+    window: int
+        length of the filter window
+    degree: int
+        order of the polynomial used to fit the samples
 
     Returns:
     -------
     df_result: pandas DataFrame
-        df_input with additional column with name col+"_filtered"
+        copy of df_input with additional column with name col+"_filtered"
     """
 
-    window=5
-    degree=1
+    from scipy import signal
 
-    df_result=df_input
+    values= df_input[col].astype(np.float64)
+    filter_in= values.ffill().bfill().fillna(0).to_numpy()
 
-    filter_in= df_input[col].fillna(0)
-    result= signal.savgol_filter(
-            np.array(filter_in), window, degree
-        )
+    n_dates= len(filter_in)
+    if(window > n_dates):
+        window= n_dates if n_dates % 2 else n_dates-1
+        degree= min(degree, window-1)
+    result= signal.savgol_filter(filter_in, window, degree) if n_dates \
+        else filter_in
+
+    df_result= df_input.copy()
+    df_result[col+ "_filtered"]= np.where(values.isna(), np.nan, result)
 
-    df_result[col+ "_filtered"]= result
     return df_result
     
 
-def calc_filtered_data(df_input, filter_on='confirmed'):
-    """ Filter data using savgol filter and return merged dataframe
+def calc_smoothed_data(df_input, smooth_on='confirmed',
+        smoothers={'filtered': FILTER}):
+    """ Smooth a column of all regions at once and return the extended
+    dataframe
 
     Parameters:
     ----------
     df_input: pandas DataFrame
-        input data
+        relational data with one row per (date, state, country)
+    smooth_on: string
+        key to column which holds data entries to smooth
+    smoothers: dict
+        name -> smoothing.Smoother, all computed from one pivot of smooth_on
+
+    Returns:
+    -------
+    df_out: pandas DataFrame
+        df_input with additional columns smooth_on+"_"+name
+    """
+
+    panel, panel_idx= to_panel(df_input, smooth_on)
+
+    df_out= df_input.copy()
+    for name, smoothed in smooth_panel(panel, smoothers).items():
+        df_out[smooth_on+'_'+name]= from_panel(smoothed, panel_idx)
+
+    return df_out
+
+
+def calc_filtered_data(df_input, filter_on='confirmed', window=5, degree=1):
+    """ Filter data using savgol filter per (state, country) group and return
+    merged dataframe
+
+    Parameters:
+    ----------
+    df_input: pandas DataFrame
+        input data, sorted by date
     filter_on: string
         key to column which holds data entries on which to filter
+    window: int
+        length of the filter window
+    degree: int
+        order of the polynomial used to fit the samples
 
     Returns:
     -------
@@ -130,10 +295,14 @@ def calc_filtered_data(df_input, filter_on='confirmed'):
     must_contain= set(['state', 'country', filter_on])
     assert must_contain.issubset(set(df_input.columns))
 
-    pd_filt_res= df_input.groupby(['state','country']).apply(savgol_filter, filter_on).reset_index()
-    df_out= pd.merge(df_input, pd_filt_res[['index', filter_on+'_filtered']], on=['index'], how='left')
+    pd_filt_res= pd.concat([
+            savgol_filter(df_group, filter_on, window, degree)
+            for _, df_group in df_input.groupby(
+                region_index(df_input), sort=False
+            )
+        ])
 
-    return df_out
+    return pd_filt_res.reindex(df_input.index)
 
 
 def calc_doubling_rate(df_input, double_on='confirmed'):
@@ -156,37 +325,946 @@ def calc_doubling_rate(df_input, double_on='confirmed'):
     must_contain= set(['state', 'country', double_on])
     assert must_contain.issubset(set(df_input.columns))
 
-    pd_doub_res= df_input.groupby(['state','country']).apply(rolling_regression, double_on).reset_index()
-    pd_doub_res= pd_doub_res.rename(columns={'level_2': 'index', double_on: double_on+"_DR"})
+    pd_doub_res= df_input.groupby(region_index(df_input)).apply(
+            rolling_regression, double_on
+        )
+    pd_doub_res= pd_doub_res.reset_index().rename(
+            columns={'level_1': 'index', double_on: double_on+"_DR"}
+        )
 
     df_out= pd.merge(df_input, pd_doub_res[['index', double_on+'_DR']], on=['index'], how='left')
 
     return df_out
 
 
+def rolling_ols(panel, window=3):
+    """ Rolling least-squares line fit over the rows of a 2-D array.
+
+    Every column is treated as an independent series and all columns are 
+    processed at once. Window sums are taken from prefix sums, so the cost 
+    does not depend on the window length. As in 
+    get_doubling_rate_via_regression, each window is fit against a centred 
+    abscissa, e.g. [-1, 0, 1] for window=3, so the intercept is the fitted 
+    value at the centre of the window.
+
+    Parameters:
+    ----------
+    panel: numpy Array
+        2-D array of shape (n_steps, n_series)
+    window: int
+        number of datapoints in each regression window
+
+    Returns:
+    -------
+    intercept: numpy Array
+    slope: numpy Array
+        arrays with the shape of panel. Rows without a complete window and 
+        windows which contain NaN are set to NaN
+    """
+
+    # Assertion
+    assert window >= 2
+
+    y= np.asarray(panel, dtype=np.float64)
+    n_steps= y.shape[0]
+
+    intercept= np.full(y.shape, np.nan)
+    slope= np.full(y.shape, np.nan)
+    if(n_steps < window):
+        return intercept, slope
+
+    # Missing values are zeroed for the sums and counted separately
+    nan_mask= np.isnan(y)
+    y= np.where(nan_mask, 0.0, y)
+    t= np.arange(n_steps, dtype=np.float64).reshape((-1,) + (1,)*(y.ndim-1))
+
+    # Prefix sums with a leading row of zeros
+    def prefix_sum(in_array):
+        out= np.zeros((n_steps+1,) + in_array.shape[1:])
+        np.cumsum(in_array, axis=0, out=out[1:])
+        return out
+
+    s_y= prefix_sum(y)
+    s_ty= prefix_sum(t*y)
+    s_nan= prefix_sum(nan_mask)
+
+    # Window sums
+    sum_y= s_y[window:] - s_y[:-window]
+    sum_ty= s_ty[window:] - s_ty[:-window]
+    n_nan= s_nan[window:] - s_nan[:-window]
+
+    # Centre of each window and sum of squared centred abscissae
+    t_centre= t[window-1:] - (window-1)/2
+    s_xx= window*(window**2 - 1)/12
+
+    intercept[window-1:]= np.where(n_nan > 0, np.nan, sum_y/window)
+    slope[window-1:]= np.where(
+            n_nan > 0, np.nan, (sum_ty - t_centre*sum_y)/s_xx
+        )
+
+    return intercept, slope
+
+
+def doubling_rate_panel(panel, window=3, method='linear'):
+    """ Approximate the doubling time for every entry of a 2-D array.
+
+    Parameters:
+    ----------
+    panel: numpy Array
+        2-D array of shape (n_steps, n_series)
+    window: int
+        number of datapoints in each regression window
+    method: string
+        'linear' divides the intercept by the slope of a line fit on the 
+        counts (same as get_doubling_rate_via_regression). 'log' fits a line 
+        on the log-counts and returns log(2)/growth_rate
+
+    Returns:
+    -------
+    doubling_time: numpy Array
+        array with the shape of panel
+    """
+
+    panel= np.asarray(panel, dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if(method == 'linear'):
+            intercept, slope= rolling_ols(panel, window)
+            doubling_time= intercept/slope
+
+        elif(method == 'log'):
+            # Counts which are not positive have no logarithm
+            log_panel= np.log(np.where(panel > 0, panel, np.nan))
+            _, growth_rate= rolling_ols(log_panel, window)
+            doubling_time= np.log(2)/growth_rate
+
+        else:
+            raise ValueError(
+                    "Unknown doubling rate method: {0}".format(method)
+                )
+
+    return doubling_time
+
+
+def calc_doubling_rate_vectorized(df_input, double_on='confirmed', window=3,
+        method='linear'):
+    """ Calculate doubling rate for all regions at once and return extended
+    dataframe
+
+    Produces the same column as calc_doubling_rate, but instead of fitting a 
+    regression per window and per region, rows are scattered into a 
+    (position in region x region) array and processed with doubling_rate_panel.
+
+    Parameters:
+    ----------
+    df_input: pandas DataFrame
+        input data
+    double_on: string
+        key to column which holds data entries
+    window: int
+        number of datapoints in each regression window
+    method: string
+        'linear' or 'log', see doubling_rate_panel
+
+    Returns:
+    -------
+    df_out: pandas DataFrame
+        df_input with additional column with name double_on+"_DR"
+    """
+
+    # Assertion
+    must_contain= set(['state', 'country', double_on])
+    assert must_contain.issubset(set(df_input.columns))
+
+    # Region of each row and position of the row within its region
+    region_idx= region_index(df_input)
+    position_idx= pd.Series(region_idx).groupby(
+            region_idx, sort=False
+        ).cumcount().to_numpy()
+
+    # Scatter rows into a 2-D array, shorter regions are padded with NaN
+    panel= np.full((position_idx.max()+1, region_idx.max()+1), np.nan)
+    panel[position_idx, region_idx]= \
+        df_input[double_on].to_numpy(dtype=np.float64)
+
+    doubling_time= doubling_rate_panel(panel, window=window, method=method)
+
+    # Gather results back into row order
+    df_out= df_input.copy()
+    df_out[double_on+"_DR"]= doubling_time[position_idx, region_idx]
+
+    return df_out
+
+
+def region_index(df_input, keys=['state', 'country']):
+    """ Number the (state, country) region of every row in order of first
+    appearance
+
+    Unlike groupby().ngroup(), a null state (a country reported as a whole)
+    is a region of its own and only combinations of categorical keys which 
+    occur are numbered.
+
+    Parameters:
+    ----------
+    df_input: pandas DataFrame
+        relational data
+    keys: list of strings
+        columns identifying a region
+
+    Returns:
+    -------
+    region_idx: numpy Array
+        region of every row, from 0 to the number of regions - 1
+    """
+
+    combined= np.zeros(len(df_input), dtype=np.int64)
+    for key in keys:
+        key_idx, key_values= pd.factorize(df_input[key], sort=False)
+        # Nulls are numbered -1 by factorize
+        combined= combined*(len(key_values)+1) + key_idx + 1
+
+    region_idx, _= pd.factorize(combined, sort=False)
+
+    return region_idx
+
+
+def to_panel(df_input, col='confirmed'):
+    """ Pivot a column of the relational dataset into a dense
+    (dates x regions) array.
+
+    Parameters:
+    ----------
+    df_input: pandas DataFrame
+        relational data with one row per (date, state, country)
+    col: string
+        key to column which holds data entries
+
+    Returns:
+    -------
+    panel: numpy Array
+        2-D array of shape (n_dates, n_regions), NaN where a region has no 
+        entry for a date
+    panel_idx: tuple of numpy Arrays
+        (date, region) position of every row of df_input in panel, used by 
+        from_panel to unpivot
+    """
+
+    # Assertion
+    must_contain= set(['date', 'state', 'country', col])
+    assert must_contain.issubset(set(df_input.columns))
+
+    date_idx, dates= pd.factorize(df_input['date'], sort=True)
+    region_idx= region_index(df_input)
+    n_regions= region_idx.max()+1
+
+    # Every (date, region) pair must be unique
+    assert np.unique(date_idx*n_regions + region_idx).size == len(df_input)
+
+    panel= np.full((len(dates), n_regions), np.nan)
+    panel[date_idx, region_idx]= df_input[col].to_numpy(dtype=np.float64)
+
+    return panel, (date_idx, region_idx)
+
+
+def from_panel(panel, panel_idx):
+    """ Unpivot a (dates x regions) array back into the row order of the
+    relational dataset.
+
+    Parameters:
+    ----------
+    panel: numpy Array
+        2-D array of shape (n_dates, n_regions)
+    panel_idx: tuple of numpy Arrays
+        row positions as returned by to_panel
+
+    Returns:
+    -------
+    result: numpy Array
+        1-D array with one entry per row
+    """
+
+    date_idx, region_idx= panel_idx
+
+    return panel[date_idx, region_idx]
+
+
+def savgol_panel(panel, window=5, degree=1):
+    """ Filter every column of a 2-D array using savgol filter.
+
+    Same filter as savgol_filter, applied along the dates of all regions at 
+    once, see smoothing.smooth_panel.
+
+    Parameters:
+    ----------
+    panel: numpy Array
+        2-D array of shape (n_dates, n_regions)
+    window: int
+        length of the filter window
+    degree: int
+        order of the polynomial used to fit the samples
+
+    Returns:
+    -------
+    result: numpy Array
+        array with the shape of panel, NaN where panel is NaN
+    """
+
+    smoother= Smoother('savgol', {'window': window, 'degree': degree})
+
+    return smooth_panel(panel, {'filtered': smoother})['filtered']
+
+
+def build_features_panel(df_input, dr_window=3, dr_method='linear',
+        smoothers={}):
+    """ Compute all features on a dense (dates x regions) panel
+
+    'confirmed' is pivoted once, filtering, additional smoothers and both 
+    doubling rates are computed as whole-array operations and the results 
+    are unpivoted into the row order of df_input. Assumes every region has 
+    an entry for every date, as in the Johns Hopkins time series.
+
+    Parameters:
+    ----------
+    df_input: pandas DataFrame
+        relational data with one row per (date, state, country)
+    dr_window: int
+        number of datapoints in each doubling rate regression window
+    dr_method: string
+        'linear' or 'log', see doubling_rate_panel
+    smoothers: dict
+        name -> smoothing.Smoother, each adds a column confirmed_<name>; 
+        'filtered' replaces the filter of confirmed_filtered
+
+    Returns:
+    -------
+    df_out: pandas DataFrame
+        df_input with additional columns confirmed_filtered, confirmed_DR, 
+        confirmed_filtered_DR and one per smoother
+    """
+
+    confirmed, panel_idx= to_panel(df_input, 'confirmed')
+
+    smoothed= smooth_panel(confirmed, {'filtered': FILTER, **smoothers})
+    confirmed_filtered= smoothed.pop('filtered')
+    confirmed_DR= doubling_rate_panel(
+            confirmed, window=dr_window, method=dr_method
+        )
+    confirmed_filtered_DR= doubling_rate_panel(
+            confirmed_filtered, window=dr_window, method=dr_method
+        )
+
+    # Cleanup confirmed_filtered_DR
+    confirmed_filtered_DR= np.where(
+            confirmed>100, confirmed_filtered_DR, np.nan
+        )
+
+    df_out= df_input.copy()
+    df_out['confirmed_filtered']= from_panel(confirmed_filtered, panel_idx)
+    df_out['confirmed_DR']= from_panel(confirmed_DR, panel_idx)
+    df_out['confirmed_filtered_DR']= from_panel(
+            confirmed_filtered_DR, panel_idx
+        )
+    for name, result in smoothed.items():
+        df_out['confirmed_'+name]= from_panel(result, panel_idx)
+
+    return df_out
+
+
+def build_features_groupby(df_input, dr_engine='vectorized', dr_window=3,
+        dr_method='linear', smoothers={}):
+    """ Compute all features per (state, country) group on the relational table
+
+    Parameters:
+    ----------
+    df_input: pandas DataFrame
+        relational data with one row per (date, state, country) and an 
+        'index' column
+    dr_engine: string
+        'vectorized' uses calc_doubling_rate_vectorized, 'regression' uses 
+        calc_doubling_rate
+    dr_window: int
+        number of datapoints in each doubling rate regression window 
+        (vectorized engine only)
+    dr_method: string
+        'linear' or 'log', see doubling_rate_panel (vectorized engine only)
+    smoothers: dict
+        see build_features_panel
+
+    Returns:
+    -------
+    df_out: pandas DataFrame
+        df_input with additional columns confirmed_filtered, confirmed_DR, 
+        confirmed_filtered_DR and one per smoother
+    """
+
+    smoothers= {'filtered': FILTER, **smoothers}
+    filtered= smoothers.pop('filtered')
+    if(filtered.kind == 'savgol'):
+        # Per group, independently of the smoothing engine of panel mode
+        df_out= calc_filtered_data(
+                df_input, filter_on='confirmed', **filtered.params
+            )
+    else:
+        df_out= calc_smoothed_data(
+                df_input, smooth_on='confirmed',
+                smoothers={'filtered': filtered}
+            )
+    if(dr_engine == 'vectorized'):
+        for double_on in ['confirmed', 'confirmed_filtered']:
+            df_out= calc_doubling_rate_vectorized(
+                    df_out, double_on=double_on, window=dr_window,
+                    method=dr_method
+                )
+    else:
+        df_out= calc_doubling_rate(df_out, double_on='confirmed')
+        df_out= calc_doubling_rate(df_out, double_on='confirmed_filtered')
+
+    # Cleanup confirmed_filtered_DR
+    DR_mask= df_out['confirmed']>100
+    df_out['confirmed_filtered_DR']= df_out['confirmed_filtered_DR'].where(
+            DR_mask, other=np.nan
+        )
+
+    if(smoothers):
+        df_out= calc_smoothed_data(
+                df_out, smooth_on='confirmed', smoothers=smoothers
+            )
+
+    return df_out
+
+
+def check_panel_matches_groupby(df_input, dr_window=3, dr_method='linear',
+        smoothers={}, dr_engines=['vectorized', 'regression']):
+    """ Assert that panel mode and groupby mode produce identical output
+
+    Values are compared up to floating point rounding, since the edges of 
+    the savgol filter are fit on all regions at once in panel mode. In 
+    groupby mode the savgol filter runs per group (calc_filtered_data), not 
+    through the smoothing engine of panel mode. As build_features_panel, 
+    the check assumes every region has an entry for every date. The 
+    'regression' engine is the original per-group regression, which only 
+    implements dr_window=3 with dr_method='linear'; for other settings only
+    the 'vectorized' engine is compared. Prefix sums and the regression 
+    round differently, which matters where the slope is close to 0 (the 
+    doubling time goes to +-inf), so against the regression engine the 
+    doubling rate columns are compared as growth rates (1/doubling time).
+
+    Parameters:
+    ----------
+    df_input: pandas DataFrame
+        relational data with one row per (date, state, country) and an 
+        'index' column
+    dr_window: int
+        number of datapoints in each doubling rate regression window
+    dr_method: string
+        'linear' or 'log', see doubling_rate_panel
+    smoothers: dict
+        see build_features_panel
+    dr_engines: list of strings
+        engines of build_features_groupby compared with panel mode
+
+    Returns:
+    -------
+    """
+
+    df_panel= build_features_panel(
+            df_input, dr_window=dr_window, dr_method=dr_method,
+            smoothers=smoothers
+        )
+
+    for dr_engine in dr_engines:
+        if(dr_engine == 'regression' and
+                (dr_window != 3 or dr_method != 'linear')):
+            continue
+
+        df_groupby= build_features_groupby(
+                df_input, dr_engine=dr_engine, dr_window=dr_window,
+                dr_method=dr_method, smoothers=smoothers
+            )
+        if(dr_engine == 'regression'):
+            DR_cols= [col for col in df_panel.columns if col.endswith('_DR')]
+            for col in DR_cols:
+                with np.errstate(divide='ignore'):
+                    np.testing.assert_allclose(
+                            1/df_panel[col].values, 1/df_groupby[col].values, 
+                            rtol=1e-6, atol=1e-9, err_msg=col
+                        )
+            df_panel_cmp= df_panel.drop(columns=DR_cols)
+            df_groupby= df_groupby.drop(columns=DR_cols)
+        else:
+            df_panel_cmp= df_panel
+
+        pd.testing.assert_frame_equal(
+                df_panel_cmp, df_groupby, check_exact=False, rtol=1e-9
+            )
+
+
+def find_first_changed_date(df_input, df_prev, col='confirmed'):
+    """ Find the earliest date for which the relational data differs from a
+    previous run
+
+    Parameters:
+    ----------
+    df_input: pandas DataFrame
+        current relational data
+    df_prev: pandas DataFrame
+        previous relational data or feature set
+    col: string
+        key to column which holds data entries
+
+    Returns:
+    -------
+    first_changed: pandas Timestamp
+        earliest date with a new, revised or removed entry, None if the data 
+        did not change
+    """
+
+    keys= ['date', 'state', 'country']
+    df_cmp= pd.merge(
+            df_input[keys + [col]], df_prev[keys + [col]], 
+            on=keys, how='outer', suffixes=('', '_prev'), indicator=True
+        )
+
+    # Rows only in one of the datasets or with different values
+    same_value= (df_cmp[col] == df_cmp[col+'_prev']) | \
+        (df_cmp[col].isna() & df_cmp[col+'_prev'].isna())
+    changed= (df_cmp['_merge'] != 'both') | ~same_value
+
+    if(not changed.any()):
+        return None
+
+    return df_cmp.loc[changed, 'date'].min()
+
+
+def feature_settings(dr_window=3, dr_method='linear', smoothers={}):
+    """ Settings a feature set is built with, as stored next to it
+
+    Parameters:
+    ----------
+    dr_window, dr_method, smoothers:
+        see build_features_panel
+
+    Returns:
+    -------
+    settings: dict
+        JSON-serializable, see storage.write_processed
+    """
+
+    return {
+        'dr_window': int(dr_window), 'dr_method': dr_method,
+        'smoothers': {
+            name: {'kind': smoother.kind, 'params': dict(smoother.params)}
+            for name, smoother in smoothers.items()
+        }
+    }
+
+
+def build_features_incremental(df_input, df_prev, dr_window=3,
+        dr_method='linear', max_days=14, smoothers={}, prev_settings=None):
+    """ Update a previous feature set, recomputing only rows affected by
+    changed data
+
+    Features only depend on a window of the data: the smoothers on their 
+    reach (2 dates on each side for the default filter) and the doubling 
+    rate on dr_window-1 preceding dates. Rows from reach dates before the 
+    first changed date onwards are recomputed in panel mode on a slice of 
+    df_input which is long enough for their windows, earlier rows are taken 
+    from df_prev. Smoothers depending on all earlier dates (ewma) always 
+    require a full rebuild, as do other settings than those df_prev was
+    built with.
+
+    Parameters:
+    ----------
+    df_input: pandas DataFrame
+        current relational data with one row per (date, state, country)
+    df_prev: pandas DataFrame
+        feature set of a previous run, as returned by build_features_panel
+    dr_window: int
+        number of datapoints in each doubling rate regression window
+    dr_method: string
+        'linear' or 'log', see doubling_rate_panel
+    max_days: int
+        maximum number of days before the last date of df_prev at which data 
+        may have changed
+    smoothers: dict
+        see build_features_panel
+    prev_settings: dict
+        settings df_prev was built with, see feature_settings; None if they 
+        are not known
+
+    Returns:
+    -------
+    df_out: pandas DataFrame
+        df_input with additional columns confirmed_filtered, confirmed_DR 
+        and confirmed_filtered_DR and a fresh 'index' column, None if a full 
+        rebuild is required
+    """
+
+    # df_prev holds features of other or unknown settings
+    if(prev_settings != feature_settings(dr_window, dr_method, smoothers)):
+        return None
+
+    first_changed= find_first_changed_date(df_input, df_prev)
+    if(first_changed is None):
+        return df_prev
+
+    # Data changed further back than allowed
+    if(first_changed < df_prev['date'].max() - pd.Timedelta(days=max_days)):
+        return None
+
+    # Smoothers with unbounded reach
+    reaches= [smoother_reach(each) for each in [FILTER, *smoothers.values()]]
+    if(None in reaches):
+        return None
+
+    # Dates on which recomputation starts and from which the slice is taken
+    reach= max(reaches)
+    dates= np.sort(df_input['date'].unique())
+    changed_pos= dates.searchsorted(np.datetime64(first_changed))
+    keep_from_pos= changed_pos - reach
+    slice_from_pos= keep_from_pos - reach - (dr_window-1)
+    if(slice_from_pos < 0):
+        return None
+
+    df_slice= df_input[df_input['date'] >= dates[slice_from_pos]]
+    df_new= build_features_panel(
+            df_slice, dr_window=dr_window, dr_method=dr_method,
+            smoothers=smoothers
+        )
+    df_new= df_new[df_new['date'] >= dates[keep_from_pos]]
+
+    # Columns of df_prev were built with other smoothers
+    if(set(df_new.columns) != set(df_prev.columns)):
+        return None
+
+    df_out= pd.concat(
+            [
+                df_prev[df_prev['date'] < dates[keep_from_pos]],
+                df_new[df_prev.columns]
+            ],
+            ignore_index=True
+        )
+    df_out['index']= np.arange(len(df_out))
+
+    return df_out
+
+
+def prepare_relational(df_input):
+    """ Sort relational data by date and add the running 'index' column
+
+    Parameters:
+    ----------
+    df_input: pandas DataFrame
+        relational data as written by process_JH_data.py
+
+    Returns:
+    -------
+    df_out: pandas DataFrame
+    """
+    df_out= df_input.sort_values('date', ascending=True).reset_index(drop=True)
+
+    return df_out.reset_index()
+
+
+def read_continents(path=None):
+    """ Read the continent of each country
+
+    Parameters:
+    ----------
+    path: URI-like
+        semicolon-separated file with columns country and continent, 
+        CONTINENTS_PATH if None
+
+    Returns:
+    -------
+    continents: dict
+        country -> continent
+    """
+
+    df_continents= pd.read_csv(path or CONTINENTS_PATH, sep=';')
+
+    return dict(zip(df_continents['country'], df_continents['continent']))
+
+
+def aggregate_counts(df_input, continents):
+    """ Sum the counts of all states per country, per continent and worldwide
+
+    Parameters:
+    ----------
+    df_input: pandas DataFrame
+        relational data with one row per (date, state, country)
+    continents: dict
+        country -> continent, countries without one are summed up under 
+        'Other' (e.g. cruise ships)
+
+    Returns:
+    -------
+    df_agg: pandas DataFrame
+        one row per (date, level, region), level is one of ROLLUP_LEVELS
+    """
+
+    counts= [col for col in COUNT_COLUMNS if col in df_input.columns]
+
+    df_country= df_input.groupby(
+            ['date', 'country'], sort=False, observed=True
+        )[counts].sum().reset_index()
+    df_country= df_country.rename(columns={'country': 'region'})
+    df_country['region']= df_country['region'].astype(object)
+    df_country.insert(1, 'level', 'country')
+
+    df_continent= df_country.assign(
+            region= df_country['region'].map(continents).fillna('Other')
+        ).groupby(['date', 'region'], sort=False)[counts].sum().reset_index()
+    df_continent.insert(1, 'level', 'continent')
+
+    df_world= df_country.groupby('date', sort=False)[counts].sum() \
+        .reset_index()
+    df_world.insert(1, 'level', 'world')
+    df_world.insert(2, 'region', 'World')
+
+    df_agg= pd.concat([df_country, df_continent, df_world], ignore_index=True)
+
+    # Regions are looked up by name alone
+    assert not df_agg[['date', 'region']].duplicated().any()
+
+    return df_agg
+
+
+def build_rollups(df_input, continents=None, dr_window=3, dr_method='linear',
+        smoothers={}):
+    """ Compute country, continent and world series with their own features
+
+    Counts are summed first and the features are computed on the sums, so 
+    the doubling rate of a country is the doubling rate of its total 
+    cases, not an average over its states.
+
+    Parameters:
+    ----------
+    df_input: pandas DataFrame
+        relational data with one row per (date, state, country)
+    continents: dict
+        country -> continent, read_continents() if None
+    dr_window: int
+        number of datapoints in each doubling rate regression window
+    dr_method: string
+        'linear' or 'log', see doubling_rate_panel
+    smoothers: dict
+        see build_features_panel
+
+    Returns:
+    -------
+    df_rollups: pandas DataFrame
+        one row per (date, level, region), sorted by level, region and date, 
+        with the summed counts and the columns of build_features_panel
+    """
+
+    if(continents is None):
+        continents= read_continents()
+
+    df_agg= aggregate_counts(df_input, continents)
+
+    # A (level, region) pair is a region of the panel
+    df_rollups= build_features_panel(
+            df_agg.rename(columns={'level': 'state', 'region': 'country'}),
+            dr_window=dr_window, dr_method=dr_method, smoothers=smoothers
+        ).rename(columns={'state': 'level', 'country': 'region'})
+
+    df_rollups['level']= pd.Categorical(
+            df_rollups['level'], categories=ROLLUP_LEVELS
+        )
+    df_rollups= df_rollups.sort_values(
+            ['level', 'region', 'date'], kind='stable'
+        )
+    df_rollups['level']= df_rollups['level'].astype(str)
+
+    return df_rollups.reset_index(drop=True)
+
+
+def threshold_offsets(df_rollups, thresholds=ALIGN_THRESHOLDS,
+        col='confirmed'):
+    """ Find the day on which every region first reaches each threshold
+
+    The counts of all regions are laid out one after the other in a single 
+    sorted array: the running maximum makes each region non-decreasing 
+    (revisions may lower cumulative counts) and region i is shifted by i 
+    times a bound above all counts. One searchsorted call then finds every 
+    (region, threshold) crossing.
+
+    Parameters:
+    ----------
+    df_rollups: pandas DataFrame
+        rollups, see build_rollups, sorted by date within each region
+    thresholds: list of ints
+        counts at which the timelines are aligned
+    col: string
+        key to column which holds the cumulative counts
+
+    Returns:
+    -------
+    df_offsets: pandas DataFrame
+        one row per (level, region, threshold) reached, with the position 
+        of the first date at or above the threshold in the timeline of the 
+        region ('offset') and that 'date'; regions which never reach a 
+        threshold have no row for it
+    """
+
+    df_rollups= df_rollups.reset_index(drop=True)
+    region_idx, regions= pd.factorize(df_rollups['region'], sort=False)
+    starts= np.flatnonzero(np.r_[True, region_idx[1:] != region_idx[:-1]])
+    # Regions must be contiguous, as written by build_rollups
+    assert len(starts) == len(regions)
+    lengths= np.diff(np.r_[starts, len(df_rollups)])
+
+    # Running maximum within each region, in [0, bound)
+    counts= np.maximum(
+            np.nan_to_num(df_rollups[col].to_numpy(dtype=np.float64)), 0
+        )
+    running= pd.Series(counts).groupby(region_idx, sort=False).cummax() \
+        .to_numpy()
+
+    bound= max(running.max(initial=0), max(thresholds)) + 1
+    shift= np.repeat(np.arange(len(regions)), lengths)*bound
+
+    thresholds= np.asarray(sorted(thresholds), dtype=np.float64)
+    targets= (np.arange(len(regions)).reshape(-1,1)*bound + thresholds).ravel()
+    positions= np.searchsorted(running + shift, targets, side='left') \
+        .reshape(len(regions), -1)
+
+    # Crossings beyond the end of a region belong to the next region
+    offsets= positions - starts.reshape(-1,1)
+    reached= offsets < lengths.reshape(-1,1)
+    region_pos, threshold_pos= np.nonzero(reached)
+    rows= positions[region_pos, threshold_pos]
+
+    return pd.DataFrame({
+        'level': df_rollups['level'].to_numpy()[rows],
+        'region': regions[region_pos],
+        'threshold': thresholds[threshold_pos].astype(np.int64),
+        'offset': offsets[region_pos, threshold_pos],
+        'date': df_rollups['date'].to_numpy()[rows],
+    })
+
+
+def main(argv=None):
+    """ Entry point of the covid-build-features command """
+    # Collect command-line arguments
+    cl_options= cl_parser.parse_args(argv)
+    try:
+        smoothers= parse_smoothers(cl_options.smoother)
+    except ValueError as err:
+        cl_parser.error(str(err))
 
-if __name__ == "__main__":
     # Test data
     test_data= np.array([2,4,6])
     # Expected result= 2
     result= get_doubling_rate_via_regression(test_data)
     assert(int(result[0]) == 2)
+    # Vectorized engine must agree with the regression
+    result= doubling_rate_panel(test_data.reshape(-1,1))
+    assert(np.isclose(result[-1,0], 2))
+
+    stage_metrics= StageMetrics('build_features')
+    stage_metrics.start('features')
 
-    pd_JH_rel= pd.read_csv(
-            cl_options.data_path + 'processed/COVID_relational_full.csv', 
-            sep=';', parse_dates=[0]
+    pd_JH_rel= read_processed(
+            cl_options.data_path, 'COVID_relational_full',
+            fmt=cl_options.input_format
         )
-    pd_JH_rel= pd_JH_rel.sort_values('date', ascending=True).reset_index(drop=True)
-    pd_JH_rel= pd_JH_rel.reset_index()
+    pd_JH_rel= prepare_relational(pd_JH_rel)
 
-    pd_res= calc_filtered_data(pd_JH_rel, filter_on='confirmed')
-    pd_res= calc_doubling_rate(pd_res, double_on='confirmed')
-    pd_res= calc_doubling_rate(pd_res, double_on='confirmed_filtered')
+    if(cl_options.check_panel):
+        check_panel_matches_groupby(
+            pd_JH_rel, dr_window=cl_options.dr_window,
+            dr_method=cl_options.dr_method, smoothers=smoothers
+        )
+        print("Panel mode output matches groupby mode output.")
 
-    # Cleanup confirmed_filtered_DR
-    DR_mask= pd_res['confirmed']>100
-    pd_res['confirmed_filtered_DR']= pd_res['confirmed_filtered_DR'].where(DR_mask, other=np.NaN)
+    final_set_path= processed_path(
+            cl_options.data_path, 'COVID_final_set',
+            fmt=cl_options.input_format
+        )
+    settings= feature_settings(
+            cl_options.dr_window, cl_options.dr_method, smoothers
+        )
+    pd_res= None
+    if(cl_options.incremental and os.path.exists(final_set_path)):
+        pd_prev= read_processed(
+                cl_options.data_path, 'COVID_final_set',
+                fmt=cl_options.input_format
+            )
+        pd_res= build_features_incremental(
+                pd_JH_rel, pd_prev, dr_window=cl_options.dr_window, 
+                dr_method=cl_options.dr_method,
+                max_days=cl_options.incremental_days, smoothers=smoothers,
+                prev_settings=read_settings(
+                    cl_options.data_path, 'COVID_final_set'
+                )
+            )
+        if(pd_res is None):
+            print("Data changed more than {0} days back or the features were \
+built with other settings, rebuilding all features.".format(
+                cl_options.incremental_days
+            ))
+
+    if(pd_res is None and cl_options.mode == 'panel'):
+        pd_res= build_features_panel(
+                pd_JH_rel, dr_window=cl_options.dr_window,
+                dr_method=cl_options.dr_method, smoothers=smoothers
+            )
+    elif(pd_res is None):
+        pd_res= build_features_groupby(
+                pd_JH_rel, dr_engine=cl_options.dr_engine, 
+                dr_window=cl_options.dr_window, dr_method=cl_options.dr_method,
+                smoothers=smoothers
+            )
 
     # Save
-    pd_res.to_csv(cl_options.data_path + 'processed/COVID_final_set.csv', sep=';', index=False)
+    write_processed(
+        pd_res, cl_options.data_path, 'COVID_final_set',
+        formats=cl_options.output_format,
+        partition_by='country' if cl_options.partition_by_country else None,
+        settings=settings
+    )
+    # Rollups are small, they are always rebuilt
+    pd_rollups= build_rollups(
+            pd_JH_rel, read_continents(cl_options.continents_path),
+            dr_window=cl_options.dr_window, dr_method=cl_options.dr_method,
+            smoothers=smoothers
+        )
+    write_processed(
+        pd_rollups, cl_options.data_path, 'COVID_rollup_set',
+        formats=cl_options.output_format, settings=settings
+    )
+    pd_offsets= threshold_offsets(
+            pd_rollups, cl_options.align_thresholds or ALIGN_THRESHOLDS
+        )
+    write_processed(
+        pd_offsets, cl_options.data_path, 'COVID_alignment_set',
+        formats=cl_options.output_format
+    )
 
+    if(not cl_options.no_metrics):
+        stage_metrics.finish(
+            'features', rows_in=len(pd_JH_rel),
+            rows_out=len(pd_res) + len(pd_rollups) + len(pd_offsets),
+            bytes_read=files_size([processed_path(
+                cl_options.data_path, 'COVID_relational_full',
+                fmt=cl_options.input_format
+            )]),
+            bytes_written=files_size([
+                processed_path(cl_options.data_path, name, fmt=fmt)
+                for name in [
+                    'COVID_final_set', 'COVID_rollup_set',
+                    'COVID_alignment_set'
+                ]
+                for fmt in cl_options.output_format
+            ])
+        )
+        stage_metrics.write_textfile(
+            cl_options.metrics_path or
+            metrics_path(cl_options.data_path, 'build_features')
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import collections
+import numpy as np
+
+# A smoother: kind is a key of SMOOTHERS, params its parameters
+Smoother= collections.namedtuple('Smoother', ['kind', 'params'])
+
+# Smoothers and their default parameters
+SMOOTHERS= {
+    # Savitzky-Golay filter, polynomial of order degree fit on window dates
+    'savgol': {'window': 5, 'degree': 1},
+    # Exponentially weighted moving average, weights decay with
+    # alpha= 2/(span+1)
+    'ewma': {'span': 7.0},
+    # Moving average over window dates centred on each date
+    'ma': {'window': 7},
+}
+
+# Smoother of the _filtered columns
+FILTER= Smoother('savgol', {'window': 5, 'degree': 1})
+
+
+def parse_smoother(spec):
+    """ Parse a smoother of the form kind:param=value,param=value
+
+    Parameters:
+    ----------
+    spec: string
+        e.g. 'savgol:window=7,degree=2', 'ewma:span=14' or 'ma', missing
+        parameters take their default from SMOOTHERS
+
+    Returns:
+    -------
+    smoother: Smoother
+    """
+
+    kind, _, args= spec.partition(':')
+    if(kind not in SMOOTHERS):
+        raise ValueError("Unknown smoother {0!r}, choose from {1}".format(
+            kind, ", ".join(SMOOTHERS)
+        ))
+
+    params= dict(SMOOTHERS[kind])
+    for arg in filter(None, args.split(',')):
+        key, _, value= arg.partition('=')
+        try:
+            params[key]= type(SMOOTHERS[kind][key])(value)
+        except (KeyError, ValueError):
+            raise ValueError(
+                "Invalid parameter {0!r} of smoother {1!r}".format(arg, kind)
+            )
+
+    smoother= Smoother(kind, params)
+    check_smoother(smoother)
+
+    return smoother
+
+
+def parse_smoothers(specs):
+    """ Parse named smoothers of the form name=kind:param=value,...
+
+    Parameters:
+    ----------
+    specs: list of strings
+        e.g. ['ewma7=ewma:span=7', 'ma:window=3']; without a name, the name
+        is the kind followed by the parameter values, e.g. 'ma_3'
+
+    Returns:
+    -------
+    smoothers: dict
+        name -> Smoother, in the order of specs
+    """
+
+    smoothers= {}
+    for spec in specs:
+        name, sep, smoother_spec= spec.partition('=')
+        if(not sep or ':' in name):
+            smoother= parse_smoother(spec)
+            name= '_'.join(
+                [smoother.kind] + [
+                    '{0:g}'.format(value) for value in smoother.params.values()
+                ]
+            )
+        else:
+            smoother= parse_smoother(smoother_spec)
+        smoothers[name]= smoother
+
+    return smoothers
+
+
+def check_smoother(smoother):
+    """ Raise ValueError if the parameters of a smoother are not usable """
+
+    params= smoother.params
+    if(smoother.kind == 'savgol'):
+        if(params['window'] < 1 or params['window'] % 2 == 0):
+            raise ValueError(
+                "Savitzky-Golay window must be a positive odd number"
+            )
+        if(not 0 <= params['degree'] < params['window']):
+            raise ValueError(
+                "Savitzky-Golay degree must be smaller than the window"
+            )
+    elif(smoother.kind == 'ewma'):
+        if(params['span'] < 1):
+            raise ValueError("EWMA span must be at least 1")
+    elif(params['window'] < 1 or params['window'] % 2 == 0):
+        raise ValueError("Moving average window must be a positive odd number")
+
+
+def smoother_reach(smoother):
+    """ Number of dates before and after a date its smoothed value depends on
+
+    Returns:
+    -------
+    reach: int
+        None if the value depends on all earlier dates (ewma)
+    """
+
+    if(smoother.kind == 'ewma'):
+        return None
+
+    return smoother.params['window']//2
+
+
+def fill_gaps(panel):
+    """ Fill missing entries of every column with the previous entry, or the
+    next one at the start
+
+    Parameters:
+    ----------
+    panel: numpy Array
+        2-D array of shape (n_dates, n_regions)
+
+    Returns:
+    -------
+    filled: numpy Array
+        copy of panel, columns without any entry are 0
+    """
+
+    n_dates, n_regions= panel.shape
+    missing= np.isnan(panel)
+    if(not missing.any()):
+        return panel.copy()
+
+    columns= np.arange(n_regions)
+
+    # Position of the last entry at or before each date
+    last= np.where(missing, 0, np.arange(n_dates).reshape(-1,1))
+    np.maximum.accumulate(last, axis=0, out=last)
+    filled= panel[last, columns]
+
+    # Position of the first entry at or after each date, for leading gaps
+    first= np.where(
+        np.isnan(filled), n_dates-1, np.arange(n_dates).reshape(-1,1)
+    )
+    first= np.minimum.accumulate(first[::-1], axis=0)[::-1]
+    filled= filled[first, columns]
+
+    return np.where(np.isnan(filled), 0, filled)
+
+
+def savgol_smooth(filled, window, degree):
+    """ Savitzky-Golay filter along the dates, polynomial fits at the edges """
+
+    from scipy import signal
+
+    # Shorter series than the window are fit as a whole
+    n_dates= filled.shape[0]
+    if(window > n_dates):
+        window= n_dates if n_dates % 2 else n_dates-1
+        degree= min(degree, window-1)
+
+    return signal.savgol_filter(filled, window, degree, axis=0, mode='interp')
+
+
+def ewma_smooth(filled, span):
+    """ Exponentially weighted moving average along the dates
+
+    Weights are normalized over the available dates, so the first dates are
+    not pulled towards 0 (pandas' ewm(adjust=True)).
+    """
+
+    from scipy import signal
+
+    decay= 1 - 2/(span+1)
+    weighted_sum= signal.lfilter([1], [1, -decay], filled, axis=0)
+    weight= signal.lfilter([1], [1, -decay], np.ones(filled.shape[0]))
+
+    return weighted_sum/weight.reshape(-1,1)
+
+
+def ma_smooth(filled, window):
+    """ Moving average centred on each date, shorter windows at the edges """
+
+    n_dates= filled.shape[0]
+    half= window//2
+
+    cumsum= np.zeros((n_dates+1,) + filled.shape[1:])
+    np.cumsum(filled, axis=0, out=cumsum[1:])
+
+    dates= np.arange(n_dates)
+    lower= np.maximum(dates-half, 0)
+    upper= np.minimum(dates+half+1, n_dates)
+
+    return (cumsum[upper] - cumsum[lower])/(upper - lower).reshape(-1,1)
+
+
+def smooth_panel(panel, smoothers):
+    """ Smooth every column of a (dates x regions) array with several smoothers
+
+    Missing entries are filled once (see fill_gaps) and every smoother runs
+    on all regions at once; smoothed values of missing entries are NaN.
+
+    Parameters:
+    ----------
+    panel: numpy Array
+        2-D array of shape (n_dates, n_regions)
+    smoothers: dict
+        name -> Smoother
+
+    Returns:
+    -------
+    smoothed: dict
+        name -> array with the shape of panel
+    """
+
+    missing= np.isnan(panel)
+    filled= fill_gaps(panel)
+
+    smoothed= {}
+    for name, smoother in smoothers.items():
+        if(filled.shape[0] == 0):
+            result= filled.copy()
+        elif(smoother.kind == 'savgol'):
+            result= savgol_smooth(filled, **smoother.params)
+        elif(smoother.kind == 'ewma'):
+            result= ewma_smooth(filled, **smoother.params)
+        else:
+            result= ma_smooth(filled, **smoother.params)
+
+        smoothed[name]= np.where(missing, np.nan, result)
+
+    return smoothed
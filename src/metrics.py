@@ -0,0 +1,203 @@
+# Imports
+import os, sys, time, resource
+
+# Prefix of all metric names in the textfiles
+PREFIX= "covid_pipeline"
+
+# Recorded per stage, in addition to its wall time and peak memory
+COUNTERS= ["rows_in", "rows_out", "bytes_read", "bytes_written"]
+
+
+#==============================================================================
+def metrics_path(data_path, job):
+    """ Path of the Prometheus textfile written by a job, e.g. "pipeline" """
+    return data_path + "metrics/" + job + ".prom"
+
+
+#==============================================================================
+def files_size(paths):
+    """ Total size in bytes of the existing files and folders among paths """
+    size= 0
+    for path in paths:
+        if(os.path.isdir(path)):
+            size+= sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, _, names in os.walk(path) for name in names
+            )
+        elif(os.path.exists(path)):
+            size+= os.path.getsize(path)
+
+    return size
+
+
+#==============================================================================
+def count_rows(path, header=True):
+    """ Number of lines of a text file, without the header line """
+    lines= 0
+    with open(path, "rb") as text_file:
+        for block in iter(lambda: text_file.read(1024**2), b""):
+            lines+= block.count(b"\n")
+
+    return lines - 1 if header else lines
+
+
+#==============================================================================
+def reset_peak_rss():
+    """ Reset the peak RSS of this process, only possible on Linux
+
+    Returns:
+    -------
+    reset: bool
+        False if peak_rss keeps reporting the peak since the process started
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+#==============================================================================
+def peak_rss():
+    """ Peak RSS of this process in bytes, since start or reset_peak_rss """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if(line.startswith("VmHWM:")):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+
+    peak= resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    return peak if sys.platform == "darwin" else peak*1024
+
+
+#==============================================================================
+def children_peak_rss():
+    """ Largest peak RSS of all finished child processes in bytes """
+    peak= resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    return peak if sys.platform == "darwin" else peak*1024
+
+
+#==============================================================================
+class StageMetrics:
+    """ Wall time, peak memory, rows and bytes of the stages of a job
+
+    start() and finish() only read clocks and /proc, so they are cheap enough
+    to run on every invocation. The peak memory of a stage is the peak RSS of
+    this process during the stage and, if larger, of the worker processes it
+    finished (e.g. the time series readers of process_JH_data.py).
+
+    Parameters:
+    ----------
+    job: string
+        name of the job, e.g. "pipeline" or "process_JH_data"
+    """
+
+    def __init__(self, job):
+        self.job= job
+        self.stages= {}
+        self._running= {}
+
+    def start(self, stage):
+        """ Start measuring a stage """
+        reset_peak_rss()
+        self._running[stage]= (time.time(), children_peak_rss())
+
+    def finish(self, stage, status="ran", **counters):
+        """ Finish measuring a stage
+
+        Parameters:
+        ----------
+        stage: string
+            name passed to start
+        status: string
+            "ran", "skipped" or "failed"
+        counters:
+            values of COUNTERS, None or left out if unknown
+
+        Returns:
+        -------
+        record: dict
+            "status", "seconds", "peak_rss_bytes" and the counters
+        """
+        start, children_before= self._running.pop(stage)
+        children_after= children_peak_rss()
+
+        record= {
+            "status": status,
+            "seconds": time.time() - start,
+            "finished": time.time(),
+            "peak_rss_bytes": max(
+                peak_rss(),
+                children_after if children_after > children_before else 0
+            )
+        }
+        for name in COUNTERS:
+            record[name]= counters.get(name)
+
+        self.stages[stage]= record
+
+        return record
+
+    def write_textfile(self, path):
+        """ Write all finished stages as a Prometheus textfile
+
+        The file is replaced atomically, so it can be picked up by the
+        textfile collector of the node exporter at any time.
+
+        Returns:
+        -------
+        written: bool
+            False if prometheus_client is not installed
+        """
+        try:
+            from prometheus_client import CollectorRegistry, Gauge, \
+                write_to_textfile
+        except ImportError:
+            print(
+                "prometheus_client is not installed, metrics are not written."
+            )
+            return False
+
+        registry= CollectorRegistry()
+        labels= ["job", "stage"]
+        gauges= {
+            "seconds": Gauge(PREFIX + "_stage_duration_seconds",
+                "Wall time of the stage", labels, registry=registry),
+            "peak_rss_bytes": Gauge(PREFIX + "_stage_peak_rss_bytes",
+                "Peak resident memory during the stage", labels,
+                registry=registry),
+            "rows_in": Gauge(PREFIX + "_stage_rows_in",
+                "Rows read by the stage", labels, registry=registry),
+            "rows_out": Gauge(PREFIX + "_stage_rows_out",
+                "Rows written by the stage", labels, registry=registry),
+            "bytes_read": Gauge(PREFIX + "_stage_bytes_read",
+                "Bytes read or received by the stage", labels,
+                registry=registry),
+            "bytes_written": Gauge(PREFIX + "_stage_bytes_written",
+                "Bytes written by the stage", labels, registry=registry),
+            "finished": Gauge(PREFIX + "_stage_finished_timestamp_seconds",
+                "Time at which the stage finished", labels, registry=registry),
+        }
+        status= Gauge(PREFIX + "_stage_status",
+            "1 for the status of the last run of the stage",
+            labels + ["status"], registry=registry)
+
+        for stage, record in self.stages.items():
+            for name, gauge in gauges.items():
+                if(record[name] is not None):
+                    gauge.labels(self.job, stage).set(record[name])
+            for each in ["ran", "skipped", "failed"]:
+                status.labels(self.job, stage, each).set(
+                    int(record["status"] == each)
+                )
+
+        if(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_to_textfile(path, registry)
+
+        return True
@@ -0,0 +1,20 @@
+""" Spread models fitted on the processed datasets
+
+Functions are imported from their modules on first access, so importing
+src.models does not import numpy, pandas, ... before they are needed.
+"""
+from src._lazy import lazy_exports
+
+# Public name -> module defining it
+_EXPORTS= {
+    "integrate_sir": "src.models.train_model",
+    "fit_sir": "src.models.train_model",
+    "fit_all_countries": "src.models.train_model",
+    "read_parameters": "src.models.train_model",
+    "FORECASTERS": "src.models.predict_model",
+    "Forecaster": "src.models.predict_model",
+    "forecast_regions": "src.models.predict_model",
+    "backtest_regions": "src.models.backtest",
+}
+
+__getattr__, __all__= lazy_exports(__name__, _EXPORTS)
@@ -0,0 +1,325 @@
+# Imports
+import os, time
+
+import numpy as np
+import pandas as pd
+
+import argparse
+
+from src.data.storage import FORMATS, processed_path, read_processed
+from src.metrics import StageMetrics, files_size, metrics_path
+from src.models.predict_model import polynomial_design
+
+# Models which can be backtested, see predict_model.FORECASTERS
+MODELS= ["loglinear", "poly"]
+
+# Columns of the metrics table, cells are identified by the first four
+CELL_COLUMNS= ["region", "model", "degree", "horizon"]
+METRIC_COLUMNS= ["origins", "mape", "rmse"]
+
+#==============================================================================
+# COMMAND LINE ARGUMENTS
+# Create parser object
+cl_parser= argparse.ArgumentParser(
+    description="Rolling-origin backtest of the growth and forecast models of \
+        every region."
+)
+
+# ARGUMENTS
+# Path to data folder
+cl_parser.add_argument(
+    "--data_path", action="store", default="data/",
+    help="Path to data folder"
+)
+# Input format
+cl_parser.add_argument(
+    "--input_format", action="store", default="csv", choices=FORMATS,
+    help="Format in which the rollups are read"
+)
+# Grid
+cl_parser.add_argument(
+    "--models", action="store", nargs="+", default=MODELS, choices=MODELS,
+    help="Models to evaluate"
+)
+cl_parser.add_argument(
+    "--degrees", action="store", type=int, nargs="+", default=[1, 2, 3],
+    help="Degrees of the polynomial model (loglinear always has degree 1)"
+)
+cl_parser.add_argument(
+    "--horizons", action="store", type=int, nargs="+", default=[1, 7, 14],
+    help="Days ahead at which forecasts are evaluated"
+)
+cl_parser.add_argument(
+    "--levels", action="store", nargs="+", default=["country"],
+    choices=["country", "continent", "world"],
+    help="Rollup levels whose regions are evaluated"
+)
+# Origins
+cl_parser.add_argument(
+    "--fit_days", action="store", type=int, default=21,
+    help="Number of days before each origin to which the models are fitted"
+)
+cl_parser.add_argument(
+    "--origins", action="store", type=int, default=30,
+    help="Number of forecast origins, the latest ones whose horizons are \
+        observed"
+)
+cl_parser.add_argument(
+    "--step", action="store", type=int, default=1,
+    help="Days between two origins"
+)
+# Worker processes
+cl_parser.add_argument(
+    "--workers", action="store", type=int, default=None,
+    help="Number of processes evaluating regions concurrently \
+        (default: number of CPUs)"
+)
+# Output
+cl_parser.add_argument(
+    "--output", action="store", default="reports/backtest.csv",
+    help="Semicolon-separated metrics table, one row per region, model, \
+        degree and horizon"
+)
+# Stage metrics
+cl_parser.add_argument(
+    "--metrics_path", action="store", default=None,
+    help="Prometheus textfile to which stage metrics are written \
+        (default: <data_path>metrics/backtest.prom)"
+)
+cl_parser.add_argument(
+    "--no_metrics", action="store_true",
+    help="Do not write stage metrics"
+)
+
+
+#==============================================================================
+def origin_positions(n_dates, fit_days, horizons, n_origins, step=1):
+    """ Positions of the forecast origins, ascending
+
+    An origin is the last fitted date; its fit window and all horizons
+    after it must lie within the data.
+    """
+    last= n_dates - 1 - max(horizons)
+    first= max(fit_days - 1, last - (n_origins - 1)*step)
+
+    return np.arange(first, last + 1)[::-1][::step][::-1]
+
+
+#==============================================================================
+def design_matrices(fit_days, horizons, degrees):
+    """ Pseudo-inverse of the fit design and forecast rows per degree
+
+    Shared by all regions, origins and models of a degree.
+
+    Returns:
+    -------
+    designs: dict
+        degree -> (pinv of shape (degree+1, fit_days), forecast rows of shape
+        (n_horizons, degree+1))
+    """
+    return {
+        degree: (
+            np.linalg.pinv(polynomial_design(fit_days, degree)),
+            np.vander(
+                np.asarray(horizons, dtype=np.float64), degree+1,
+                increasing=True
+            )
+        )
+        for degree in degrees
+    }
+
+
+#==============================================================================
+def evaluate_regions(values, origins, fit_days, horizons, grid, designs):
+    """ Errors of every model and degree on a group of regions, run in a
+    worker process
+
+    The fit windows of all origins are gathered into one array, so each
+    (model, degree) is fitted to every origin and region with one product
+    with the shared pseudo-inverse.
+
+    Parameters:
+    ----------
+    values: numpy Array
+        cumulative cases, shape (n_dates, n_regions)
+    origins: numpy Array
+        positions of the forecast origins
+    fit_days: int
+        number of fitted days up to each origin
+    horizons: list of ints
+        days ahead
+    grid: list of tuples
+        (model, degree)
+    designs: dict
+        see design_matrices
+
+    Returns:
+    -------
+    metrics: list of tuples
+        (model, degree, mape, rmse), errors of shape (n_horizons, n_regions)
+    """
+
+    # (origins, fit_days, regions) windows and (origins, horizons, regions)
+    # actuals
+    window_idx= origins.reshape(-1,1) - np.arange(fit_days)[::-1]
+    windows= values[window_idx]
+    actual= values[origins.reshape(-1,1) + np.asarray(horizons)]
+
+    metrics= []
+    for model, degree in grid:
+        pinv, future= designs[degree]
+        fitted= np.log1p(windows) if model == "loglinear" else windows
+
+        coef= np.einsum("pd,odr->opr", pinv, fitted)
+        forecast= np.einsum("hp,opr->ohr", future, coef)
+        if(model == "loglinear"):
+            forecast= np.expm1(forecast)
+        else:
+            forecast= np.maximum(forecast, 0)
+
+        error= forecast - actual
+        rmse= np.sqrt(np.mean(error**2, axis=0))
+        # Dates without cases are left out of the MAPE, NaN if there is none
+        observed= actual > 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ape= np.where(
+                observed, np.abs(error)/np.where(observed, actual, 1), 0
+            )
+            mape= 100*ape.sum(axis=0)/observed.sum(axis=0)
+
+        metrics.append((model, degree, mape, rmse))
+
+    return metrics
+
+
+#==============================================================================
+def backtest_regions(df_rollups, models=MODELS, degrees=[1, 2, 3],
+        horizons=[1, 7, 14], levels=["country"], fit_days=21, n_origins=30,
+        step=1, workers=None):
+    """ Rolling-origin evaluation of every region x model x degree x horizon
+
+    Regions are split into one group per worker; joblib runs the groups
+    in parallel processes.
+
+    Parameters:
+    ----------
+    df_rollups: pandas DataFrame
+        rollups as written by build_features.py, see
+        build_features.build_rollups
+    models, degrees, horizons, levels, fit_days, workers:
+        see command-line arguments
+    n_origins, step:
+        number of forecast origins and days between them
+
+    Returns:
+    -------
+    df_metrics: pandas DataFrame
+        one row per cell with the number of "origins", "mape" (percent) and
+        "rmse", sorted by CELL_COLUMNS
+    """
+    from joblib import Parallel, delayed
+
+    df_levels= df_rollups[df_rollups["level"].isin(levels)]
+    panel= df_levels.pivot(index="date", columns="region", values="confirmed")
+    panel= panel.sort_index()
+    values= panel.ffill().fillna(0).to_numpy(dtype=np.float64)
+    regions= panel.columns.to_numpy()
+
+    origins= origin_positions(len(panel), fit_days, horizons, n_origins, step)
+    if(len(origins) == 0):
+        raise ValueError(
+            "Not enough dates for {0} fitted days and a horizon of {1} "
+            "days".format(fit_days, max(horizons))
+        )
+
+    grid= [("loglinear", 1)]*("loglinear" in models) + \
+        [("poly", degree) for degree in degrees if "poly" in models]
+    designs= design_matrices(
+        fit_days, horizons, sorted(set(degree for _, degree in grid))
+    )
+
+    workers= workers or os.cpu_count()
+    groups= [
+        group for group in np.array_split(np.arange(len(regions)), workers)
+        if len(group)
+    ]
+    results= Parallel(n_jobs=len(groups))(
+        delayed(evaluate_regions)(
+            values[:, group], origins, fit_days, horizons, grid, designs
+        )
+        for group in groups
+    )
+
+    frames= []
+    for group, metrics in zip(groups, results):
+        for model, degree, mape, rmse in metrics:
+            frames.append(pd.DataFrame({
+                "region": np.tile(regions[group], len(horizons)),
+                "model": model, "degree": degree,
+                "horizon": np.repeat(horizons, len(group)),
+                "origins": len(origins),
+                "mape": mape.ravel(), "rmse": rmse.ravel(),
+            }))
+
+    df_metrics= pd.concat(frames, ignore_index=True)
+
+    return df_metrics.sort_values(CELL_COLUMNS).reset_index(drop=True)
+
+
+#==============================================================================
+def write_metrics(df_metrics, path):
+    """ Write the metrics table with stable row order and rounding, so runs
+    can be diffed """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path= path + ".tmp"
+    df_metrics.to_csv(tmp_path, sep=";", index=False, float_format="%.6g")
+    os.replace(tmp_path, path)
+
+
+#==============================================================================
+def main(argv=None):
+    """ Entry point of the covid-backtest command """
+    # Collect command-line arguments
+    cl_options= cl_parser.parse_args(argv)
+
+    stage_metrics= StageMetrics("backtest")
+    stage_metrics.start("backtest")
+    start= time.time()
+
+    df_rollups= read_processed(
+        cl_options.data_path, "COVID_rollup_set", fmt=cl_options.input_format
+    )
+    df_metrics= backtest_regions(
+        df_rollups, models=cl_options.models, degrees=cl_options.degrees,
+        horizons=cl_options.horizons, levels=cl_options.levels,
+        fit_days=cl_options.fit_days, n_origins=cl_options.origins,
+        step=cl_options.step, workers=cl_options.workers
+    )
+    write_metrics(df_metrics, cl_options.output)
+
+    # Median over regions per model, degree and horizon
+    summary= df_metrics.groupby(["model", "degree", "horizon"])
+    summary= summary[["mape", "rmse"]].median()
+    print(summary.to_string(float_format="{0:.3g}".format))
+    print("Evaluated {0} cells in {1:.2f}s, written to {2}.".format(
+        len(df_metrics), time.time() - start, cl_options.output
+    ))
+
+    if(not cl_options.no_metrics):
+        stage_metrics.finish(
+            "backtest", rows_in=len(df_rollups), rows_out=len(df_metrics),
+            bytes_read=files_size([processed_path(
+                cl_options.data_path, "COVID_rollup_set",
+                fmt=cl_options.input_format
+            )]),
+            bytes_written=files_size([cl_options.output])
+        )
+        stage_metrics.write_textfile(
+            cl_options.metrics_path or
+            metrics_path(cl_options.data_path, "backtest")
+        )
+
+
+#==============================================================================
+if __name__ == "__main__":
+    main()
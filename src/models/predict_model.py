@@ -0,0 +1,472 @@
+# Imports
+import os, json, hashlib, time, collections
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import argparse
+
+from src.data.storage import FORMATS, processed_path, read_processed, \
+    write_processed
+from src.metrics import StageMetrics, files_size, metrics_path
+
+# A forecasting model: "fit" fits the last fit_days values of many regions
+# and returns one JSON-serializable parameter dict per region, "predict"
+# turns the parameters of one region into forecasts with intervals.
+# "dated" models depend on the dates of the series, not only their values.
+Forecaster= collections.namedtuple(
+    "Forecaster", ["name", "fit", "predict", "dated"]
+)
+
+#==============================================================================
+# COMMAND LINE ARGUMENTS
+# Create parser object
+cl_parser= argparse.ArgumentParser(
+    description="Forecast confirmed cases of every country, continent and \
+        the world."
+)
+
+# ARGUMENTS
+# Path to data folder
+cl_parser.add_argument(
+    "--data_path", action="store", default="data/",
+    help="Path to data folder"
+)
+# Input format
+cl_parser.add_argument(
+    "--input_format", action="store", default="csv", choices=FORMATS,
+    help="Format in which the rollups are read"
+)
+# Output formats
+cl_parser.add_argument(
+    "--output_format", action="store", nargs="+", default=["csv"],
+    choices=FORMATS,
+    help="Formats in which the forecasts are written"
+)
+# Model cache
+cl_parser.add_argument(
+    "--models_path", action="store", default="models/",
+    help="Folder holding the cache of fitted models"
+)
+cl_parser.add_argument(
+    "--no_cache", action="store_true",
+    help="Refit all models and do not write the cache"
+)
+# Models
+cl_parser.add_argument(
+    "--models", action="store", nargs="+", default=["loglinear", "poly"],
+    choices=["loglinear", "poly", "prophet"],
+    help="Models to forecast with, prophet is skipped if it is not installed"
+)
+cl_parser.add_argument(
+    "--degree", action="store", type=int, default=2,
+    help="Degree of the polynomial model"
+)
+cl_parser.add_argument(
+    "--fit_days", action="store", type=int, default=21,
+    help="Number of most recent days to which the models are fitted"
+)
+cl_parser.add_argument(
+    "--horizon", action="store", type=int, default=14,
+    help="Number of days to forecast"
+)
+cl_parser.add_argument(
+    "--level", action="store", type=float, default=0.9,
+    help="Coverage of the prediction intervals"
+)
+# Worker processes
+cl_parser.add_argument(
+    "--workers", action="store", type=int, default=None,
+    help="Number of processes fitting Prophet models concurrently \
+        (default: number of CPUs)"
+)
+# Metrics
+cl_parser.add_argument(
+    "--metrics_path", action="store", default=None,
+    help="Prometheus textfile to which stage metrics are written \
+        (default: <data_path>metrics/predict_model.prom)"
+)
+cl_parser.add_argument(
+    "--no_metrics", action="store_true",
+    help="Do not write stage metrics"
+)
+
+
+#==============================================================================
+def polynomial_design(n_days, degree):
+    """ Design matrix of a polynomial in the day, days -n_days+1 ... 0 """
+    days= np.arange(-n_days+1, 1, dtype=np.float64)
+
+    return np.vander(days, degree+1, increasing=True)
+
+
+#==============================================================================
+def fit_least_squares(values, degree):
+    """ Least squares polynomial fits of many series sharing a design matrix
+
+    The design matrix and its pseudo-inverse are computed once for all
+    series; each fit is a matrix product.
+
+    Parameters:
+    ----------
+    values: numpy Array
+        shape (n_days, n_regions)
+    degree: int
+        degree of the polynomial
+
+    Returns:
+    -------
+    params: list of dicts
+        "coef" and residual standard deviation "sigma" per region
+    """
+
+    design= polynomial_design(values.shape[0], degree)
+    coef= np.linalg.pinv(design) @ values
+    dof= max(values.shape[0] - design.shape[1], 1)
+    sigma= np.sqrt(((values - design @ coef)**2).sum(axis=0)/dof)
+
+    return [
+        {"coef": coef[:, col].tolist(), "sigma": float(sigma[col])}
+        for col in range(values.shape[1])
+    ]
+
+
+#==============================================================================
+def predict_least_squares(params, n_days, horizon, level):
+    """ Forecast of a polynomial fit with a prediction interval
+
+    Returns:
+    -------
+    forecast, lower, upper: numpy Array
+        one value per day after the last fitted day
+    """
+    from scipy import stats
+
+    degree= len(params["coef"]) - 1
+    design= polynomial_design(n_days, degree)
+    future= np.vander(
+        np.arange(1, horizon+1, dtype=np.float64), degree+1, increasing=True
+    )
+
+    forecast= future @ np.array(params["coef"])
+    leverage= np.einsum(
+        "ij,jk,ik->i", future, np.linalg.pinv(design.T @ design), future
+    )
+    dof= max(n_days - degree - 1, 1)
+    half_width= stats.t.ppf((1 + level)/2, dof)*params["sigma"]* \
+        np.sqrt(1 + leverage)
+
+    return forecast, forecast - half_width, forecast + half_width
+
+
+#==============================================================================
+def fit_loglinear(values, dates, options):
+    """ Line fit on log(1 + cases) of every region, i.e. exponential growth """
+    return fit_least_squares(np.log1p(values), 1)
+
+
+#==============================================================================
+def predict_loglinear(params, dates, options):
+    """ Forecast of fit_loglinear, back on the scale of the cases """
+    forecast, lower, upper= predict_least_squares(
+        params, options["fit_days"], options["horizon"], options["level"]
+    )
+    return np.expm1(forecast), np.expm1(lower), np.expm1(upper)
+
+
+#==============================================================================
+def fit_poly(values, dates, options):
+    """ Polynomial fit on the cases of every region """
+    return fit_least_squares(values, options["degree"])
+
+
+#==============================================================================
+def predict_poly(params, dates, options):
+    """ Forecast of fit_poly, cases below 0 are cut off """
+    forecast, lower, upper= predict_least_squares(
+        params, options["fit_days"], options["horizon"], options["level"]
+    )
+    return np.maximum(forecast, 0), np.maximum(lower, 0), np.maximum(upper, 0)
+
+
+#==============================================================================
+def prophet_module():
+    """ The Prophet package, None if it is not installed """
+    try:
+        import prophet
+        return prophet
+    except ImportError:
+        return None
+
+
+#==============================================================================
+def fit_prophet_series(series, dates, level):
+    """ Fit Prophet to one series, run in a worker process
+
+    Returns:
+    -------
+    params: dict
+        serialized model under "model"
+    """
+    from prophet import Prophet
+    from prophet.serialize import model_to_json
+
+    model= Prophet(
+        interval_width=level, daily_seasonality=False, yearly_seasonality=False
+    )
+    model.fit(pd.DataFrame({"ds": dates, "y": series}))
+
+    return {"model": model_to_json(model)}
+
+
+#==============================================================================
+def fit_prophet(values, dates, options):
+    """ Prophet fit of every region, regions are fitted in a process pool """
+    with ProcessPoolExecutor(max_workers=options["workers"]) as executor:
+        futures= [
+            executor.submit(
+                fit_prophet_series, values[:, col], dates, options["level"]
+            )
+            for col in range(values.shape[1])
+        ]
+        return [future.result() for future in futures]
+
+
+#==============================================================================
+def predict_prophet(params, dates, options):
+    """ Forecast of a serialized Prophet model """
+    from prophet.serialize import model_from_json
+
+    model= model_from_json(params["model"])
+    future= pd.DataFrame({
+        "ds": pd.date_range(
+            dates[-1], periods=options["horizon"]+1, freq="D"
+        )[1:]
+    })
+    df_pred= model.predict(future)
+
+    return (
+        df_pred["yhat"].to_numpy(), df_pred["yhat_lower"].to_numpy(),
+        df_pred["yhat_upper"].to_numpy()
+    )
+
+
+# Registered models, by name
+FORECASTERS= {
+    "loglinear": Forecaster(
+        "loglinear", fit_loglinear, predict_loglinear, False
+    ),
+    "poly": Forecaster("poly", fit_poly, predict_poly, False),
+    "prophet": Forecaster("prophet", fit_prophet, predict_prophet, True),
+}
+
+
+#==============================================================================
+def series_fingerprint(forecaster, values, dates, options):
+    """ SHA-256 of the fitted values of a region and the parameters of the fit
+
+    Models which only depend on the values (not "dated") are not refit when
+    a series did not change, even if its window moved to a later date.
+    """
+    digest= hashlib.sha256()
+    digest.update(json.dumps(
+        [forecaster.name, options["fit_days"],
+            options["degree"] if forecaster.name == "poly" else None,
+            options["level"] if forecaster.dated else None],
+    ).encode())
+    digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    if(forecaster.dated):
+        digest.update(str(dates[-1]).encode())
+
+    return digest.hexdigest()
+
+
+#==============================================================================
+def cache_path(models_path, name):
+    """ Path of the cached fits of a model """
+    return models_path + "forecast_cache/" + name + ".json"
+
+
+#==============================================================================
+def read_cache(models_path, name):
+    """ Cached fits of a model by fingerprint, empty if there are none """
+    try:
+        with open(cache_path(models_path, name)) as cache_file:
+            return json.load(cache_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+#==============================================================================
+def write_cache(models_path, name, cache):
+    """ Atomically replace the cached fits of a model """
+    os.makedirs(os.path.dirname(cache_path(models_path, name)), exist_ok=True)
+    tmp_path= cache_path(models_path, name) + ".tmp"
+    with open(tmp_path, "w") as cache_file:
+        json.dump(cache, cache_file)
+    os.replace(tmp_path, cache_path(models_path, name))
+
+
+#==============================================================================
+def forecast_regions(df_rollups, models=["loglinear", "poly"],
+        models_path="models/", use_cache=True, fit_days=21, horizon=14,
+        degree=2, level=0.9, workers=None):
+    """ Forecast confirmed cases of every region with every model
+
+    Each model is fitted to the last fit_days values of all regions whose
+    fingerprint (see series_fingerprint) is not in the cache of the model;
+    least squares models fit all of them with one matrix product. The
+    cache then holds the fits of this run only, so it does not grow.
+
+    Parameters:
+    ----------
+    df_rollups: pandas DataFrame
+        rollups as written by build_features.py, see
+        build_features.build_rollups
+    models: list of strings
+        keys of FORECASTERS, prophet is skipped if it is not installed
+    models_path: URI-like
+        folder holding the cache
+    use_cache: bool
+        read and write the cache
+    fit_days, horizon, degree, level, workers:
+        see command-line arguments
+
+    Returns:
+    -------
+    df_forecast: pandas DataFrame
+        one row per (date, level, region, model) with "forecast", "lower"
+        and "upper"; dates follow the last date of the rollups
+    report: dict
+        number of "fitted" and "cached" regions per model
+    """
+
+    options= {
+        "fit_days": fit_days, "horizon": horizon, "degree": degree,
+        "level": level, "workers": workers or os.cpu_count()
+    }
+
+    panel= df_rollups.pivot(index="date", columns="region", values="confirmed")
+    panel= panel.sort_index().ffill().fillna(0).iloc[-fit_days:]
+    dates, regions= panel.index, panel.columns
+    values= panel.to_numpy(dtype=np.float64)
+    levels= df_rollups.drop_duplicates("region").set_index("region")["level"]
+    levels= levels.reindex(regions)
+    future_dates= pd.date_range(dates[-1], periods=horizon+1, freq="D")[1:]
+
+    if(len(dates) < fit_days):
+        raise ValueError(
+            "Fewer than {0} dates in the rollups".format(fit_days)
+        )
+
+    frames= []
+    report= {}
+    for name in models:
+        forecaster= FORECASTERS[name]
+        if(forecaster.dated and prophet_module() is None):
+            print("Prophet is not installed, skipping model {0}.".format(name))
+            continue
+
+        cache= read_cache(models_path, name) if use_cache else {}
+        fingerprints= [
+            series_fingerprint(forecaster, values[:, col], dates, options)
+            for col in range(len(regions))
+        ]
+
+        # Fit regions missing from the cache
+        missing= [
+            col for col, each in enumerate(fingerprints) if each not in cache
+        ]
+        if(missing):
+            fits= forecaster.fit(values[:, missing], dates, options)
+            for col, params in zip(missing, fits):
+                cache[fingerprints[col]]= params
+        report[name]= {
+            "fitted": len(missing), "cached": len(regions) - len(missing)
+        }
+
+        forecasts= [
+            forecaster.predict(cache[each], dates, options)
+            for each in fingerprints
+        ]
+        frames.append(pd.DataFrame({
+            "date": np.tile(future_dates, len(regions)),
+            "level": np.repeat(levels.to_numpy(), horizon),
+            "region": np.repeat(regions.to_numpy(), horizon),
+            "model": name,
+            "forecast": np.concatenate([each[0] for each in forecasts]),
+            "lower": np.concatenate([each[1] for each in forecasts]),
+            "upper": np.concatenate([each[2] for each in forecasts]),
+        }))
+
+        if(use_cache):
+            write_cache(
+                models_path, name,
+                {each: cache[each] for each in set(fingerprints)}
+            )
+
+    df_forecast= pd.concat(frames, ignore_index=True) if frames else None
+
+    return df_forecast, report
+
+
+#==============================================================================
+def main(argv=None):
+    """ Entry point of the covid-predict-model command """
+    # Collect command-line arguments
+    cl_options= cl_parser.parse_args(argv)
+
+    stage_metrics= StageMetrics("predict_model")
+    stage_metrics.start("forecast")
+    start= time.time()
+
+    df_rollups= read_processed(
+        cl_options.data_path, "COVID_rollup_set", fmt=cl_options.input_format
+    )
+    df_forecast, report= forecast_regions(
+        df_rollups, models=cl_options.models,
+        models_path=cl_options.models_path,
+        use_cache=not cl_options.no_cache, fit_days=cl_options.fit_days,
+        horizon=cl_options.horizon, degree=cl_options.degree,
+        level=cl_options.level, workers=cl_options.workers
+    )
+    if(df_forecast is None):
+        print("No model to forecast with.")
+        return
+
+    write_processed(
+        df_forecast, cl_options.data_path, "COVID_forecast_set",
+        formats=cl_options.output_format
+    )
+    for name, counts in report.items():
+        print("Model {0}: {1} regions fitted, {2} from cache.".format(
+            name, counts["fitted"], counts["cached"]
+        ))
+    print("Forecast {0} rows in {1:.2f}s.".format(
+        len(df_forecast), time.time() - start
+    ))
+
+    if(not cl_options.no_metrics):
+        stage_metrics.finish(
+            "forecast", rows_in=len(df_rollups), rows_out=len(df_forecast),
+            bytes_read=files_size([processed_path(
+                cl_options.data_path, "COVID_rollup_set",
+                fmt=cl_options.input_format
+            )]),
+            bytes_written=files_size([
+                processed_path(
+                    cl_options.data_path, "COVID_forecast_set", fmt=fmt
+                )
+                for fmt in cl_options.output_format
+            ])
+        )
+        stage_metrics.write_textfile(
+            cl_options.metrics_path or
+            metrics_path(cl_options.data_path, "predict_model")
+        )
+
+
+#==============================================================================
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,545 @@
+# Imports
+import os, time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import argparse
+
+from src.data.storage import FORMATS, processed_path, read_processed
+from src.metrics import StageMetrics, files_size, metrics_path
+
+# Starting point of fits without previous parameters, per day
+DEFAULT_BETA= 0.3
+DEFAULT_GAMMA= 0.1
+
+# Bounds of the fitted parameters, per day
+BETA_BOUNDS= (1e-3, 5.0)
+GAMMA_BOUNDS= (1e-3, 1.0)
+
+# Population per country shipped with the repository, UN estimates for 2020
+POPULATION_PATH= os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "references",
+    "population.csv"
+)
+
+#==============================================================================
+# COMMAND LINE ARGUMENTS
+# Create parser object
+cl_parser= argparse.ArgumentParser(
+    description="Fit SIR parameters (beta, gamma) of every country."
+)
+
+# ARGUMENTS
+# Path to data folder
+cl_parser.add_argument(
+    "--data_path", action="store", default="data/",
+    help="Path to data folder"
+)
+# Input format
+cl_parser.add_argument(
+    "--input_format", action="store", default="csv", choices=FORMATS,
+    help="Format in which the rollups are read"
+)
+# Output folder
+cl_parser.add_argument(
+    "--models_path", action="store", default="models/",
+    help="Folder to which sir_parameters.csv is written"
+)
+# Fitting window
+cl_parser.add_argument(
+    "--window", action="store", type=int, default=28,
+    help="Number of days of cumulative cases to which each fit is fitted"
+)
+cl_parser.add_argument(
+    "--days", action="store", type=int, default=1,
+    help="Fit windows ending on each of the last DAYS dates, each one \
+        warm-started from the fit of the day before"
+)
+cl_parser.add_argument(
+    "--min_cases", action="store", type=float, default=100,
+    help="Skip countries with fewer confirmed cases at the start of the window"
+)
+cl_parser.add_argument(
+    "--active_days", action="store", type=int, default=14,
+    help="Cases of the last ACTIVE_DAYS days before the window count as \
+        infectious at its start"
+)
+# Population
+cl_parser.add_argument(
+    "--population_path", action="store", default=None,
+    help="Semicolon-separated file with columns country and population, or \
+        the Johns Hopkins UID_ISO_FIPS_LookUp_Table.csv (default: \
+        references/population.csv); countries without a population are not \
+        fitted"
+)
+# Optimizer
+cl_parser.add_argument(
+    "--max_iter", action="store", type=int, default=50,
+    help="Maximum number of Levenberg-Marquardt iterations per fit"
+)
+cl_parser.add_argument(
+    "--substeps", action="store", type=int, default=4,
+    help="Runge-Kutta steps per day"
+)
+# Worker processes
+cl_parser.add_argument(
+    "--workers", action="store", type=int, default=None,
+    help="Number of processes fitting countries concurrently \
+        (default: number of CPUs)"
+)
+# Metrics
+cl_parser.add_argument(
+    "--metrics_path", action="store", default=None,
+    help="Prometheus textfile to which stage metrics are written \
+        (default: <data_path>metrics/train_model.prom)"
+)
+cl_parser.add_argument(
+    "--no_metrics", action="store_true",
+    help="Do not write stage metrics"
+)
+
+
+#==============================================================================
+def parameters_path(models_path):
+    """ Path of the fitted SIR parameters """
+    return models_path + "sir_parameters.csv"
+
+
+#==============================================================================
+def read_parameters(models_path):
+    """ SIR parameters of earlier runs, None if there are none """
+    if(not os.path.exists(parameters_path(models_path))):
+        return None
+
+    return pd.read_csv(
+        parameters_path(models_path), sep=";", parse_dates=["date"]
+    )
+
+
+#==============================================================================
+def write_parameters(df_params, models_path):
+    """ Atomically replace the SIR parameters """
+    os.makedirs(models_path, exist_ok=True)
+    tmp_path= parameters_path(models_path) + ".tmp"
+    df_params.to_csv(tmp_path, sep=";", index=False)
+    os.replace(tmp_path, parameters_path(models_path))
+
+
+#==============================================================================
+def integrate_sir(beta, gamma, s0, i0, days, substeps=4):
+    """ Integrate the SIR model of many regions at once
+
+    S' = -beta*S*I, I' = beta*S*I - gamma*I with S and I as fractions of
+    the population, by classic Runge-Kutta with substeps steps per day.
+    All arguments are arrays with one entry per region, every step updates
+    all regions with whole-array operations.
+
+    Parameters:
+    ----------
+    beta, gamma: numpy Array
+        infection and recovery rate per day
+    s0, i0: numpy Array
+        susceptible and infectious fraction on the first day
+    days: int
+        number of days
+    substeps: int
+        Runge-Kutta steps per day
+
+    Returns:
+    -------
+    s: numpy Array
+        susceptible fraction, shape (n_regions, days)
+    """
+
+    def rhs(s, i):
+        infections= beta*s*i
+        return -infections, infections - gamma*i
+
+    h= 1.0/substeps
+    s, i= s0.astype(np.float64), i0.astype(np.float64)
+    s_days= np.empty((len(s), days))
+    s_days[:, 0]= s
+
+    for day in range(1, days):
+        for _ in range(substeps):
+            ds1, di1= rhs(s, i)
+            ds2, di2= rhs(s + h/2*ds1, i + h/2*di1)
+            ds3, di3= rhs(s + h/2*ds2, i + h/2*di2)
+            ds4, di4= rhs(s + h*ds3, i + h*di3)
+            s= s + h/6*(ds1 + 2*ds2 + 2*ds3 + ds4)
+            i= i + h/6*(di1 + 2*di2 + 2*di3 + di4)
+        s_days[:, day]= s
+
+    return s_days
+
+
+#==============================================================================
+def fit_sir(observed, s0, i0, beta0, gamma0, max_iter=50, tol=1e-8,
+        substeps=4):
+    """ Fit beta and gamma of many regions at once
+
+    Cumulative cases N*(1-S) are fit to the observed cumulative cases by
+    least squares on the log scale, with a Levenberg-Marquardt iteration
+    run on all regions together: every iteration integrates the model of
+    all regions which have not converged yet three times (the current
+    parameters and a forward difference per parameter) and once more for
+    the trial step. Parameters are fitted as logarithms within BETA_BOUNDS
+    and GAMMA_BOUNDS.
+
+    Parameters:
+    ----------
+    observed: numpy Array
+        cumulative cases as fraction of the population, shape (n_regions, days)
+    s0, i0: numpy Array
+        initial susceptible and infectious fractions per region
+    beta0, gamma0: numpy Array
+        starting point per region, e.g. the fit of the day before
+    max_iter: int
+        maximum number of iterations
+    tol: float
+        relative cost improvement below which a fit has converged
+    substeps: int
+        Runge-Kutta steps per day
+
+    Returns:
+    -------
+    fit: dict
+        "beta", "gamma", "rmse" (of the log cases), "iterations" and
+        "converged", arrays with one entry per region
+    """
+
+    n_regions, days= observed.shape
+    log_obs= np.log(observed)
+    lower= np.log([BETA_BOUNDS[0], GAMMA_BOUNDS[0]])
+    upper= np.log([BETA_BOUNDS[1], GAMMA_BOUNDS[1]])
+
+    theta= np.clip(np.log(np.column_stack([beta0, gamma0])), lower, upper)
+    damping= np.full(n_regions, 1e-3)
+    iterations= np.zeros(n_regions, dtype=np.int64)
+    converged= np.zeros(n_regions, dtype=bool)
+
+    def residuals(theta, idx):
+        s= integrate_sir(
+            np.exp(theta[:, 0]), np.exp(theta[:, 1]), s0[idx], i0[idx], days,
+            substeps
+        )
+        return np.log(np.maximum(1 - s, 1e-300)) - log_obs[idx]
+
+    eps= 1e-6
+    for _ in range(max_iter):
+        idx= np.flatnonzero(~converged)
+        if(len(idx) == 0):
+            break
+
+        theta_act= theta[idx]
+        res= residuals(theta_act, idx)
+        cost= (res**2).sum(axis=1)
+
+        # Forward-difference Jacobian, shape (regions, days, 2)
+        jac= np.stack([
+            (residuals(theta_act + eps*np.eye(2)[k], idx) - res)/eps
+            for k in range(2)
+        ], axis=2)
+
+        # Damped normal equations of all regions
+        jtj= np.einsum("ntk,ntl->nkl", jac, jac)
+        jtr= np.einsum("ntk,nt->nk", jac, res)
+        diag= np.einsum("nkk->nk", jtj)
+        lhs= jtj + (damping[idx, None]*diag + 1e-12)[:, :, None]*np.eye(2)
+        step= -np.linalg.solve(lhs, jtr[:, :, None])[:, :, 0]
+
+        theta_new= np.clip(theta_act + step, lower, upper)
+        cost_new= (residuals(theta_new, idx)**2).sum(axis=1)
+
+        improved= cost_new < cost
+        theta[idx]= np.where(improved[:, None], theta_new, theta_act)
+        damping[idx]= np.where(
+            improved, damping[idx]/3, np.minimum(damping[idx]*3, 1e8)
+        )
+        iterations[idx]+= 1
+        converged[idx]= (
+            (improved & (cost - cost_new <= tol*cost))
+            | (np.abs(theta_new - theta_act).max(axis=1) < tol)
+            | (damping[idx] >= 1e8)
+        )
+
+    s= integrate_sir(
+        np.exp(theta[:, 0]), np.exp(theta[:, 1]), s0, i0, days, substeps
+    )
+    log_fit= np.log(np.maximum(1 - s, 1e-300))
+    rmse= np.sqrt(np.mean((log_fit - log_obs)**2, axis=1))
+
+    return {
+        "beta": np.exp(theta[:, 0]), "gamma": np.exp(theta[:, 1]),
+        "rmse": rmse, "iterations": iterations, "converged": converged
+    }
+
+
+#==============================================================================
+def fit_countries(confirmed, population, end_positions, beta0, gamma0,
+        window=28, min_cases=100, active_days=14, max_iter=50, substeps=4):
+    """ Fit a group of countries on windows ending at several dates, run in a
+    worker process
+
+    Windows are fitted in date order; the fit of a window starts from the
+    parameters fitted on the window of the day before.
+
+    Parameters:
+    ----------
+    confirmed: numpy Array
+        cumulative cases, shape (n_dates, n_countries)
+    population: numpy Array
+        population per country, countries with NaN are not fitted
+    end_positions: list of ints
+        positions of the last dates of the windows, ascending
+    beta0, gamma0: numpy Array
+        starting point of the first window per country
+    window, min_cases, active_days, max_iter, substeps:
+        see command-line arguments
+
+    Returns:
+    -------
+    fits: list of tuples
+        (end position, fitted countries as positions, fit dict of fit_sir)
+    """
+
+    beta0, gamma0= beta0.copy(), gamma0.copy()
+    fits= []
+    for end in end_positions:
+        start= end - window + 1
+        if(start < 0):
+            continue
+
+        observed= confirmed[start:end+1].T
+        # Countries with a population and enough cases over the whole window
+        cols= np.flatnonzero(
+            (observed[:, 0] >= min_cases) & np.isfinite(population)
+        )
+        if(len(cols) == 0):
+            continue
+
+        # Effective population, at least twice the cases at the end of the
+        # window
+        pop= np.maximum(population[cols], 2*observed[cols, -1])
+        before= confirmed[start - active_days, cols] \
+            if start >= active_days else 0
+        c0= observed[cols, 0]
+        i0= np.maximum(c0 - before, 1)/pop
+
+        fit= fit_sir(
+            observed[cols]/pop[:, None], 1 - c0/pop, i0, beta0[cols],
+            gamma0[cols], max_iter=max_iter, substeps=substeps
+        )
+        fit["population"]= pop
+        fits.append((end, cols, fit))
+
+        # Warm start of the next day
+        beta0[cols], gamma0[cols]= fit["beta"], fit["gamma"]
+
+    return fits
+
+
+#==============================================================================
+def read_population(path, countries):
+    """ Population per country, NaN where unknown
+
+    Parameters:
+    ----------
+    path: URI-like
+        semicolon-separated file with columns country and population, 
+        POPULATION_PATH if None, or the lookup table of the Johns Hopkins 
+        repository (UID_ISO_FIPS_LookUp_Table.csv), whose rows without a 
+        province hold the populations of the countries
+    countries: list of strings
+        countries in the order of the result
+
+    Returns:
+    -------
+    population: numpy Array
+    """
+    path= path or POPULATION_PATH
+    with open(path) as population_file:
+        header= population_file.readline()
+
+    if("Country_Region" in header):
+        df_pop= pd.read_csv(
+            path, usecols=["Province_State", "Country_Region", "Population"]
+        )
+        df_pop= df_pop[df_pop["Province_State"].isna()].rename(
+            columns={"Country_Region": "country", "Population": "population"}
+        )
+    else:
+        df_pop= pd.read_csv(path, sep=";")
+
+    known= df_pop.drop_duplicates("country").set_index("country")["population"]
+
+    return known.reindex(countries).to_numpy(dtype=np.float64)
+
+
+#==============================================================================
+def fit_all_countries(df_rollups, df_previous=None, days=1, window=28,
+        min_cases=100, active_days=14, population_path=None, max_iter=50,
+        substeps=4, workers=None):
+    """ Fit SIR parameters of every country on windows ending on the last days
+
+    Countries are split into one group per worker process; each process
+    fits all countries of its group at once, see fit_sir. Fits of the first
+    window start from the latest earlier parameters in df_previous.
+
+    Parameters:
+    ----------
+    df_rollups: pandas DataFrame
+        rollups as written by build_features.py, see
+        build_features.build_rollups
+    df_previous: pandas DataFrame
+        parameters of earlier runs, see read_parameters
+    days, window, min_cases, active_days, population_path, max_iter,
+    substeps, workers:
+        see command-line arguments
+
+    Returns:
+    -------
+    df_params: pandas DataFrame
+        one row per (date, country): "beta", "gamma", "R0", "population",
+        "rmse", "iterations" and "converged"; date is the last day of the
+        window
+    """
+
+    df_country= df_rollups[df_rollups["level"] == "country"]
+    panel= df_country.pivot(index="date", columns="region", values="confirmed")
+    panel= panel.sort_index()
+    panel= panel.ffill().fillna(0)
+    dates, countries= panel.index, panel.columns.to_numpy()
+    confirmed= panel.to_numpy(dtype=np.float64)
+
+    end_positions= list(range(max(len(dates) - days, 0), len(dates)))
+    if(not end_positions):
+        return None
+
+    # Warm start from the latest parameters before the first window
+    beta0= np.full(len(countries), DEFAULT_BETA)
+    gamma0= np.full(len(countries), DEFAULT_GAMMA)
+    if(df_previous is not None):
+        df_last= df_previous[df_previous["date"] < dates[end_positions[0]]]
+        df_last= df_last.sort_values("date")
+        df_last= df_last.drop_duplicates("country", keep="last")
+        df_last= df_last.set_index("country").reindex(countries)
+        beta0= df_last["beta"].fillna(DEFAULT_BETA).to_numpy()
+        gamma0= df_last["gamma"].fillna(DEFAULT_GAMMA).to_numpy()
+
+    population= read_population(population_path, countries)
+    unknown= countries[np.isnan(population)]
+    if(len(unknown)):
+        print("No population of {0} countries, they are not fitted: "
+            "{1}".format(len(unknown), ", ".join(map(str, unknown))))
+
+    workers= workers or os.cpu_count()
+    groups= [
+        group for group in np.array_split(np.arange(len(countries)), workers)
+        if len(group)
+    ]
+    with ProcessPoolExecutor(max_workers=len(groups)) as executor:
+        futures= [
+            executor.submit(
+                fit_countries, confirmed[:, group], population[group],
+                end_positions, beta0[group], gamma0[group], window=window,
+                min_cases=min_cases, active_days=active_days,
+                max_iter=max_iter, substeps=substeps
+            )
+            for group in groups
+        ]
+        results= [
+            (group, future.result()) for group, future in zip(groups, futures)
+        ]
+
+    records= []
+    for group, fits in results:
+        for end, cols, fit in fits:
+            records.append(pd.DataFrame({
+                "date": dates[end], "country": countries[group[cols]],
+                "beta": fit["beta"], "gamma": fit["gamma"],
+                "R0": fit["beta"]/fit["gamma"],
+                "population": fit["population"],
+                "rmse": fit["rmse"], "iterations": fit["iterations"],
+                "converged": fit["converged"]
+            }))
+
+    if(not records):
+        return None
+
+    df_params= pd.concat(records, ignore_index=True)
+
+    return df_params.sort_values(["date", "country"]).reset_index(drop=True)
+
+
+#==============================================================================
+def merge_parameters(df_previous, df_params):
+    """ Replace the rows of df_previous which were fitted again """
+    if(df_previous is None):
+        return df_params
+
+    df_merged= pd.concat([df_previous, df_params], ignore_index=True)
+    df_merged= df_merged.drop_duplicates(["date", "country"], keep="last")
+
+    return df_merged.sort_values(["date", "country"]).reset_index(drop=True)
+
+
+#==============================================================================
+def main(argv=None):
+    """ Entry point of the covid-train-model command """
+    # Collect command-line arguments
+    cl_options= cl_parser.parse_args(argv)
+
+    stage_metrics= StageMetrics("train_model")
+    stage_metrics.start("train")
+    start= time.time()
+
+    df_rollups= read_processed(
+        cl_options.data_path, "COVID_rollup_set", fmt=cl_options.input_format
+    )
+    df_previous= read_parameters(cl_options.models_path)
+
+    df_params= fit_all_countries(
+        df_rollups, df_previous, days=cl_options.days,
+        window=cl_options.window, min_cases=cl_options.min_cases,
+        active_days=cl_options.active_days,
+        population_path=cl_options.population_path,
+        max_iter=cl_options.max_iter, substeps=cl_options.substeps,
+        workers=cl_options.workers
+    )
+    if(df_params is None):
+        print("No country has {0:g} cases {1} days before the last "
+            "date.".format(cl_options.min_cases, cl_options.window))
+        return
+
+    write_parameters(
+        merge_parameters(df_previous, df_params), cl_options.models_path
+    )
+    print(
+        "Fitted {0} windows of {1} countries in {2:.2f}s, {3} did not "
+        "converge.".format(
+            len(df_params), df_params["country"].nunique(),
+            time.time() - start, int((~df_params["converged"]).sum())
+        )
+    )
+
+    if(not cl_options.no_metrics):
+        stage_metrics.finish(
+            "train", rows_in=len(df_rollups), rows_out=len(df_params),
+            bytes_read=files_size([processed_path(
+                cl_options.data_path, "COVID_rollup_set",
+                fmt=cl_options.input_format
+            )]),
+            bytes_written=files_size([parameters_path(cl_options.models_path)])
+        )
+        stage_metrics.write_textfile(
+            cl_options.metrics_path or
+            metrics_path(cl_options.data_path, "train_model")
+        )
+
+
+#==============================================================================
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,446 @@
+# Imports
+import os, json, hashlib, time
+from datetime import datetime
+
+import argparse
+
+# Stage modules importing pandas, scipy, ... are imported when a stage runs,
+# so a run in which nothing changed starts quickly
+from src.data.storage import FORMATS, TIME_SERIES, DATASET_NAMES, \
+    CONTINENTS_PATH, processed_path, time_series_path
+from src.data.publish import publish_version, file_digest, versions_path
+from src.data.national import SOURCES
+from src.metrics import StageMetrics, files_size, metrics_path
+
+#==============================================================================
+# COMMAND LINE ARGUMENTS
+# Create parser object
+cl_parser= argparse.ArgumentParser(
+    description="Run the whole data pipeline (fetch, process, features, \
+        publish) in one process, skipping stages whose inputs did not change."
+)
+
+# ARGUMENTS
+# Path to data folder
+cl_parser.add_argument(
+    "--data_path", action="store", default="data/",
+    help="Path to data folder"
+)
+# Output formats
+cl_parser.add_argument(
+    "--output_format", action="store", nargs="+", default=["csv"],
+    choices=FORMATS,
+    help="Formats in which processed datasets are written"
+)
+# Stage control
+cl_parser.add_argument(
+    "--force", action="store_true",
+    help="Run all stages even if their inputs did not change"
+)
+cl_parser.add_argument(
+    "--skip_fetch", action="store_true",
+    help="Do not update the raw data, process what is on disk"
+)
+cl_parser.add_argument(
+    "--skip_national", "--skip_ncdc", action="store_true",
+    help="Do not fetch the national sources (NCDC, ...)"
+)
+# Johns Hopkins repository, see get_data.py
+cl_parser.add_argument(
+    "--jh_remote", action="store",
+    default="https://github.com/CSSEGISandData/COVID-19.git",
+    help="URL of the Johns Hopkins repository"
+)
+cl_parser.add_argument(
+    "--jh_mode", action="store", default="sparse", choices=["sparse", "full"],
+    help="Johns Hopkins ingestion mode, see get_data.py"
+)
+cl_parser.add_argument(
+    "--git_timeout", action="store", type=int, default=600,
+    help="Seconds after which a git command is aborted"
+)
+# Time series, see process_JH_data.py
+cl_parser.add_argument(
+    "--time_series", action="store", nargs="+",
+    default=[
+        "global:confirmed", "global:deaths", "global:recovered",
+        "US:confirmed", "US:deaths"
+    ],
+    help="Time series to ingest as scope:metric"
+)
+cl_parser.add_argument(
+    "--workers", action="store", type=int, default=None,
+    help="Number of processes reading time series concurrently"
+)
+# Doubling rate, see build_features.py
+cl_parser.add_argument(
+    "--dr_window", action="store", type=int, default=3,
+    help="Number of days in each doubling rate regression window"
+)
+cl_parser.add_argument(
+    "--dr_method", action="store", default="linear", choices=["linear", "log"],
+    help="Doubling rate estimator"
+)
+cl_parser.add_argument(
+    "--smoother", action="append", default=[],
+    help="Additional smoothed column as name=kind:param=value,..., see \
+        build_features.py (repeatable)"
+)
+cl_parser.add_argument(
+    "--continents_path", action="store", default=None,
+    help="Country to continent mapping of the rollups, see build_features.py"
+)
+cl_parser.add_argument(
+    "--align_thresholds", action="store", type=int, nargs="+", default=None,
+    help="Confirmed cases at which the rollup timelines are aligned, see \
+        build_features.py"
+)
+# Publishing
+cl_parser.add_argument(
+    "--keep_versions", action="store", type=int, default=3,
+    help="Number of most recent published versions to keep"
+)
+# Metrics
+cl_parser.add_argument(
+    "--metrics_path", action="store", default=None,
+    help="Prometheus textfile to which stage metrics are written \
+        (default: <data_path>metrics/pipeline.prom)"
+)
+cl_parser.add_argument(
+    "--no_metrics", action="store_true",
+    help="Do not write stage metrics"
+)
+
+
+#==============================================================================
+def state_path(data_path):
+    """ Path of the file recording the fingerprint of each finished stage """
+    return data_path + "processed/pipeline_state.json"
+
+
+#==============================================================================
+def read_state(data_path):
+    """ Fingerprints of the last successful run of every stage, or empty """
+    try:
+        with open(state_path(data_path)) as state_file:
+            return json.load(state_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+#==============================================================================
+def write_state(data_path, state):
+    """ Atomically replace the stage state file """
+    tmp_path= state_path(data_path) + ".tmp"
+    with open(tmp_path, "w") as state_file:
+        json.dump(state, state_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, state_path(data_path))
+
+
+#==============================================================================
+def fingerprint(*parts):
+    """ SHA-256 of JSON-serializable parts, e.g. file digests, parameters """
+    encoded= json.dumps(parts, sort_keys=True, default=str).encode()
+
+    return hashlib.sha256(encoded).hexdigest()
+
+
+#==============================================================================
+def optional_digest(path):
+    """ file_digest of a file or folder, None if it does not exist """
+    if(not os.path.exists(path)):
+        return None
+
+    return file_digest(path)
+
+
+#==============================================================================
+def run_pipeline(data_path, formats=["csv"], force=False, fetch=True,
+        national=True,
+        jh_remote="https://github.com/CSSEGISandData/COVID-19.git",
+        jh_mode="sparse", git_timeout=600, time_series=["global:confirmed"],
+        workers=None, dr_window=3, dr_method="linear", smoothers=[],
+        continents_path=None, align_thresholds=None, keep_versions=3,
+        metrics_file=None):
+    """ Run fetch, process, features and publish in one process
+
+    DataFrames are handed from one stage to the next in memory instead of
+    being re-read from disk. Each stage except fetch has a fingerprint over
+    its inputs: the process stage over the selected raw time series files,
+    the features and publish stages over the fingerprint of the stage before
+    them, their own parameters, (features) the continent mapping and 
+    (publish) the national datasets. A stage whose fingerprint matches the
+    one recorded in <data_path>processed/pipeline_state.json and whose
+    outputs exist is skipped; unchanged raw data therefore skips everything
+    after fetch.
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    formats: list of strings
+        formats in which processed datasets are written, see storage.FORMATS
+    force: bool
+        run all stages regardless of their fingerprints
+    fetch: bool
+        update the raw data first
+    national: bool
+        fetch the national sources during fetch, see national.SOURCES
+    jh_remote, jh_mode, git_timeout:
+        see get_data.get_johns_hopkings
+    time_series: list of strings
+        time series to ingest as "scope:metric", see
+        process_JH_data.TIME_SERIES
+    workers: int
+        number of processes reading time series, number of CPUs if None
+    dr_window, dr_method:
+        see build_features.build_features_panel
+    smoothers: list of strings
+        additional smoothed columns, see smoothing.parse_smoothers
+    continents_path: URI-like
+        country to continent mapping of the rollups, see
+        build_features.read_continents
+    align_thresholds: list of ints
+        confirmed cases at which the rollup timelines are aligned, 
+        build_features.ALIGN_THRESHOLDS if None, see
+        build_features.threshold_offsets
+    keep_versions: int
+        number of most recent published versions to keep
+    metrics_file: URI-like
+        Prometheus textfile to which wall time, peak memory, rows and bytes 
+        of every stage are written at the end of the run, None to disable
+
+    Returns:
+    -------
+    report: list of dicts
+        "stage", "status" ("ran", "skipped" or "failed") and "seconds" per
+        stage
+    """
+
+    state= read_state(data_path)
+    report= []
+    stage_metrics= StageMetrics("pipeline")
+
+    def begin(stage):
+        stage_metrics.start(stage)
+        return time.time()
+
+    def record(stage, status, start, stage_fingerprint=None, **counters):
+        stage_metrics.finish(stage, status=status, **counters)
+        seconds= time.time() - start
+        report.append({"stage": stage, "status": status, "seconds": seconds})
+        print("Stage {0}: {1} ({2:.2f}s).".format(stage, status, seconds))
+        if(status == "ran" and stage_fingerprint is not None):
+            state[stage]= {
+                "fingerprint": stage_fingerprint,
+                "finished": datetime.utcnow().isoformat() + "Z",
+                "seconds": seconds
+            }
+            write_state(data_path, state)
+
+    def unchanged(stage, stage_fingerprint, outputs):
+        recorded= state.get(stage, {}).get("fingerprint")
+        return (not force and recorded == stage_fingerprint
+            and all(os.path.exists(path) for path in outputs))
+
+    # FETCH
+    start= begin("fetch")
+    if(fetch):
+        from src.data.get_data import get_johns_hopkings
+        from src.data.national import fetch_sources
+
+        fetch_status= "ran"
+        jh_report= get_johns_hopkings(
+            data_path, remote=jh_remote, mode=jh_mode, timeout=git_timeout
+        )
+        if(not jh_report["ok"]):
+            print(
+                "Johns Hopkins update failed, continuing with the data on "
+                "disk."
+            )
+            fetch_status= "failed"
+        national_reports= fetch_sources(data_path, formats=formats) \
+            if national else []
+        if(any(each["status"] == "failed" for each in national_reports)):
+            fetch_status= "failed"
+        updated= [
+            each for each in national_reports if each["status"] == "updated"
+        ]
+        record(
+            "fetch", fetch_status, start,
+            rows_out=sum(each["rows"] for each in updated),
+            bytes_read=jh_report["bytes_received"] + sum(
+                each["bytes_received"] for each in national_reports
+            ),
+            bytes_written=files_size([
+                processed_path(data_path, each["name"], fmt)
+                for each in updated for fmt in formats
+            ])
+        )
+    else:
+        record("fetch", "skipped", start)
+
+    # PROCESS
+    start= begin("process")
+    scopes= sorted(set(each.split(":")[0] for each in time_series))
+    files= sorted(
+        file_name
+        for scope, series in TIME_SERIES.items()
+        for metric, file_name in series
+        if scope + ":" + metric in time_series
+    )
+    process_fingerprint= fingerprint(
+        "process",
+        [file_digest(time_series_path(data_path, name)) for name in files],
+        sorted(time_series), formats
+    )
+    relational= {}
+    if(unchanged("process", process_fingerprint, [
+            processed_path(data_path, DATASET_NAMES[scope], fmt)
+            for scope in scopes for fmt in formats])):
+        record("process", "skipped", start)
+    else:
+        from src.data.process_JH_data import store_relational_model, \
+            process_counters
+
+        relational= store_relational_model(
+            data_path, formats=formats, time_series=time_series,
+            workers=workers
+        )
+        record(
+            "process", "ran", start, process_fingerprint,
+            **process_counters(data_path, time_series, relational, formats)
+        )
+
+    # FEATURES
+    start= begin("features")
+    features_fingerprint= fingerprint(
+        "features", process_fingerprint, dr_window, dr_method, smoothers,
+        formats, file_digest(continents_path or CONTINENTS_PATH),
+        align_thresholds
+    )
+    features_outputs= [
+        "COVID_final_set", "COVID_rollup_set", "COVID_alignment_set"
+    ]
+    features_ran= False
+    if("global" not in scopes):
+        record("features", "skipped", start)
+    elif(unchanged("features", features_fingerprint, [
+            processed_path(data_path, name, fmt)
+            for name in features_outputs for fmt in formats])):
+        record("features", "skipped", start)
+    else:
+        from src.data.storage import read_processed, write_processed
+        from src.features.build_features import ALIGN_THRESHOLDS, \
+            build_features_panel, build_rollups, feature_settings, \
+            prepare_relational, read_continents, threshold_offsets
+        from src.features.smoothing import parse_smoothers
+
+        pd_JH_rel= relational.get("global")
+        bytes_read= 0
+        if(pd_JH_rel is None):
+            # Process was skipped, read its output from the fastest format
+            fmt= "feather" if "feather" in formats else formats[0]
+            pd_JH_rel= read_processed(
+                data_path, DATASET_NAMES["global"], fmt=fmt
+            )
+            bytes_read= files_size([
+                processed_path(data_path, DATASET_NAMES["global"], fmt)
+            ])
+
+        stage_smoothers= parse_smoothers(smoothers)
+        settings= feature_settings(dr_window, dr_method, stage_smoothers)
+        pd_res= build_features_panel(
+            prepare_relational(pd_JH_rel), dr_window=dr_window,
+            dr_method=dr_method, smoothers=stage_smoothers
+        )
+        write_processed(
+            pd_res, data_path, "COVID_final_set", formats=formats,
+            settings=settings
+        )
+        pd_rollups= build_rollups(
+            pd_JH_rel, read_continents(continents_path), dr_window=dr_window,
+            dr_method=dr_method, smoothers=stage_smoothers
+        )
+        write_processed(
+            pd_rollups, data_path, "COVID_rollup_set", formats=formats,
+            settings=settings
+        )
+        pd_offsets= threshold_offsets(
+            pd_rollups, align_thresholds or ALIGN_THRESHOLDS
+        )
+        write_processed(
+            pd_offsets, data_path, "COVID_alignment_set", formats=formats
+        )
+        features_ran= True
+        record(
+            "features", "ran", start, features_fingerprint,
+            rows_in=len(pd_JH_rel),
+            rows_out=len(pd_res) + len(pd_rollups) + len(pd_offsets),
+            bytes_read=bytes_read,
+            bytes_written=files_size([
+                processed_path(data_path, name, fmt)
+                for name in features_outputs for fmt in formats
+            ])
+        )
+
+    # PUBLISH
+    start= begin("publish")
+    publish_fingerprint= fingerprint(
+        "publish", features_fingerprint,
+        [
+            optional_digest(processed_path(data_path, name, formats[0]))
+            for name in sorted(SOURCES)
+        ]
+    )
+    if(not features_ran and unchanged("publish", publish_fingerprint,
+            [versions_path(data_path) + "CURRENT"])):
+        record("publish", "skipped", start)
+    else:
+        version= publish_version(data_path, keep_versions=keep_versions)
+        print("Published version {0}.".format(version))
+        record("publish", "ran", start, publish_fingerprint)
+
+    print("Pipeline finished in {0:.2f}s: {1}.".format(
+        sum(each["seconds"] for each in report),
+        ", ".join(
+            "{0} {1}".format(each["stage"], each["status"]) for each in report
+        )
+    ))
+    if(metrics_file is not None):
+        stage_metrics.write_textfile(metrics_file)
+
+    return report
+
+
+#==============================================================================
+def main(argv=None):
+    """ Entry point of the covid-pipeline command """
+    # Collect command-line arguments
+    cl_options= cl_parser.parse_args(argv)
+    from src.features.smoothing import parse_smoothers
+    try:
+        parse_smoothers(cl_options.smoother)
+    except ValueError as err:
+        cl_parser.error(str(err))
+
+    run_pipeline(
+        cl_options.data_path, formats=cl_options.output_format,
+        force=cl_options.force,
+        fetch=not cl_options.skip_fetch, national=not cl_options.skip_national,
+        jh_remote=cl_options.jh_remote, jh_mode=cl_options.jh_mode,
+        git_timeout=cl_options.git_timeout, time_series=cl_options.time_series,
+        workers=cl_options.workers, dr_window=cl_options.dr_window,
+        dr_method=cl_options.dr_method, smoothers=cl_options.smoother,
+        continents_path=cl_options.continents_path,
+        align_thresholds=cl_options.align_thresholds,
+        keep_versions=cl_options.keep_versions,
+        metrics_file=None if cl_options.no_metrics else
+            cl_options.metrics_path or
+            metrics_path(cl_options.data_path, "pipeline")
+    )
+
+
+#==============================================================================
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+""" COVID-19 dashboard
+
+Functions are imported from their modules on first access, so importing
+src.visualization does not import dash, pandas, ... before they are needed.
+"""
+from src._lazy import lazy_exports
+
+# Public name -> module defining it
+_EXPORTS= {
+    "create_app": "src.visualization.visualize",
+    "load_dataset": "src.visualization.visualize",
+    "region_timeline": "src.visualization.visualize",
+    "build_figure": "src.visualization.visualize",
+    "build_series_store": "src.visualization.visualize",
+    "TraceCache": "src.visualization.cache",
+    "downsample_trace": "src.visualization.payload",
+    "lttb_indices": "src.visualization.payload",
+}
+
+__getattr__, __all__= lazy_exports(__name__, _EXPORTS)
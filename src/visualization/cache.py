@@ -0,0 +1,206 @@
+# Imports
+import os, pickle, sqlite3, threading, time
+
+
+#==============================================================================
+def dataset_version(path):
+    """ Version of a dataset file, changes whenever the file is replaced
+
+    Parameters:
+    ----------
+    path: URI-like
+        path to dataset file or directory
+
+    Returns:
+    -------
+    version: string
+    """
+    stat= os.stat(path)
+
+    return "{0}-{1}".format(stat.st_mtime_ns, stat.st_size)
+
+
+#==============================================================================
+class TraceCache:
+    """ LRU cache for dashboard traces, shared between processes through SQLite
+
+    Entries are keyed by (dataset version, country, metric). When the cache
+    holds more than max_entries entries or max_bytes bytes, the least
+    recently used entries are evicted. Hit and miss counters are kept in the
+    same database, so they cover all processes using the cache.
+
+    Lookups only read the database: hits, misses and access times are 
+    collected in each process and written in one transaction every 
+    flush_every lookups or flush_seconds seconds, so worker processes do 
+    not queue on the write lock for every trace. Least recently used is 
+    therefore exact up to one batch, and stats() flushes the calling 
+    process only.
+
+    Parameters:
+    ----------
+    path: URI-like
+        path to the SQLite database file
+    max_entries: int
+        maximum number of cached entries
+    max_bytes: int
+        maximum total size of cached values in bytes
+    flush_every: int
+        number of lookups after which counters and access times are written
+    flush_seconds: float
+        seconds after which they are written at the latest, on the next lookup
+    """
+
+    def __init__(self, path, max_entries=2048, max_bytes=64*1024**2,
+            flush_every=256, flush_seconds=5.0):
+        self.path= path
+        self.max_entries= max_entries
+        self.max_bytes= max_bytes
+        self.flush_every= flush_every
+        self.flush_seconds= flush_seconds
+        # One connection per thread and process
+        self._local= threading.local()
+        # Counters and access times not yet written, per process
+        self._pending_lock= threading.Lock()
+        self._reset_pending()
+
+        folder= os.path.dirname(path)
+        if(folder and not os.path.exists(folder)):
+            os.makedirs(folder)
+
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "version TEXT, country TEXT, metric TEXT, value BLOB, "
+                "size INTEGER, last_access REAL, "
+                "PRIMARY KEY (version, country, metric))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters "
+                "(name TEXT PRIMARY KEY, value INTEGER)"
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO counters "
+                "VALUES ('hits', 0), ('misses', 0)"
+            )
+
+    def _connection(self):
+        conn= getattr(self._local, "conn", None)
+        # Connections must not be shared with forked worker processes
+        if(conn is None or self._local.pid != os.getpid()):
+            conn= sqlite3.connect(self.path, timeout=30)
+            # Readers do not block the writer
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn= conn
+            self._local.pid= os.getpid()
+
+        return conn
+
+    def _reset_pending(self):
+        self._pending= {"hits": 0, "misses": 0, "accessed": {}}
+        self._pending_pid= os.getpid()
+        self._flushed= time.time()
+
+    def get(self, version, country, metric):
+        """ Look up a cached value, None on a miss """
+        row= self._connection().execute(
+            "SELECT value FROM entries "
+            "WHERE version=? AND country=? AND metric=?",
+            (version, country, metric)
+        ).fetchone()
+
+        with self._pending_lock:
+            # Counts inherited from the parent process were not made here
+            if(self._pending_pid != os.getpid()):
+                self._reset_pending()
+
+            if(row is None):
+                self._pending["misses"]+= 1
+            else:
+                self._pending["hits"]+= 1
+                key= (version, country, metric)
+                self._pending["accessed"][key]= time.time()
+
+            lookups= self._pending["hits"] + self._pending["misses"]
+            if(lookups >= self.flush_every or \
+                    time.time() - self._flushed >= self.flush_seconds):
+                self._flush_locked()
+
+        return None if row is None else pickle.loads(row[0])
+
+    def flush(self):
+        """ Write the counters and access times collected by this process """
+        with self._pending_lock:
+            if(self._pending_pid != os.getpid()):
+                self._reset_pending()
+            self._flush_locked()
+
+    def _flush_locked(self):
+        pending= self._pending
+        self._pending= {"hits": 0, "misses": 0, "accessed": {}}
+        self._flushed= time.time()
+        if(not (pending["hits"] or pending["misses"])):
+            return
+
+        with self._connection() as conn:
+            conn.executemany(
+                "UPDATE counters SET value=value+? WHERE name=?",
+                [(pending["hits"], "hits"), (pending["misses"], "misses")]
+            )
+            conn.executemany(
+                "UPDATE entries SET last_access=MAX(last_access, ?) "
+                "WHERE version=? AND country=? AND metric=?",
+                [
+                    (accessed, *key)
+                    for key, accessed in pending["accessed"].items()
+                ]
+            )
+
+    def put(self, version, country, metric, value):
+        """ Store a value, evict least recently used entries beyond the bounds
+        """
+        blob= pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (version, country, metric, blob, len(blob), time.time())
+            )
+
+            n_entries, n_bytes= conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+            if(n_entries <= self.max_entries and n_bytes <= self.max_bytes):
+                return
+
+            # Walk entries from least to most recently used
+            evict= []
+            for row in conn.execute(
+                "SELECT rowid, size FROM entries ORDER BY last_access ASC"
+            ):
+                if(n_entries <= self.max_entries and \
+                        n_bytes <= self.max_bytes):
+                    break
+                evict.append((row[0],))
+                n_entries-= 1
+                n_bytes-= row[1]
+
+            conn.executemany("DELETE FROM entries WHERE rowid=?", evict)
+
+    def invalidate(self, version):
+        """ Drop all entries which belong to other dataset versions """
+        with self._connection() as conn:
+            conn.execute("DELETE FROM entries WHERE version!=?", (version,))
+
+    def stats(self):
+        """ Hit and miss counters, number of entries and their total size """
+        self.flush()
+        conn= self._connection()
+        stats= dict(
+            conn.execute("SELECT name, value FROM counters").fetchall()
+        )
+        stats["entries"], stats["bytes"]= conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+
+        return stats
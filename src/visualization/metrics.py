@@ -0,0 +1,103 @@
+# Imports
+import os, glob, time, functools
+
+# Environment variables naming the folder in which prometheus_client shares
+# metrics between processes, the lower case name is read by older versions
+MULTIPROC_ENV= ["PROMETHEUS_MULTIPROC_DIR", "prometheus_multiproc_dir"]
+
+# Upper bounds of the response size buckets in bytes, 256 B to 16 MB
+SIZE_BUCKETS= [4**idx for idx in range(4, 13)]
+
+
+#==============================================================================
+def enable_multiprocess(metrics_dir):
+    """ Share dashboard metrics between server processes through a folder
+
+    Must be called before prometheus_client is imported, i.e. before the
+    dashboard is created. Files of earlier runs are removed.
+
+    Parameters:
+    ----------
+    metrics_dir: URI-like
+        folder for the metric files of all processes
+    """
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+        os.remove(path)
+
+    for name in MULTIPROC_ENV:
+        os.environ[name]= metrics_dir
+
+
+#==============================================================================
+def multiprocess_dir():
+    """ Folder shared by all server processes, None in single-process mode """
+    for name in MULTIPROC_ENV:
+        if(os.environ.get(name)):
+            return os.environ[name]
+
+    return None
+
+
+#==============================================================================
+class DashboardMetrics:
+    """ Callback latencies and response sizes of the dashboard
+
+    Observing a value updates a histogram in memory, or in a memory-mapped
+    file shared by all gunicorn workers if enable_multiprocess was called,
+    so it is cheap enough for every request. The metrics of all processes
+    are collected when /metrics is requested.
+    """
+
+    def __init__(self):
+        from prometheus_client import CollectorRegistry, Histogram
+
+        # Own registry, so more than one app can be created in a process
+        self.registry= CollectorRegistry()
+        self.callback_seconds= Histogram(
+            "dashboard_callback_seconds", "Latency of dashboard callbacks",
+            ["callback"], registry=self.registry
+        )
+        self.response_bytes= Histogram(
+            "dashboard_response_bytes", "Size of response payloads",
+            ["endpoint"], buckets=SIZE_BUCKETS, registry=self.registry
+        )
+
+    def timed_callback(self, func):
+        """ Decorator observing the latency of a callback under its name """
+        histogram= self.callback_seconds.labels(func.__name__)
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start= time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+
+        return timed
+
+    def observe_response(self, endpoint, response):
+        """ Observe the payload size of a response, unless it is streamed """
+        size= response.calculate_content_length()
+        if(size is not None):
+            self.response_bytes.labels(endpoint).observe(size)
+
+    def exposition(self):
+        """ Metrics of all processes in the Prometheus text format
+
+        Returns:
+        -------
+        payload: bytes
+        content_type: string
+        """
+        from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, \
+            generate_latest
+
+        registry= self.registry
+        if(multiprocess_dir() is not None):
+            from prometheus_client import multiprocess
+            registry= CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+
+        return generate_latest(registry), CONTENT_TYPE_LATEST
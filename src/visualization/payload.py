@@ -0,0 +1,277 @@
+""" Downsampling and compact encoding of the traces sent to the browser
+"""
+import json
+
+import numpy as np
+
+# Points per trace if the width of the graph is not known
+MAX_POINTS= 1000
+# Bounds of the points per trace derived from the width of the graph
+WIDTH_POINTS= (100, 4000)
+# Decimals kept of the plotted values
+DECIMALS= 3
+
+
+#==============================================================================
+def points_for_width(width):
+    """ Number of points per trace for a graph of width pixels, one per pixel
+
+    Parameters:
+    ----------
+    width: int
+        width of the graph in pixels, None if not known
+
+    Returns:
+    -------
+    max_points: int
+    """
+    if(not width):
+        return MAX_POINTS
+
+    return int(min(max(width, WIDTH_POINTS[0]), WIDTH_POINTS[1]))
+
+
+#==============================================================================
+def lttb_indices(x, y, n_out):
+    """ Positions of the points kept by Largest-Triangle-Three-Buckets
+
+    The first and last points are kept; the points in between are split
+    into n_out-2 buckets and of every bucket the point is kept which forms
+    the largest triangle with the point kept of the previous bucket and the
+    average of the next bucket, so peaks and dips survive. Bucket averages
+    are computed for all buckets at once from cumulative sums.
+
+    Parameters:
+    ----------
+    x, y: numpy Arrays
+        finite coordinates, x ascending
+    n_out: int
+        number of points kept
+
+    Returns:
+    -------
+    indices: numpy Array
+        ascending positions, all positions if there are at most n_out points
+    """
+    n= len(x)
+    if(n_out >= n or n_out < 3):
+        return np.arange(n)
+
+    edges= np.linspace(1, n-1, n_out-1).astype(np.int64)
+    lengths= np.diff(edges)
+    cum_x= np.r_[0, np.cumsum(x)]
+    cum_y= np.r_[0, np.cumsum(y)]
+    avg_x= (cum_x[edges[1:]] - cum_x[edges[:-1]])/lengths
+    avg_y= (cum_y[edges[1:]] - cum_y[edges[:-1]])/lengths
+    # The last bucket looks ahead to the last point
+    next_x= np.r_[avg_x[1:], x[-1]]
+    next_y= np.r_[avg_y[1:], y[-1]]
+
+    indices= np.empty(n_out, dtype=np.int64)
+    indices[0], indices[-1]= 0, n-1
+    kept= 0
+    for bucket in range(n_out-2):
+        lower, upper= edges[bucket], edges[bucket+1]
+        area= np.abs(
+            (x[kept] - next_x[bucket])*(y[lower:upper] - y[kept])
+            - (x[kept] - x[lower:upper])*(next_y[bucket] - y[kept])
+        )
+        kept= lower + int(np.argmax(area))
+        indices[bucket+1]= kept
+
+    return indices
+
+
+#==============================================================================
+def as_numbers(x):
+    """ x as float64, dates as milliseconds since the epoch """
+    x= np.asarray(x)
+    if(np.issubdtype(x.dtype, np.datetime64)):
+        return x.astype("datetime64[ms]").astype(np.int64).astype(np.float64)
+
+    return x.astype(np.float64)
+
+
+#==============================================================================
+def parse_range(value):
+    """ Bound of an axis range in relayoutData as a number, dates in ms """
+    if(isinstance(value, str)):
+        date= np.datetime64(value.replace(" ", "T"), "ms")
+        return float(date.astype(np.int64))
+
+    return float(value)
+
+
+#==============================================================================
+def zoom_range(relayout_data):
+    """ x-axis range the user zoomed into
+
+    Parameters:
+    ----------
+    relayout_data: dict
+        relayoutData of a dcc.Graph, None before any interaction
+
+    Returns:
+    -------
+    x_range: tuple of floats
+        (lower, upper), dates as milliseconds since the epoch; None when the
+        whole axis is shown
+    """
+    if(not relayout_data or relayout_data.get("xaxis.autorange")):
+        return None
+
+    try:
+        if("xaxis.range" in relayout_data):
+            lower, upper= relayout_data["xaxis.range"]
+        else:
+            lower= relayout_data["xaxis.range[0]"]
+            upper= relayout_data["xaxis.range[1]"]
+        return parse_range(lower), parse_range(upper)
+    except (KeyError, ValueError, TypeError):
+        return None
+
+
+#==============================================================================
+def view_zoom(zoom, axis, relayout_data, zoomed):
+    """ Zoom of the x-axis to render, kept per axis
+
+    relayoutData keeps the last zoom of the graph, also after the figure was
+    replaced by one with another x-axis (dates vs. days since a threshold,
+    another metric or dataset version, on which the browser autoscales). A
+    zoom therefore only counts if the graph itself triggered the callback
+    while it showed the same axis, and it is dropped as soon as the axis
+    changes.
+
+    Parameters:
+    ----------
+    zoom: dict
+        zoom returned for the figure on screen, None before the first one
+    axis: string
+        identity of the x-axis of the figure to render, e.g. its uirevision
+    relayout_data: dict
+        relayoutData of the graph
+    zoomed: bool
+        the graph triggered the callback (relayoutData changed)
+
+    Returns:
+    -------
+    zoom: dict
+        "axis" and "range" (see zoom_range, as a list, None for the whole
+        axis) of the figure to render, to be passed in on the next call
+    """
+    same_axis= zoom is None or zoom.get("axis") == axis
+    x_range= zoom.get("range") if(zoom is not None and same_axis) else None
+
+    if(zoomed and same_axis and relayout_data):
+        if(relayout_data.get("xaxis.autorange")):
+            x_range= None
+        elif(any(key.startswith("xaxis.range") for key in relayout_data)):
+            x_range= zoom_range(relayout_data)
+        # Other changes (y-axis zoom, autosize) keep the x-axis range
+
+    return {
+        "axis": axis, "range": list(x_range) if x_range is not None else None
+    }
+
+
+#==============================================================================
+def downsample_trace(x, y, max_points, x_range=None):
+    """ Reduce a trace to at most max_points points of the visible range
+
+    Parameters:
+    ----------
+    x, y: numpy Arrays
+        trace, x ascending (dates or numbers)
+    max_points: int
+        number of points kept, None to keep every point
+    x_range: tuple of floats
+        visible range, see zoom_range; None for the whole trace
+
+    Returns:
+    -------
+    x, y: numpy Arrays
+        kept points; NaN and infinite values (which are not drawn) are 
+        dropped if the trace had to be reduced
+    """
+    if(x_range is not None and len(x)):
+        # Visible points and one neighbour on each side, so lines reach the
+        # edges
+        numbers= as_numbers(x)
+        lower= max(np.searchsorted(numbers, x_range[0], side="left") - 1, 0)
+        upper= np.searchsorted(numbers, x_range[1], side="right") + 1
+        x, y= x[lower:upper], y[lower:upper]
+
+    if(max_points is None or len(x) <= max_points):
+        return x, y
+
+    valid= np.isfinite(y)
+    x, y= x[valid], y[valid]
+    indices= lttb_indices(as_numbers(x), y, max_points)
+
+    return x[indices], y[indices]
+
+
+#==============================================================================
+def encode_values(values, decimals=DECIMALS):
+    """ Plain list of rounded numbers, None for NaN
+
+    Integral values are written without a fraction, dates as milliseconds
+    since the epoch (plotly reads these as dates on a date axis), so no
+    per-point date strings are sent.
+    """
+    values= np.asarray(values)
+    if(np.issubdtype(values.dtype, np.datetime64)):
+        return values.astype("datetime64[ms]").astype(np.int64).tolist()
+    if(np.issubdtype(values.dtype, np.integer)):
+        return values.tolist()
+
+    values= np.round(values.astype(np.float64), decimals)
+    finite= np.isfinite(values)
+    if(finite.all() and (values == np.round(values)).all()):
+        return values.astype(np.int64).tolist()
+
+    encoded= values.tolist()
+    if(not finite.all()):
+        for position in np.flatnonzero(~finite):
+            encoded[position]= None
+
+    return encoded
+
+
+#==============================================================================
+def use_fast_json():
+    """ Make plotly, and Dash which serializes responses through it, use orjson
+
+    orjson serializes large numeric lists several times faster than the
+    json module. Nothing changes if orjson is not installed or plotly does
+    not support choosing the JSON engine.
+
+    Returns:
+    -------
+    engine: string
+        "orjson" or "json"
+    """
+    try:
+        import orjson
+        import plotly.io.json as plotly_json
+        plotly_json.config.default_engine= "orjson"
+        return "orjson"
+    except (ImportError, AttributeError):
+        return "json"
+
+
+#==============================================================================
+def serialize_figure(figure):
+    """ Serialize a figure as Dash serializes callback responses
+
+    Returns:
+    -------
+    payload: bytes
+    """
+    try:
+        from plotly.io.json import to_json_plotly
+    except ImportError:
+        from plotly.utils import PlotlyJSONEncoder
+        return json.dumps(figure, cls=PlotlyJSONEncoder).encode()
+
+    return to_json_plotly(figure).encode()
@@ -0,0 +1,120 @@
+# Imports
+import multiprocessing, tempfile
+import argparse
+
+from gunicorn.app.base import BaseApplication
+
+#==============================================================================
+# COMMAND LINE ARGUMENTS
+# Create parser object
+cl_parser= argparse.ArgumentParser(
+    description="Serve the COVID-19 dashboard with multiple worker processes. \
+        Arguments of visualize.py (--data_path, --input_format, ...) are \
+        passed through. Workers share the dataset loaded at startup and map \
+        one copy of every version published later."
+)
+
+# ARGUMENTS
+# Bind address
+cl_parser.add_argument(
+    "--host", action="store", default="0.0.0.0",
+    help="Address to listen on"
+)
+cl_parser.add_argument(
+    "--port", action="store", default="8080",
+    help="Port to listen on"
+)
+# Worker processes
+cl_parser.add_argument(
+    "--workers", action="store", type=int,
+    default=min(multiprocessing.cpu_count(), 4),
+    help="Number of worker processes"
+)
+# Threads per worker
+cl_parser.add_argument(
+    "--threads", action="store", type=int, default=4,
+    help="Number of request threads per worker process"
+)
+# Request timeout
+cl_parser.add_argument(
+    "--timeout", action="store", type=int, default=60,
+    help="Seconds after which a silent worker is restarted"
+)
+# Metrics shared by the workers
+cl_parser.add_argument(
+    "--metrics_dir", action="store", default=None,
+    help="Folder in which the workers share the metrics served under \
+        /metrics (default: a new temporary folder)"
+)
+
+
+#==============================================================================
+class DashboardApplication(BaseApplication):
+    """ Gunicorn application serving the dashboard
+
+    The dashboard, and with it the dataset, is created once in the
+    master process before workers are forked (preload_app). Workers therefore
+    share one read-only copy of the dataset: numeric columns of a memory-mapped
+    feather dataset (--input_format feather) are backed by the page cache, and
+    the buffers of a parsed CSV dataset are shared copy-on-write.
+
+    A newly published version is loaded by the watcher of every worker (see
+    visualize.create_app). Memory-mapped feather files stay shared through
+    the page cache. A CSV dataset is converted to feather once, by the first
+    worker, and mapped by all of them (see visualize.shared_copy), so it is
+    not parsed into the memory of every worker.
+
+    Parameters:
+    ----------
+    options: dict
+        gunicorn settings
+    app_options: dict
+        keyword arguments of visualize.create_app
+    """
+
+    def __init__(self, options, app_options):
+        self.options= options
+        self.app_options= app_options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from src.visualization.visualize import create_app
+
+        return create_app(**self.app_options).server
+
+
+#==============================================================================
+def main(argv=None):
+    """ Entry point of the covid-serve command """
+    from src.visualization import visualize
+    from src.visualization.metrics import enable_multiprocess
+
+    # Collect command-line arguments, other arguments are left to visualize.py
+    cl_options, app_argv= cl_parser.parse_known_args(argv)
+    app_options= visualize.cl_parser.parse_args(app_argv)
+
+    options= {
+        "bind": "{0}:{1}".format(cl_options.host, cl_options.port),
+        "workers": cl_options.workers,
+        "threads": cl_options.threads,
+        "worker_class": "gthread",
+        "timeout": cl_options.timeout,
+        "preload_app": True,
+    }
+
+    # Every worker observes its own requests, /metrics adds them up
+    if(not app_options.no_metrics):
+        enable_multiprocess(
+            cl_options.metrics_dir or tempfile.mkdtemp(prefix="covid_metrics_")
+        )
+
+    DashboardApplication(options, vars(app_options)).run()
+
+
+#==============================================================================
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,20 @@ import pandas as pd
 import plotly.graph_objects as go
 
 import dash
+import flask
 import dash_core_components as dcc
 import dash_bootstrap_components as dbc
 import dash_html_components as dhtml
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 
-import os, argparse
+import os, argparse, threading, time
+
+from src.data.storage import FORMATS, processed_path, read_processed, \
+    read_settings
+from src.data.publish import current_version, version_data_path
+from src.visualization.cache import TraceCache, dataset_version
+from src.visualization.payload import downsample_trace, encode_values, \
+    points_for_width, use_fast_json, view_zoom
 
 #==============================================================================
 # COMMAND LINE ARGUMENTS
@@ -23,166 +31,1061 @@ cl_parser.add_argument(
     "--data_path", action="store", default="data/",
     help="Path to data folder"
 )
+# Input format
+cl_parser.add_argument(
+    "--input_format", action="store", default="csv", choices=FORMATS,
+    help="Format in which the processed dataset is read, feather files are \
+        memory-mapped"
+)
+# Trace cache
+cl_parser.add_argument(
+    "--cache_path", action="store", default=None,
+    help="Path to the trace cache database shared by all server processes \
+        (default: <data_path>cache/traces.sqlite)"
+)
+cl_parser.add_argument(
+    "--cache_entries", action="store", type=int, default=2048,
+    help="Maximum number of cached traces"
+)
+cl_parser.add_argument(
+    "--cache_bytes", action="store", type=int, default=64*1024**2,
+    help="Maximum total size of cached traces in bytes"
+)
+cl_parser.add_argument(
+    "--no_cache", action="store_true",
+    help="Disable the trace cache"
+)
+# Metrics
+cl_parser.add_argument(
+    "--no_metrics", action="store_true",
+    help="Do not serve callback latencies and response sizes under /metrics"
+)
+# Client-side figures
+cl_parser.add_argument(
+    "--client_side", action="store_true",
+    help="Send the timelines of all metrics of the selected countries to the \
+        browser once; switching metric, alignment or scale is drawn there \
+        without a request"
+)
+# Downsampling
+cl_parser.add_argument(
+    "--max_points", action="store", type=int, default=None,
+    help="Maximum number of points per timeline (default: one per pixel of \
+        the graph's width)"
+)
+# Dataset watcher
+cl_parser.add_argument(
+    "--watch_interval", action="store", type=float, default=60,
+    help="Seconds between checks for a newly published dataset, 0 disables \
+        reloading"
+)
 
-# Collect command-line arguments
-cl_options= cl_parser.parse_args()
-
-df_JH_data= pd.read_csv(cl_options.data_path + 'processed/COVID_final_set.csv', sep=';')
-
-# Create figure
-fig= go.Figure()
-
-# Create Dash App
-app= dash.Dash(external_stylesheets=[dbc.themes.LUX])
-app.title= "COVID-19 Dashboard"
-
-# Country List Select
-ctry_input= dbc.FormGroup([
-    dhtml.H5("Select Countries"),
-    dcc.Dropdown(
-        id="country_dropdown",
-        options=[ {'label': each, 'value': each} for each in df_JH_data['country'].unique() ],
-        value=['Nigeria', 'Germany'],
-        multi=True
-    )    
-])
-
-# Visualization Select
-vis_input= dbc.FormGroup([
-    dhtml.H5("Select Timeline"),
-    dcc.Dropdown(
-        id="visual_time",
-        options=[
-            {'label': 'Confirmed Cases', 'value': 'confirmed'},
-            {'label': 'Confirmed Cases Filtered', 'value': 'confirmed_filtered'},
-            {'label': 'Doubling Rate of Confirmed Cases', 'value': 'confirmed_DR'},
-            {'label': 'Doubling Rate of Confirmed Cases Filtered', 'value': 'confirmed_filtered_DR'}
-        ],
-        value='confirmed',
-        multi=False,
-        clearable=False,
-        searchable=False
-    )    
-])
-
-#Create layout
-app.layout= dbc.Container(
-    fluid=True,
-    children=[
-        # Navbar
-        dbc.NavbarSimple(className="",dark=True,expand="sm",
-            style={ "background": "linear-gradient(120deg,#11a048,#01727a)" },
-            children=[
-                dbc.NavItem(dbc.NavLink("Back to faaizz.com", href="https://faaizz.com"))
-            ],
-            brand="COVID-19 Dashboard"
-        ),
-        # Header
-        dhtml.Br(),
-        dhtml.P(children=[
-            "A COVID-19 Dashboard Prototype developed using the Cross Industry \
-            Standard Process for Data Mining. The data is sourced from ",
-            dhtml.A("Johns Hopkings University", href="https://github.com/CSSEGISandData/COVID-19"),
-            ", a Savitsky-Golay Filter is used for filtering (in the filtered versions of the timelines), \
-            and the Doubling Times (the estimated number of days it will take for the current number of \
-            confirmed cases to get doubled) are calculated using Linear Regression over a window of 3 days."
-        ]),
-        dhtml.Br(),dhtml.Br(),
-        
-        # Body
-        dbc.Row([
-            dbc.Col(md=6, lg=4, children=[ctry_input]),
-            dbc.Col(md=6, lg=4, children=[vis_input]),
-            dhtml.Br(),dhtml.Br(),
-            # Plot
-            dbc.Col(sm=12, children=[
-                dbc.Col(dhtml.H4("Plots", className="text-center"), sm=12),
-                dcc.Graph(figure=fig, id="main_figure")
-            ]
+
+# Doubling times in days of the reference curves of aligned timelines
+DOUBLING_DAYS= [3, 7, 14]
+
+# Metrics of the timeline dropdown
+VISUALS= [
+    'confirmed', 'confirmed_filtered', 'confirmed_DR', 'confirmed_filtered_DR'
+]
+
+# Scales of the y-axis which can be chosen instead of the automatic one
+Y_SCALES= ['linear', 'log']
+
+# Clientside callback drawing the figure from the store of build_series_store,
+# the browser's counterpart of build_figure
+CLIENT_FIGURE= """
+function(store, visual_name, align, y_scale) {
+    if(!store) {
+        return window.dash_clientside.no_update;
+    }
+    align= align || 0;
+
+    var layout= JSON.parse(
+        JSON.stringify(store.layouts[visual_name + ':' + align])
+    );
+    if(y_scale === 'linear' || y_scale === 'log') {
+        layout.yaxis.title= layout.yaxis.title.replace(
+            '(' + layout.yaxis.type + '-scale)', '(' + y_scale + '-scale)'
+        );
+        layout.yaxis.type= y_scale;
+    }
+
+    // Extent of the aligned timelines, for the reference curves
+    var traces= [], alignedDays= 0, maxValue= 0;
+    store.regions.forEach(function(region) {
+        var x= region.series[visual_name].x, y= region.series[visual_name].y;
+        if(align) {
+            var crossing= region.crossings[align];
+            if(crossing === undefined) {
+                return;
+            }
+            var first= 0;
+            while(first < x.length && x[first] < crossing) {
+                first++;
+            }
+            x= x.slice(first).map(function(date) {
+                return Math.round((date - crossing)/86400000);
+            });
+            y= y.slice(first);
+            if(x.length) {
+                alignedDays= Math.max(alignedDays, x[x.length-1] + 1);
+            }
+            y.forEach(function(value) {
+                if(value !== null && value > maxValue) {
+                    maxValue= value;
+                }
+            });
+        }
+        traces.push({
+            x: x, y: y, mode: 'markers+lines', opacity: 0.8, name: region.name
+        });
+    });
+
+    // Reference doubling curves of counts, see doubling_traces
+    if(align && visual_name.indexOf('DR') < 0 && traces.length) {
+        var references= store.doubling_days.map(function(days) {
+            var x= [], y= [];
+            for(var day= 0; day < alignedDays; day++) {
+                var value= align*Math.pow(2, day/days);
+                if(value > 2*Math.max(maxValue, align)) {
+                    break;
+                }
+                x.push(day);
+                y.push(value);
+            }
+            return {
+                x: x, y: y, mode: 'lines', line: {dash: 'dash', width: 1},
+                opacity: 0.6, name: 'doubling every ' + days + ' days'
+            };
+        });
+        traces= references.concat(traces);
+    }
+
+    return {data: traces, layout: layout};
+}
+"""
+
+
+#==============================================================================
+# DATASET
+def load_dataset(data_path, input_format="csv", share_csv=False):
+    """ Load the rollups of the currently published dataset
+
+    Falls back to the processed folder if no version was published. Only the
+    country, continent and world rollups and their threshold offsets are 
+    loaded; for a dataset without them (published before they existed), 
+    they are computed once here.
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    input_format: string
+        format in which the dataset is read, see storage.FORMATS
+    share_csv: bool
+        read a CSV dataset through a memory-mapped feather copy, which is 
+        shared by all processes loading the same version, see shared_copy
+
+    Returns:
+    -------
+    dataset: dict
+        rollups (see build_features.build_rollups) under "rollups", the 
+        offset of every (region, threshold) reached under "offsets" (see 
+        build_features.threshold_offsets), the thresholds under "thresholds",
+        the rows of every region under "positions" (see region_positions),
+        the doubling rate window the features were built with under 
+        "dr_window" (see build_features.feature_settings, 3 if unknown) 
+        and the version under "version"
+    """
+    version= current_version(data_path)
+    if(version is None):
+        version_path= data_path
+        version= dataset_version(
+                processed_path(data_path, 'COVID_final_set', fmt=input_format)
             )
-        ], className="align-items-center"
-        )        
-    ],
-)
+    else:
+        version_path= version_data_path(data_path, version)
 
-# Add callback for Dropdown
+    if(share_csv and input_format == "csv"):
+        version_path= shared_copy(data_path, version_path, version)
+        input_format= "feather"
 
-# Callback wrapper
-@app.callback(
-    Output("main_figure", "figure"),
-    [
-        Input("country_dropdown", "value"),
-        Input('visual_time', 'value')
-    ]
-)
-# Callback function
-def update_fig(selected_countries, visual_name):
+    df_rollups, df_offsets, settings= read_rollups(version_path, input_format)
+
+    return {
+        "rollups": df_rollups,
+        "offsets": dict(zip(
+            zip(df_offsets['region'], df_offsets['threshold'].astype(int)),
+            df_offsets['offset'].astype(int)
+        )),
+        "thresholds": sorted(df_offsets['threshold'].astype(int).unique()),
+        "positions": region_positions(df_rollups),
+        "dr_window": settings.get('dr_window', 3),
+        "version": version
+    }
+
+
+def read_rollups(version_path, input_format="csv"):
+    """ Rollups, threshold offsets and settings of a dataset, see load_dataset
+
+    Returns:
+    -------
+    df_rollups: pandas DataFrame
+    df_offsets: pandas DataFrame
+    settings: dict
+        settings the features were built with, empty if unknown
+    """
+    if(os.path.exists(processed_path(
+            version_path, 'COVID_rollup_set', fmt=input_format))):
+        df_rollups= read_processed(
+                version_path, 'COVID_rollup_set', fmt=input_format
+            )
+    else:
+        from src.features.build_features import build_rollups
+        df_rollups= build_rollups(read_processed(
+                version_path, 'COVID_final_set', fmt=input_format
+            ))
+
+    if(os.path.exists(processed_path(
+            version_path, 'COVID_alignment_set', fmt=input_format))):
+        df_offsets= read_processed(
+                version_path, 'COVID_alignment_set', fmt=input_format
+            )
+    else:
+        from src.features.build_features import threshold_offsets
+        df_offsets= threshold_offsets(df_rollups)
+
+    settings= read_settings(version_path, 'COVID_rollup_set') or \
+        read_settings(version_path, 'COVID_final_set') or {}
+
+    return df_rollups, df_offsets, settings
+
+
+def shared_copy(data_path, version_path, version):
+    """ Feather copy of a CSV dataset, memory-mapped by every process reading
+    it
+
+    Gunicorn workers reload a newly published version each on their own (see
+    create_app), and a parsed CSV dataset is private to the worker that 
+    parsed it. Instead, the first worker converts the version to feather 
+    under <data_path>cache/datasets/<version>/ and every worker maps these 
+    files, whose pages are shared through the page cache. The copy is built 
+    in a folder of its own and renamed into place; a worker that finishes 
+    second discards its copy. Copies of other versions are removed.
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    version_path: URI-like
+        data path of the CSV dataset
+    version: string
+        version of the dataset
+
+    Returns:
+    -------
+    copy_path: URI-like
+        data path of the feather copy
+    """
+    from src.data.storage import remove_path, write_processed
+
+    cache_path= data_path + 'cache/datasets/'
+    copy_path= cache_path + version + '/'
+
+    if(not os.path.isdir(copy_path)):
+        df_rollups, df_offsets, settings= read_rollups(version_path, 'csv')
+
+        tmp_path= cache_path + '{0}.tmp{1}/'.format(version, os.getpid())
+        remove_path(tmp_path)
+        os.makedirs(tmp_path + 'processed')
+        write_processed(
+            df_offsets, tmp_path, 'COVID_alignment_set', formats=['feather']
+        )
+        write_processed(
+            df_rollups, tmp_path, 'COVID_rollup_set', formats=['feather'],
+            settings=settings or None
+        )
+
+        try:
+            os.replace(tmp_path.rstrip('/'), copy_path.rstrip('/'))
+        except OSError:
+            # Another worker was faster
+            remove_path(tmp_path)
+
+    # Mapped files of older copies stay readable until they are unmapped
+    for name in os.listdir(cache_path):
+        if(name != version and '.tmp' not in name):
+            try:
+                remove_path(cache_path + name)
+            except OSError:
+                pass
+
+    return copy_path
+
+
+def region_positions(df_rollups):
+    """ Rows of every region in the rollups, which hold each region in one
+    block
+
+    Parameters:
+    ----------
+    df_rollups: pandas DataFrame
+        rollups, see build_features.build_rollups
+
+    Returns:
+    -------
+    positions: dict
+        region -> (start, stop) row positions
+    """
+    region_idx, regions= pd.factorize(df_rollups['region'], sort=False)
+    starts= np.flatnonzero(np.r_[True, region_idx[1:] != region_idx[:-1]])
+    # Regions must be contiguous, as written by build_rollups
+    assert len(starts) == len(regions)
+    stops= np.r_[starts[1:], len(region_idx)]
+
+    return dict(zip(regions, zip(starts.tolist(), stops.tolist())))
+
+
+def region_timeline(df_rollups, region, visual_name, positions=None):
+    """ Slice the precomputed timeline of a country, continent or the world
+
+    Parameters:
+    ----------
+    df_rollups: pandas DataFrame
+        rollups, sorted by date within each region
+    region: string
+        country name, continent name or "World"
+    visual_name: string
+        key to column which holds the metric
+    positions: dict
+        see region_positions, rows are sliced instead of matching every 
+        region name if given
+
+    Returns:
+    -------
+    timeline: dict
+        dates under "x" and values under "y", as numpy arrays
+    """
+
+    if(positions is not None):
+        start, stop= positions.get(region, (0, 0))
+        df_plot= df_rollups.iloc[start:stop]
+    else:
+        # Selected region mask
+        df_plot= df_rollups[df_rollups['region']== region]
+
+    return {
+        "x": df_plot['date'].to_numpy(),
+        "y": df_plot[visual_name].to_numpy()
+    }
+
+
+def doubling_traces(threshold, n_days, max_value):
+    """ Reference curves threshold*2^(t/T) for the doubling times in
+    DOUBLING_DAYS
+
+    Parameters:
+    ----------
+    threshold: int
+        value of the curves on day 0
+    n_days: int
+        number of days of the longest aligned timeline
+    max_value: float
+        curves stop once they exceed twice this value
+
+    Returns:
+    -------
+    traces: list of dicts
+        one dashed line per doubling time
+    """
+
+    days= np.arange(n_days)
+    traces= []
+    for doubling_days in DOUBLING_DAYS:
+        values= threshold*np.power(2.0, days/doubling_days)
+        shown= values <= 2*max(max_value, threshold)
+        traces.append({
+            "x": encode_values(days[shown]),
+            "y": encode_values(values[shown]),
+            "mode": "lines",
+            "line": {"dash": "dash", "width": 1},
+            "opacity": 0.6,
+            "name": "doubling every {0} days".format(doubling_days)
+        })
+
+    return traces
+
+
+def cached_timeline(current, trace_cache, region, visual_name):
+    """ Timeline of a region from the trace cache, sliced from the rollups on
+    a miss
+
+    Parameters:
+    ----------
+    current: dict
+        dataset as returned by load_dataset
+    trace_cache: TraceCache
+        cache of region timelines, None to disable caching
+    region: string
+        country, continent or "World" name
+    visual_name: string
+        key to column which holds the metric
+
+    Returns:
+    -------
+    timeline: dict
+        see region_timeline
+    """
+
+    timeline= None
+    if(trace_cache is not None):
+        timeline= trace_cache.get(current["version"], region, visual_name)
+
+    if(timeline is None):
+        timeline= region_timeline(
+                current["rollups"], region, visual_name,
+                positions=current.get("positions")
+            )
+        if(trace_cache is not None):
+            trace_cache.put(current["version"], region, visual_name, timeline)
+
+    return timeline
+
+
+def figure_axis(visual_name, align, version):
+    """ Identity of the x-axis of a figure, its uirevision
+
+    Zoom is kept while it does not change, see payload.view_zoom.
+    """
+    return "{0}:{1}:{2}".format(visual_name, align or 0, version)
+
+
+def figure_layout(visual_name, align, version, y_scale=None, dr_window=3):
+    """ Layout of the figure of a metric
+
+    Parameters:
+    ----------
+    visual_name: string
+        key to column which holds the metric
+    align: int
+        threshold the timelines are aligned at, None (or 0) for dates
+    version: string
+        version of the dataset, zoom is kept while it does not change
+    y_scale: string
+        'linear' or 'log', None (or 'auto') for log-scale doubling rates 
+        and aligned counts and linear-scale counts otherwise
+    dr_window: int
+        number of days in each doubling rate regression window
+
+    Returns:
+    -------
+    layout: dict
+    """
 
     # Title
     if('DR' in visual_name):
         my_yaxis={
             'type': 'log',
-            'title': 'Approximated doubling rate over 3 days (log-scale)'
+            'title': 'Approximated doubling rate over {0} days \
+(log-scale)'.format(dr_window)
         }
     
+    elif(align): 
+        # Doubling curves are straight lines
+        my_yaxis={
+            'type': 'log',
+            'title': 'Confirmed cases (log-scale)'
+        }
+
     else: 
         my_yaxis={
             'type': 'linear',
             'title': 'Confirmed cases (linear-scale)'
         }
 
+    if(y_scale in Y_SCALES):
+        my_yaxis={
+            'type': y_scale,
+            'title': my_yaxis['title'].replace(
+                '({0}-scale)'.format(my_yaxis['type']),
+                '({0}-scale)'.format(y_scale)
+            )
+        }
+
+    # Layout, zoom is kept when the figure is replaced
+    return dict(
+        uirevision=figure_axis(visual_name, align, version),
+        xaxis_title="Days since {0} confirmed cases".format(align) if align
+            else "Timeline",
+        xaxis={
+            "type": "linear" if align else "date",
+            "tickangle": -75,
+            "nticks": 20,
+            "tickfont": dict(size=14, color="#7f7f7f")
+        },
+        yaxis=my_yaxis
+    )
+
+
+def build_figure(current, trace_cache, selected_countries, visual_name,
+        align=None, max_points=None, x_range=None, y_scale=None):
+    """ Figure with one timeline per selected country
+
+    Aligned timelines start on the day a region first reached align 
+    confirmed cases, looked up in the precomputed offsets of the dataset; 
+    regions which never reached it are left out. Timelines are reduced to 
+    the visible range and max_points points (see payload.downsample_trace) 
+    and sent as plain lists of numbers, dates as milliseconds.
+
+    Parameters:
+    ----------
+    current: dict
+        dataset as returned by load_dataset
+    trace_cache: TraceCache
+        cache of region timelines, None to disable caching
+    selected_countries: list of strings
+        country, continent or "World" names
+    visual_name: string
+        key to column which holds the metric
+    align: int
+        plot against days since this number of confirmed cases instead of 
+        dates, one of current["thresholds"]; None (or 0) for dates
+    max_points: int
+        maximum number of points per timeline, None for all points
+    x_range: tuple of floats
+        visible x-axis range, see payload.zoom_range; None for the whole axis
+    y_scale: string
+        scale of the y-axis, see figure_layout
+
+    Returns:
+    -------
+    figure: dict
+        plotly figure with "data" and "layout"
+    """
+
     #Traces
     traces= []
+    # Extent of the aligned timelines, for the reference curves
+    aligned_days, max_value= 0, 0
     for country in selected_countries:
 
-        # Selected country mask
-        df_plot= df_JH_data[df_JH_data['country']== country]
-
-        # Aggregate country-wide data
-        if 'DR' in visual_name:
-            # If doubling rate is being calculated, use the mean over the states
-            df_plot= df_plot[[
-                'date', 'state', 'country', 'confirmed', 'confirmed_filtered', 
-                'confirmed_DR', 'confirmed_filtered_DR'
-                ]].groupby(['country', 'date']).agg(np.mean).reset_index()
-
-        else:
-            # Otherwise, sum up the values for all states
-            df_plot= df_plot[[
-                'date', 'state', 'country', 'confirmed', 'confirmed_filtered', 
-                'confirmed_DR', 'confirmed_filtered_DR'
-                ]].groupby(['country', 'date']).agg(np.sum).reset_index()
+        timeline= cached_timeline(current, trace_cache, country, visual_name)
 
+        x, y= timeline["x"], timeline["y"]
+        if(align):
+            offset= current["offsets"].get((country, align))
+            if(offset is None):
+                continue
+            y= y[offset:]
+            x= np.arange(len(y))
+            aligned_days= max(aligned_days, len(y))
+            max_value= max(max_value, np.nanmax(y, initial=0))
+        x, y= downsample_trace(x, y, max_points, x_range)
 
         # Add a trace
         traces.append(
             {
-                "x": df_plot.date,
-                "y": df_plot[visual_name],
+                "x": encode_values(x),
+                "y": encode_values(y),
                 "mode":"markers+lines",
                 "opacity": 0.8,
                 "name": country
             }
         )
 
-    # Layout
-    fig_design= dict(
-        xaxis_title="Timeline",
-        xaxis={
-            "tickangle": -75,
-            "nticks": 20,
-            "tickfont": dict(size=14, color="#7f7f7f")
-        },
-        yaxis=my_yaxis
-    )
+    # Reference doubling curves of counts
+    if(align and 'DR' not in visual_name and traces):
+        traces= doubling_traces(align, aligned_days, max_value) + traces
 
     return {
         "data": traces,
-        "layout": fig_design
+        "layout": figure_layout(
+            visual_name, align, current["version"], y_scale,
+            dr_window=current.get("dr_window", 3)
+        )
     }
 
 
+def update_view(current, trace_cache, selected_countries, visual_name,
+        align=None, y_scale=None, relayout_data=None, zoomed=False, zoom=None,
+        max_points=None):
+    """ Figure of the server-side callback and the zoom it was rendered with
 
-if __name__ == "__main__":
+    Parameters:
+    ----------
+    current, trace_cache, selected_countries, visual_name, align, y_scale, 
+    max_points:
+        see build_figure
+    relayout_data, zoomed, zoom:
+        relayoutData of the graph, whether it triggered the callback and 
+        the zoom returned with the figure on screen, see payload.view_zoom
+
+    Returns:
+    -------
+    figure: dict
+        see build_figure
+    zoom: dict
+        to be passed in as zoom on the next call
+    """
+    zoom= view_zoom(
+        zoom, figure_axis(visual_name, align, current["version"]),
+        relayout_data, zoomed
+    )
+    figure= build_figure(
+        current, trace_cache, selected_countries or [], visual_name,
+        align=align, max_points=max_points, y_scale=y_scale,
+        x_range=tuple(zoom["range"]) if zoom["range"] is not None else None
+    )
+
+    return figure, zoom
+
+
+def build_series_store(current, trace_cache, selected_countries,
+        max_points=None):
+    """ Timelines of every metric of the selected regions, for the browser
+
+    Everything the clientside callback (CLIENT_FIGURE) needs to draw any 
+    metric, alignment and y-axis scale without asking the server again: 
+    the timelines of all VISUALS reduced to max_points points, the date at 
+    which each region crossed each threshold and the layouts of all 
+    metrics and alignments.
+
+    Parameters:
+    ----------
+    current: dict
+        dataset as returned by load_dataset
+    trace_cache: TraceCache
+        cache of region timelines, None to disable caching
+    selected_countries: list of strings
+        country, continent or "World" names
+    max_points: int
+        maximum number of points per timeline, None for all points
+
+    Returns:
+    -------
+    store: dict
+        "regions": list of dicts with the "name", the timeline of every 
+        metric under "series" (x in milliseconds) and the crossing dates 
+        (milliseconds) under "crossings" by threshold; "layouts" by 
+        "<metric>:<threshold>" (threshold 0 for dates) and "doubling_days"
+    """
+
+    regions= []
+    for region in selected_countries:
+        series= {}
+        for visual_name in VISUALS:
+            timeline= cached_timeline(
+                current, trace_cache, region, visual_name
+            )
+            x, y= downsample_trace(timeline["x"], timeline["y"], max_points)
+            series[visual_name]= {"x": encode_values(x), "y": encode_values(y)}
+
+        dates= timeline["x"]
+        crossings= {}
+        for threshold in current["thresholds"]:
+            offset= current["offsets"].get((region, threshold))
+            if(offset is not None and offset < len(dates)):
+                crossings[str(threshold)]= \
+                    encode_values(dates[offset:offset+1])[0]
+
+        regions.append({
+            "name": region, "series": series, "crossings": crossings
+        })
+
+    return {
+        "regions": regions,
+        "layouts": {
+            "{0}:{1}".format(visual_name, align): figure_layout(
+                visual_name, align, current["version"],
+                dr_window=current.get("dr_window", 3)
+            )
+            for visual_name in VISUALS
+            for align in [0] + list(current["thresholds"])
+        },
+        "doubling_days": DOUBLING_DAYS
+    }
+
+
+#==============================================================================
+# APP
+def create_app(data_path="data/", input_format="csv", cache_path=None,
+        cache_entries=2048, cache_bytes=64*1024**2, no_cache=False,
+        watch_interval=60, no_metrics=False, max_points=None,
+        client_side=False):
+    """ Create the dashboard
+
+    The dataset is loaded when the app is created, not when this module is
+    imported. Arguments correspond to the command-line arguments of 
+    the covid-dashboard command.
+
+    Parameters:
+    ----------
+    data_path: URI-like
+        Path to data folder
+    input_format: string
+        format in which the processed dataset is read
+    cache_path: URI-like
+        path to the trace cache database, <data_path>cache/traces.sqlite if
+        None
+    cache_entries: int
+        maximum number of cached traces
+    cache_bytes: int
+        maximum total size of cached traces in bytes
+    no_cache: bool
+        disable the trace cache
+    watch_interval: float
+        seconds between checks for a newly published dataset, 0 disables
+        reloading
+    no_metrics: bool
+        do not serve callback latencies and response sizes under /metrics, 
+        see metrics.DashboardMetrics
+    max_points: int
+        maximum number of points per timeline, one per pixel of the graph's 
+        width if None, see payload.points_for_width
+    client_side: bool
+        send the timelines of all metrics of the selected countries to the 
+        browser (see build_series_store), which draws the figure itself; 
+        the server is only asked when the selection changes
+
+    Returns:
+    -------
+    app: dash.Dash
+    """
+
+    # The dataset is swapped as a whole, requests hold on to the one they
+    # started with
+    state= {"dataset": load_dataset(data_path, input_format)}
+
+    # Trace cache
+    if(no_cache):
+        trace_cache= None
+    else:
+        trace_cache= TraceCache(
+                cache_path or data_path + 'cache/traces.sqlite',
+                max_entries=cache_entries, max_bytes=cache_bytes
+            )
+        # Drop traces of previous datasets
+        trace_cache.invalidate(state["dataset"]["version"])
+
+    def watch_dataset():
+        """ Poll the published version and swap in new datasets in the
+        background
+        """
+        while True:
+            time.sleep(watch_interval)
+
+            try:
+                version= current_version(data_path)
+                if(version is None or version == state["dataset"]["version"]):
+                    continue
+
+                # Workers map one feather copy of a CSV dataset
+                new_dataset= load_dataset(
+                        data_path, input_format, share_csv=True
+                    )
+                if(trace_cache is not None):
+                    trace_cache.invalidate(new_dataset["version"])
+                state["dataset"]= new_dataset
+                print("Loaded dataset version {0}.".format(
+                    new_dataset["version"]
+                ))
+
+            except Exception as err:
+                print("Reloading dataset failed: {0}".format(err))
 
+
+    # Create figure
+    fig= go.Figure()
+
+    # Serialize responses with orjson if installed
+    use_fast_json()
+
+    # Create Dash App
+    app= dash.Dash(external_stylesheets=[dbc.themes.LUX])
+    app.title= "COVID-19 Dashboard"
+
+    # Visualization Select
+    vis_input= dbc.FormGroup([
+        dhtml.H5("Select Timeline"),
+        dcc.Dropdown(
+            id="visual_time",
+            options=[
+                {'label': 'Confirmed Cases', 'value': 'confirmed'},
+                {
+                    'label': 'Confirmed Cases Filtered',
+                    'value': 'confirmed_filtered'
+                },
+                {
+                    'label': 'Doubling Rate of Confirmed Cases',
+                    'value': 'confirmed_DR'
+                },
+                {
+                    'label': 'Doubling Rate of Confirmed Cases Filtered',
+                    'value': 'confirmed_filtered_DR'
+                }
+            ],
+            value='confirmed',
+            multi=False,
+            clearable=False,
+            searchable=False
+        ),
+        dcc.RadioItems(
+            id="y_scale",
+            options=[
+                {'label': ' Automatic scale ', 'value': 'auto'},
+                {'label': ' Linear ', 'value': 'linear'},
+                {'label': ' Logarithmic ', 'value': 'log'}
+            ],
+            value='auto',
+            labelStyle={'display': 'inline-block', 'margin-right': '1em'}
+        )
+    ])
+
+    #Create layout, evaluated on every page load to pick up new countries
+    def serve_layout():
+
+        # Countries, then continents, then the world
+        df_rollups= state["dataset"]["rollups"]
+        regions= df_rollups.drop_duplicates('region')[['level', 'region']]
+
+        # Country List Select
+        ctry_input= dbc.FormGroup([
+            dhtml.H5("Select Countries"),
+            dcc.Dropdown(
+                id="country_dropdown",
+                options=[
+                    {
+                        'label': region + ' (continent)'
+                            if level == 'continent' else region,
+                        'value': region
+                    }
+                    for level, region in regions.itertuples(index=False)
+                ],
+                value=['Nigeria', 'Germany'],
+                multi=True
+            )    
+        ])
+
+        # Alignment Select, 0 plots against dates
+        align_input= dbc.FormGroup([
+            dhtml.H5("Align Timelines"),
+            dcc.Dropdown(
+                id="align_threshold",
+                options=[{'label': 'Calendar dates', 'value': 0}] + [
+                    {
+                        'label': 'Days since {0} cases'.format(threshold),
+                        'value': threshold
+                    }
+                    for threshold in state["dataset"]["thresholds"]
+                ],
+                value=0,
+                multi=False,
+                clearable=False,
+                searchable=False
+            )
+        ])
+
+        return dbc.Container(
+            fluid=True,
+            children=[
+                # Navbar
+                dbc.NavbarSimple(className="",dark=True,expand="sm",
+                    style={
+                        "background":
+                            "linear-gradient(120deg,#11a048,#01727a)"
+                    },
+                    children=[
+                        dbc.NavItem(dbc.NavLink(
+                            "Back to faaizz.com", href="https://faaizz.com"
+                        ))
+                    ],
+                    brand="COVID-19 Dashboard"
+                ),
+                # Header
+                dhtml.Br(),
+                dhtml.P(children=[
+                    "A COVID-19 Dashboard Prototype developed using the \
+                    Cross Industry Standard Process for Data Mining. The \
+                    data is sourced from ",
+                    dhtml.A(
+                        "Johns Hopkings University",
+                        href="https://github.com/CSSEGISandData/COVID-19"
+                    ),
+                    ", a Savitsky-Golay Filter is used for filtering (in \
+                    the filtered versions of the timelines), and the \
+                    Doubling Times (the estimated number of days it will \
+                    take for the current number of confirmed cases to get \
+                    doubled) are calculated using Linear Regression over a \
+                    moving window of days (the length of the window is \
+                    given in the title of the axis)."
+                ]),
+                dhtml.Br(),dhtml.Br(),
+            
+                # Body
+                dbc.Row([
+                    dbc.Col(md=6, lg=4, children=[ctry_input]),
+                    dbc.Col(md=6, lg=4, children=[vis_input]),
+                    dbc.Col(md=6, lg=4, children=[align_input]),
+                    dhtml.Br(),dhtml.Br(),
+                    # Plot
+                    dbc.Col(sm=12, children=[
+                        dbc.Col(
+                            dhtml.H4("Plots", className="text-center"), sm=12
+                        ),
+                        dcc.Graph(figure=fig, id="main_figure"),
+                        # Width of the window in pixels, set in the browser
+                        dcc.Store(id="graph_width"),
+                        # Zoom of the figure on screen, see payload.view_zoom
+                        dcc.Store(id="figure_zoom")
+                    ] + (
+                        # Timelines of all metrics, see build_series_store
+                        [dcc.Store(id="series_store")] if client_side else []
+                    )
+                    )
+                ], className="align-items-center"
+                )        
+            ],
+        )
+
+    app.layout= serve_layout
+
+
+    # Start the dataset watcher once in every server process, threads do not
+    # survive forking into gunicorn workers
+    watcher_lock= threading.Lock()
+    watcher= {"pid": None}
+
+    @app.server.before_request
+    def start_watcher():
+        if(watch_interval <= 0 or watcher["pid"] == os.getpid()):
+            return
+
+        with watcher_lock:
+            if(watcher["pid"] != os.getpid()):
+                watcher["pid"]= os.getpid()
+                threading.Thread(target=watch_dataset, daemon=True).start()
+
+
+    # Expose cache counters
+    @app.server.route("/cache_stats")
+    def cache_stats():
+        if(trace_cache is None):
+            return flask.jsonify({})
+
+        return flask.jsonify(trace_cache.stats())
+
+
+    # Expose metrics
+    dashboard_metrics= None
+    if(not no_metrics):
+        from src.visualization.metrics import DashboardMetrics
+        dashboard_metrics= DashboardMetrics()
+
+        @app.server.after_request
+        def observe_response(response):
+            rule= flask.request.url_rule
+            dashboard_metrics.observe_response(
+                rule.rule if rule is not None else "other", response
+            )
+            return response
+
+        @app.server.route("/metrics")
+        def metrics():
+            payload, content_type= dashboard_metrics.exposition()
+            return flask.Response(payload, content_type=content_type)
+
+
+    # Add callback for Dropdown
+
+    # Callback functions
+    def update_fig(selected_countries, visual_name, align, y_scale,
+            relayout_data, width, zoom):
+        # relayoutData only counts when the graph was zoomed, not when other
+        # inputs changed
+        zoomed= any(
+            each["prop_id"] == "main_figure.relayoutData"
+            for each in dash.callback_context.triggered
+        )
+        # Dataset used for the whole request
+        return update_view(
+            state["dataset"], trace_cache, selected_countries, visual_name,
+            align=align, y_scale=y_scale, relayout_data=relayout_data,
+            zoomed=zoomed, zoom=zoom,
+            max_points=max_points or points_for_width(width)
+        )
+
+    def update_store(selected_countries, width):
+        # Dataset used for the whole request
+        return build_series_store(
+            state["dataset"], trace_cache, selected_countries or [],
+            max_points=max_points or points_for_width(width)
+        )
+
+    # Observe latency, before the callback is registered
+    server_callback= update_store if client_side else update_fig
+    if(dashboard_metrics is not None):
+        server_callback= dashboard_metrics.timed_callback(server_callback)
+
+    # Callback wrappers
+    if(client_side):
+        # Only a new selection reaches the server
+        app.callback(
+            Output("series_store", "data"),
+            [
+                Input("country_dropdown", "value"),
+                Input("graph_width", "data")
+            ]
+        )(server_callback)
+
+        app.clientside_callback(
+            CLIENT_FIGURE,
+            Output("main_figure", "figure"),
+            [
+                Input("series_store", "data"),
+                Input('visual_time', 'value'),
+                Input('align_threshold', 'value'),
+                Input('y_scale', 'value')
+            ]
+        )
+
+    else:
+        app.callback(
+            [
+                Output("main_figure", "figure"),
+                Output("figure_zoom", "data")
+            ],
+            [
+                Input("country_dropdown", "value"),
+                Input('visual_time', 'value'),
+                Input('align_threshold', 'value'),
+                Input('y_scale', 'value'),
+                Input("main_figure", "relayoutData"),
+                Input("graph_width", "data")
+            ],
+            [State("figure_zoom", "data")]
+        )(server_callback)
+
+    # The graph spans the window, its width decides the number of points
+    app.clientside_callback(
+        "function(id) { return window.innerWidth; }",
+        Output("graph_width", "data"),
+        [Input("main_figure", "id")]
+    )
+
+    return app
+
+
+#==============================================================================
+def main(argv=None):
+    """ Entry point of the covid-dashboard command, runs Flask's development
+    server """
+    # Collect command-line arguments
+    cl_options= cl_parser.parse_args(argv)
+
+    app= create_app(**vars(cl_options))
     app.run_server(host="0.0.0.0", port="8080", use_reloader=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+""" Shared synthetic datasets of the tests
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.benchmark import synthetic_time_series
+from src.data.process_JH_data import reshape_time_series
+from src.features.build_features import build_rollups, prepare_relational, \
+    threshold_offsets
+
+
+@pytest.fixture(scope="session")
+def relational(tmp_path_factory):
+    """ Relational data of 12 synthetic regions over 80 days, 4 of them
+    states """
+    path= tmp_path_factory.mktemp("raw") / \
+        "time_series_covid19_confirmed_global.csv"
+    synthetic_time_series(12, 80).to_csv(path, index=False)
+
+    return prepare_relational(reshape_time_series(str(path)))
+
+
+@pytest.fixture(scope="session")
+def dataset(relational):
+    """ Dashboard dataset of the synthetic regions, as returned by
+    load_dataset """
+    from src.visualization.visualize import region_positions
+
+    df_rollups= build_rollups(relational)
+    df_offsets= threshold_offsets(df_rollups)
+
+    return {
+        "rollups": df_rollups,
+        "offsets": dict(zip(
+            zip(df_offsets['region'], df_offsets['threshold'].astype(int)),
+            df_offsets['offset'].astype(int)
+        )),
+        "thresholds": sorted(df_offsets['threshold'].astype(int).unique()),
+        "positions": region_positions(df_rollups),
+        "version": "test"
+    }
+
+
+@pytest.fixture
+def edge_relational():
+    """ Relational data with a NaN gap, a short series and an all-zero region
+
+    Regions: "Gap" misses 3 values in the middle, "Short" only reports the
+    last 4 days, "Zero" never has a case and "Plain" grows exponentially.
+    """
+    n_days= 30
+    dates= pd.date_range("2020-03-01", periods=n_days)
+    growth= np.round(50*np.power(1.15, np.arange(n_days)))
+
+    gap= growth*2
+    gap[10:13]= np.nan
+    short= np.full(n_days, np.nan)
+    short[-4:]= [5, 9, 20, 31]
+
+    frames= [
+        pd.DataFrame({
+            "date": dates, "state": np.nan, "country": country,
+            "confirmed": values
+        })
+        for country, values in [
+            ("Plain", growth), ("Gap", gap), ("Short", short),
+            ("Zero", np.zeros(n_days))
+        ]
+    ]
+    df_rel= pd.concat(frames, ignore_index=True)
+    df_rel= df_rel[
+        df_rel["confirmed"].notna() | (df_rel["country"] != "Short")
+    ]
+
+    return prepare_relational(df_rel)
@@ -0,0 +1,122 @@
+""" Rolling-origin backtest compared with a per-cell np.polyfit loop
+"""
+import numpy as np
+import pytest
+
+from src.models.backtest import backtest_regions, design_matrices, \
+    evaluate_regions, origin_positions
+
+
+def reference_cell(series, origins, fit_days, horizon, model, degree):
+    """ MAPE and RMSE of one region, model, degree and horizon, origin by
+    origin """
+    days= np.arange(-fit_days+1, 1)
+    errors, actuals= [], []
+    for origin in origins:
+        window= series[origin-fit_days+1:origin+1]
+        if(model == "loglinear"):
+            coefs= np.polyfit(days, np.log1p(window), 1)
+            forecast= np.expm1(np.polyval(coefs, horizon))
+        else:
+            coefs= np.polyfit(days, window, degree)
+            forecast= max(np.polyval(coefs, horizon), 0)
+        actual= series[origin+horizon]
+        errors.append(forecast - actual)
+        actuals.append(actual)
+
+    errors, actuals= np.array(errors), np.array(actuals)
+    observed= actuals > 0
+    mape= np.nan
+    if(observed.any()):
+        mape= 100*np.mean(np.abs(errors[observed])/actuals[observed])
+
+    return mape, np.sqrt(np.mean(errors**2))
+
+
+def reference_origins(n_dates, fit_days, horizons, n_origins, step):
+    """ Latest origins step days apart whose window and horizons lie in the
+    data """
+    origins= []
+    origin= n_dates - 1 - max(horizons)
+    while(origin >= fit_days - 1 and len(origins) < n_origins):
+        origins.append(origin)
+        origin-= step
+
+    return sorted(origins)
+
+
+@pytest.mark.parametrize("n_dates, fit_days, horizons, n_origins, step", [
+    (80, 21, [1, 7, 14], 30, 1),
+    (80, 21, [1, 7, 14], 30, 3),
+    (80, 21, [1, 7, 14], 10, 4),
+    (40, 21, [14], 30, 2),
+    (30, 21, [14], 5, 1),
+])
+def test_origin_positions(n_dates, fit_days, horizons, n_origins, step):
+    origins= origin_positions(n_dates, fit_days, horizons, n_origins, step)
+
+    assert list(origins) == reference_origins(
+        n_dates, fit_days, horizons, n_origins, step
+    )
+
+
+def test_evaluate_regions_matches_polyfit():
+    rng= np.random.default_rng(4)
+    values= np.cumsum(rng.poisson([5, 50, 0], (60, 3)), axis=0) \
+        .astype(np.float64)
+    origins= origin_positions(60, 14, [1, 5], 8, 2)
+    grid= [("loglinear", 1), ("poly", 1), ("poly", 2)]
+
+    designs= design_matrices(14, [1, 5], [1, 2])
+    metrics= evaluate_regions(values, origins, 14, [1, 5], grid, designs)
+
+    for model, degree, mape, rmse in metrics:
+        for h_pos, horizon in enumerate([1, 5]):
+            for region in range(3):
+                expected= reference_cell(
+                    values[:, region], origins, 14, horizon, model, degree
+                )
+                np.testing.assert_allclose(
+                    [mape[h_pos, region], rmse[h_pos, region]], expected,
+                    rtol=1e-6, atol=1e-9
+                )
+    # A region without cases has no MAPE
+    assert np.isnan(metrics[0][2][:, 2]).all()
+
+
+@pytest.mark.parametrize("workers, step", [(1, 1), (3, 2)])
+def test_backtest_cells_match_polyfit(dataset, workers, step):
+    df_rollups= dataset["rollups"]
+    horizons= [1, 7, 14]
+
+    df_metrics= backtest_regions(
+        df_rollups, degrees=[1, 2], horizons=horizons, fit_days=14,
+        n_origins=6, step=step, workers=workers
+    )
+
+    df_country= df_rollups[df_rollups["level"] == "country"]
+    panel= df_country.pivot(
+        index="date", columns="region", values="confirmed"
+    ).sort_index()
+    panel= panel.ffill().fillna(0)
+    origins= reference_origins(len(panel), 14, horizons, 6, step)
+
+    # Every region x (loglinear, poly 1, poly 2) x horizon, each labelled
+    # correctly
+    assert len(df_metrics) == panel.shape[1]*3*len(horizons)
+    assert (df_metrics["origins"] == len(origins)).all()
+    for row in df_metrics.itertuples():
+        expected= reference_cell(
+            panel[row.region].to_numpy(dtype=np.float64), origins, 14,
+            row.horizon, row.model, row.degree
+        )
+        np.testing.assert_allclose(
+            [row.mape, row.rmse], expected, rtol=1e-6, atol=1e-9
+        )
+
+
+def test_backtest_needs_enough_dates(dataset):
+    with pytest.raises(ValueError):
+        backtest_regions(
+            dataset["rollups"], fit_days=70, horizons=[14], workers=1
+        )
@@ -0,0 +1,246 @@
+""" Feature engines compared with the original per-group computation
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.features import build_features as bf
+
+
+def polyfit_windows(values, window):
+    """ Intercept and slope of np.polyfit on every window of one series """
+    intercept= np.full(len(values), np.nan)
+    slope= np.full(len(values), np.nan)
+    x= np.arange(window) - (window-1)/2
+    for end in range(window-1, len(values)):
+        y= values[end-window+1:end+1]
+        if(not np.isnan(y).any()):
+            slope[end], intercept[end]= np.polyfit(x, y, 1)
+
+    return intercept, slope
+
+
+def assert_same_growth(doubling_time, expected):
+    """ Doubling times compared as growth rates, which stay finite for flat
+    series """
+    with np.errstate(divide='ignore'):
+        np.testing.assert_allclose(
+            1/doubling_time, 1/expected, rtol=1e-7, atol=1e-9
+        )
+
+
+@pytest.mark.parametrize("window", [2, 3, 5])
+def test_rolling_ols_matches_polyfit(window):
+    rng= np.random.default_rng(1)
+    panel= np.cumsum(rng.poisson(20, (40, 4)), axis=0).astype(np.float64)
+    panel[10:13, 1]= np.nan
+    panel[:35, 2]= np.nan
+    panel[:, 3]= 0
+
+    intercept, slope= bf.rolling_ols(panel, window)
+
+    for col in range(panel.shape[1]):
+        expected_intercept, expected_slope= polyfit_windows(
+            panel[:, col], window
+        )
+        np.testing.assert_allclose(
+            intercept[:, col], expected_intercept, atol=1e-8
+        )
+        np.testing.assert_allclose(slope[:, col], expected_slope, atol=1e-8)
+
+
+def test_rolling_ols_shorter_than_window():
+    intercept, slope= bf.rolling_ols(np.ones((2, 3)), 3)
+    assert np.isnan(intercept).all() and np.isnan(slope).all()
+
+
+def test_vectorized_doubling_rate_matches_regression(edge_relational):
+    df_vectorized= bf.calc_doubling_rate_vectorized(edge_relational)
+    df_regression= bf.calc_doubling_rate(edge_relational)
+
+    assert_same_growth(
+        df_vectorized['confirmed_DR'].to_numpy(),
+        df_regression['confirmed_DR'].to_numpy()
+    )
+    # Too few and missing values have no doubling time
+    short= df_vectorized[df_vectorized['country'] == 'Short']['confirmed_DR']
+    assert short.isna().sum() == 2
+    gap= df_vectorized[df_vectorized['country'] == 'Gap']['confirmed_DR']
+    assert gap.iloc[10:15].isna().all()
+
+
+def test_log_doubling_rate_matches_polyfit(edge_relational):
+    df_out= bf.calc_doubling_rate_vectorized(
+        edge_relational, window=5, method='log'
+    )
+
+    for country, df_region in df_out.groupby('country', observed=True):
+        values= df_region['confirmed'].to_numpy(dtype=np.float64)
+        with np.errstate(divide='ignore'):
+            log_values= np.log(np.where(values > 0, values, np.nan))
+            _, growth_rate= polyfit_windows(log_values, 5)
+            expected= np.log(2)/growth_rate
+        assert_same_growth(df_region['confirmed_DR'].to_numpy(), expected)
+
+    plain= df_out[df_out['country'] == 'Plain']['confirmed_DR'].dropna()
+    np.testing.assert_allclose(plain, np.log(2)/np.log(1.15), rtol=0.03)
+
+
+def test_panel_matches_both_groupby_engines(relational):
+    bf.check_panel_matches_groupby(
+        relational, dr_engines=['vectorized', 'regression']
+    )
+
+
+def test_panel_matches_groupby_on_edge_cases(edge_relational):
+    # Panel mode expects an entry for every date, "Short" gets NaN rows
+    dates= edge_relational['date'].unique()
+    df_complete= pd.merge(
+        pd.DataFrame({'date': np.tile(dates, 4), 'country': np.repeat(
+            ['Plain', 'Gap', 'Short', 'Zero'], len(dates)
+        )}),
+        edge_relational.drop(columns=['index', 'state']),
+        on=['date', 'country'], how='left'
+    ).assign(state=np.nan)
+    df_complete= bf.prepare_relational(df_complete)
+
+    bf.check_panel_matches_groupby(df_complete)
+    bf.check_panel_matches_groupby(df_complete, dr_window=5, dr_method='log')
+
+
+def test_panel_check_catches_a_changed_filter(relational, monkeypatch):
+    smooth_panel= bf.smooth_panel
+
+    def shifted_smooth_panel(panel, smoothers):
+        smoothed= smooth_panel(panel, smoothers)
+        smoothed['filtered']= smoothed['filtered'] + 1
+        return smoothed
+
+    # Panel mode filters through the smoothing engine, groupby mode does not
+    monkeypatch.setattr(bf, "smooth_panel", shifted_smooth_panel)
+    with pytest.raises(AssertionError):
+        bf.check_panel_matches_groupby(relational, dr_engines=['vectorized'])
+
+
+def test_panel_check_catches_a_changed_doubling_rate(relational, monkeypatch):
+    build_panel= bf.build_features_panel
+
+    def shifted_panel(*args, **kwargs):
+        df_out= build_panel(*args, **kwargs)
+        df_out['confirmed_DR']= df_out['confirmed_DR']*1.01
+        return df_out
+
+    monkeypatch.setattr(bf, "build_features_panel", shifted_panel)
+    with pytest.raises(AssertionError):
+        bf.check_panel_matches_groupby(relational, dr_engines=['regression'])
+
+
+def revise_last_days(df_rel, days, factor=1.1):
+    """ Copy of relational data with the counts of the last days revised """
+    df_rel= df_rel.copy()
+    revised= df_rel['date'] > df_rel['date'].max() - pd.Timedelta(days=days)
+    df_rel.loc[revised, 'confirmed']= np.round(
+        df_rel.loc[revised, 'confirmed']*factor
+    )
+
+    return df_rel
+
+
+@pytest.mark.parametrize("fixture", ["relational", "edge_relational"])
+def test_incremental_matches_full_rebuild(fixture, request):
+    df_rel= request.getfixturevalue(fixture)
+    df_prev= bf.build_features_panel(df_rel)
+    df_new= revise_last_days(df_rel, 3)
+
+    df_incremental= bf.build_features_incremental(
+        df_new, df_prev, prev_settings=bf.feature_settings()
+    )
+    df_full= bf.build_features_panel(df_new)
+
+    keys= ['date', 'state', 'country']
+    df_incremental= df_incremental.sort_values(keys).reset_index(drop=True)
+    df_full= df_full.sort_values(keys).reset_index(drop=True)
+    pd.testing.assert_frame_equal(
+        df_incremental.drop(columns='index'), df_full.drop(columns='index'),
+        check_exact=False, rtol=1e-9, check_categorical=False
+    )
+
+
+def test_incremental_requires_rebuild_for_old_changes(relational):
+    df_prev= bf.build_features_panel(relational)
+    df_new= revise_last_days(relational, 30)
+
+    settings= bf.feature_settings()
+    assert bf.build_features_incremental(
+        df_new, df_prev, max_days=14, prev_settings=settings
+    ) is None
+    assert bf.build_features_incremental(
+        relational, df_prev, prev_settings=settings
+    ) is df_prev
+
+
+@pytest.mark.parametrize("changed", [
+    {'dr_window': 5}, {'dr_method': 'log'},
+    {'smoothers': {'ma': bf.Smoother('ma', {'window': 3})}}
+])
+def test_incremental_requires_rebuild_for_other_settings(relational, changed):
+    df_prev= bf.build_features_panel(relational)
+    settings= bf.feature_settings()
+
+    # Unchanged data is not reused either
+    assert bf.build_features_incremental(
+        relational, df_prev, prev_settings=settings, **changed
+    ) is None
+    assert bf.build_features_incremental(
+        relational, df_prev, prev_settings=None
+    ) is None
+
+
+def test_settings_are_stored_with_the_feature_set(relational, tmp_path):
+    from src.data.storage import read_settings, write_processed
+
+    data_path= str(tmp_path) + "/"
+    (tmp_path / "processed").mkdir()
+    smoothers= {'ewma7': bf.Smoother('ewma', {'span': 7.0})}
+    settings= bf.feature_settings(5, 'log', smoothers)
+
+    write_processed(
+        relational, data_path, 'COVID_final_set', settings=settings
+    )
+    assert read_settings(data_path, 'COVID_final_set') == settings
+
+    # Data written without settings has none
+    write_processed(relational, data_path, 'COVID_final_set')
+    assert read_settings(data_path, 'COVID_final_set') is None
+
+
+def test_threshold_offsets_match_per_region_scan(edge_relational):
+    df_rollups= edge_relational.rename(
+        columns={'state': 'level', 'country': 'region'}
+    )
+    df_rollups['level']= 'country'
+    df_rollups= df_rollups.sort_values(['region', 'date'], kind='stable') \
+        .reset_index(drop=True)
+    # A revision lowers a cumulative count after the first crossing
+    plain= np.flatnonzero(df_rollups['region'] == 'Plain')
+    df_rollups.loc[plain[20], 'confirmed']= 10
+
+    df_offsets= bf.threshold_offsets(df_rollups, thresholds=[100, 1000, 10000])
+
+    expected= []
+    for region, df_region in df_rollups.groupby(
+            'region', sort=False, observed=True):
+        counts= df_region['confirmed'].fillna(0).to_numpy()
+        for threshold in [100, 1000, 10000]:
+            reached= np.flatnonzero(counts >= threshold)
+            if(len(reached)):
+                expected.append((
+                    region, threshold, reached[0],
+                    df_region['date'].iloc[reached[0]]
+                ))
+
+    found= list(df_offsets[
+        ['region', 'threshold', 'offset', 'date']
+    ].itertuples(index=False))
+    assert sorted(map(tuple, found)) == sorted(expected)
+    assert not (df_offsets['region'] == 'Zero').any()
@@ -0,0 +1,37 @@
+""" Trace cache shared between processes
+"""
+from src.visualization.cache import TraceCache
+
+
+def test_counters_are_batched_and_flushed(tmp_path):
+    cache= TraceCache(
+        str(tmp_path / "cache.sqlite"), flush_every=10, flush_seconds=60
+    )
+    cache.put("v1", "Germany", "confirmed", {"x": [1, 2]})
+
+    assert cache.get("v1", "Germany", "confirmed") == {"x": [1, 2]}
+    assert cache.get("v1", "Nigeria", "confirmed") is None
+
+    # Another process sees nothing until the batch is written
+    other= TraceCache(str(tmp_path / "cache.sqlite"))
+    assert other._connection().execute(
+        "SELECT value FROM counters WHERE name='hits'"
+    ).fetchone()[0] == 0
+
+    stats= cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path):
+    cache= TraceCache(
+        str(tmp_path / "cache.sqlite"), max_entries=2, flush_every=1
+    )
+    cache.put("v1", "Germany", "confirmed", 1)
+    cache.put("v1", "Nigeria", "confirmed", 2)
+    # Touch the older entry, its access time is written with the batch
+    assert cache.get("v1", "Germany", "confirmed") == 1
+
+    cache.put("v1", "France", "confirmed", 3)
+
+    assert cache.get("v1", "Nigeria", "confirmed") is None
+    assert cache.get("v1", "Germany", "confirmed") == 1
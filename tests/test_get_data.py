@@ -0,0 +1,111 @@
+""" Johns Hopkins ingestion against a local bare repository
+"""
+import os, subprocess
+
+import pytest
+
+from src.data.get_data import dir_size, get_johns_hopkings
+
+TIME_SERIES_DIR= "csse_covid_19_data/csse_covid_19_time_series"
+
+pytestmark= pytest.mark.skipif(
+    subprocess.run(
+        ["git", "--version"], stdout=subprocess.PIPE
+    ).returncode != 0,
+    reason="git is not installed"
+)
+
+
+def git(args, cwd):
+    return subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com"]
+        + args,
+        cwd=cwd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    ).stdout.decode().strip()
+
+
+def publish(work, bare, version):
+    """ Commit an incompressible time series file and push it, returns the
+    commit """
+    os.makedirs(os.path.join(work, TIME_SERIES_DIR), exist_ok=True)
+    path= os.path.join(work, TIME_SERIES_DIR, "series.csv")
+    with open(path, "wb") as series:
+        series.write(version.encode() + b"\n" + os.urandom(256*1024))
+    # Outside the sparse checkout, never downloaded
+    os.makedirs(os.path.join(work, "archive"), exist_ok=True)
+    path= os.path.join(work, "archive", version + ".bin")
+    with open(path, "wb") as archive:
+        archive.write(os.urandom(64*1024))
+    git(["add", "-A"], work)
+    git(["commit", "-q", "-m", version], work)
+    git(["push", "-q", bare, "HEAD:main"], work)
+
+    return git(["rev-parse", "HEAD"], work)
+
+
+@pytest.fixture
+def remote(tmp_path):
+    work, bare= str(tmp_path / "work"), str(tmp_path / "remote.git")
+    git(["-c", "init.defaultBranch=main", "init", "-q", work], str(tmp_path))
+    git(["init", "-q", "--bare", bare], str(tmp_path))
+    git(["symbolic-ref", "HEAD", "refs/heads/main"], bare)
+
+    return work, bare
+
+
+def checked_out(data_path):
+    path= os.path.join(
+        data_path, "raw/JH_dataset/COVID-19", TIME_SERIES_DIR, "series.csv"
+    )
+    with open(path, "rb") as series:
+        return series.readline().decode().strip()
+
+
+def local_objects(data_path):
+    """ Objects in the object store, without fetching missing ones from the
+    remote """
+    return set(git(
+        ["cat-file", "--batch-all-objects", "--batch-check=%(objectname)"],
+        data_path + "raw/JH_dataset/COVID-19"
+    ).split())
+
+
+def test_sparse_update_and_gc_keep_only_the_latest_snapshot(tmp_path, remote):
+    work, bare= remote
+    data_path= str(tmp_path / "data") + "/"
+    os.makedirs(data_path)
+    url= "file://" + bare
+
+    first= publish(work, bare, "v1")
+    assert get_johns_hopkings(data_path, remote=url, mode="sparse")["ok"]
+    assert checked_out(data_path) == "v1"
+
+    publish(work, bare, "v2")
+    assert get_johns_hopkings(data_path, remote=url, mode="sparse")["ok"]
+    assert checked_out(data_path) == "v2"
+    objects= data_path + "raw/JH_dataset/COVID-19/.git/objects"
+    before_gc= dir_size(objects)
+
+    assert get_johns_hopkings(
+        data_path, remote=url, mode="sparse", gc=True
+    )["ok"]
+    assert checked_out(data_path) == "v2"
+    assert dir_size(objects) < before_gc - 200*1024
+    assert first not in local_objects(data_path)
+
+
+def test_full_clone_moved_to_sparse_drops_its_history(tmp_path, remote):
+    work, bare= remote
+    data_path= str(tmp_path / "data") + "/"
+    os.makedirs(data_path)
+    url= "file://" + bare
+
+    old= [publish(work, bare, "v1"), publish(work, bare, "v2")]
+    assert get_johns_hopkings(data_path, remote=url, mode="full")["ok"]
+
+    publish(work, bare, "v3")
+    assert get_johns_hopkings(
+        data_path, remote=url, mode="sparse", gc=True
+    )["ok"]
+    assert checked_out(data_path) == "v3"
+    assert not set(old) & local_objects(data_path)
@@ -0,0 +1,120 @@
+""" Append-only history of national snapshots, compared with a list of scrapes
+"""
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data import history
+from src.features.build_features import build_features_panel
+
+
+def snapshot(lagos, kano):
+    return pd.DataFrame({
+        "state": ["Lagos", "Kano"], "confirmed": [lagos, kano],
+        "discharged": [lagos//2, kano//2], "deaths": [lagos//100, kano//100]
+    })
+
+
+# (day of the scrape, Lagos, Kano); unchanged pages are scraped again on days
+# 3, 5 and 6
+SCRAPES= [
+    (1, 100, 10), (2, 120, 10), (3, 120, 10), (4, 150, 30), (5, 150, 30),
+    (6, 150, 30)
+]
+
+
+def scrape(data_path, scrapes, compact_every=history.COMPACT_EVERY):
+    return [
+        history.append_snapshot(
+            data_path, "NCDC", snapshot(lagos, kano),
+            scraped=datetime(2020, 5, day), compact_every=compact_every
+        )
+        for day, lagos, kano in scrapes
+    ]
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    os.makedirs(tmp_path / "processed")
+    return str(tmp_path) + "/"
+
+
+@pytest.mark.parametrize("compact_every", [2, history.COMPACT_EVERY])
+def test_unchanged_snapshots_are_dropped(data_path, compact_every):
+    appended= scrape(data_path, SCRAPES, compact_every=compact_every)
+    assert appended == [True, True, False, True, False, False]
+
+    df_history= history.read_history(data_path, "NCDC")
+
+    assert list(df_history["date"].unique()) == list(pd.to_datetime(
+        ["2020-05-01", "2020-05-02", "2020-05-04"]
+    ))
+    assert list(df_history["state"][:2]) == ["Kano", "Lagos"]
+    last= df_history[df_history["date"] == "2020-05-04"].set_index("state")
+    assert last.loc["Lagos", "confirmed"] == 150
+    assert last.loc["Kano", "deaths"] == 0
+    assert history.read_state(data_path, "NCDC")["last_seen"] == "2020-05-06"
+
+
+def test_compaction_keeps_every_snapshot(data_path):
+    scrape(data_path, SCRAPES[:2])
+    before= history.read_history(data_path, "NCDC")
+
+    assert history.compact_history(data_path, "NCDC") == 4
+    assert history.read_log(data_path, "NCDC") is None
+    assert history.read_state(data_path, "NCDC")["logged"] == 0
+    pd.testing.assert_frame_equal(
+        history.read_history(data_path, "NCDC"), before, check_dtype=False,
+        check_categorical=False
+    )
+    # Nothing left to compact
+    assert history.compact_history(data_path, "NCDC") is None
+
+    # Snapshots after the compaction are read from the log
+    scrape(data_path, SCRAPES[3:4])
+    assert len(history.read_history(data_path, "NCDC")) == 6
+
+
+def test_later_snapshot_of_a_day_wins(data_path):
+    scrape(data_path, [(1, 100, 10), (1, 110, 10)])
+    df_history= history.read_history(data_path, "NCDC")
+
+    assert len(df_history) == 2
+    assert df_history.set_index("state").loc["Lagos", "confirmed"] == 110
+
+
+def test_history_relational_reaches_the_last_scrape(data_path):
+    scrape(data_path, SCRAPES)
+    # A page that was not modified is a scrape as well
+    history.record_scrape(data_path, "NCDC", datetime(2020, 5, 8))
+    # An older scrape does not move the end back
+    history.record_scrape(data_path, "NCDC", datetime(2020, 5, 7))
+
+    df_rel= history.history_relational(data_path, "NCDC")
+
+    # Counts of every state carried forward day by day from the scrape list
+    expected= {}
+    counts= {}
+    for day in range(1, 9):
+        for scrape_day, lagos, kano in SCRAPES:
+            if(scrape_day == day):
+                counts= {"Lagos": lagos, "Kano": kano}
+        for state, confirmed in counts.items():
+            expected[(pd.Timestamp(2020, 5, day), state)]= confirmed
+
+    found= dict(zip(zip(df_rel["date"], df_rel["state"]), df_rel["confirmed"]))
+    assert found == expected
+    assert (df_rel["country"] == "Nigeria").all()
+    assert df_rel["date"].is_monotonic_increasing
+
+    # The feature code runs on it directly
+    df_features= build_features_panel(df_rel)
+    assert np.isfinite(df_features["confirmed_filtered"]).all()
+
+
+def test_missing_history(data_path):
+    with pytest.raises(FileNotFoundError):
+        history.read_history(data_path, "NCDC")
@@ -0,0 +1,30 @@
+""" Lazy exports of the src packages
+"""
+import importlib
+import subprocess
+import sys
+
+import pytest
+
+PACKAGES= ["src.data", "src.features", "src.visualization", "src.models"]
+
+
+@pytest.mark.parametrize("package", PACKAGES)
+def test_every_export_resolves(package):
+    module= importlib.import_module(package)
+
+    for name in module.__all__:
+        assert getattr(module, name) is not None
+    with pytest.raises(AttributeError):
+        module.missing_name
+
+
+def test_import_does_not_load_dependencies():
+    code= "import sys, {0}; print(sorted(\
+{{'numpy', 'pandas', 'dash'}} & set(sys.modules)))".format(", ".join(PACKAGES))
+    output= subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True,
+        check=True
+    )
+
+    assert output.stdout.strip() == "[]"
@@ -0,0 +1,119 @@
+""" Conditional, retried fetches of national sources from a local HTTP server
+"""
+import http.server
+import json
+import os
+import threading
+
+import pytest
+
+from src.data import national
+from src.data.storage import processed_path
+
+PAGE= b"""<html><body><table>
+<tr><th>States Affected</th><th>No. of Cases (Lab Confirmed)</th>
+<th>No. of Cases (on admission)</th><th>No. Discharged</th>
+<th>No. of Deaths</th></tr>
+<tr><td>Lagos</td><td>1,204</td><td>10</td><td>1,000</td><td>12</td></tr>
+<tr><td>Kano</td><td>310</td><td>4</td><td>250</td><td>3</td></tr>
+</table></body></html>"""
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """ Answers with the statuses queued on the server, then with the page """
+
+    def do_GET(self):
+        server= self.server
+        server.requests.append(dict(self.headers))
+        status= server.statuses.pop(0) if server.statuses else 200
+
+        if(status == 200 and self.headers.get("If-None-Match") == server.etag):
+            status= 304
+        self.send_response(status)
+        if(status == 200):
+            self.send_header("ETag", server.etag)
+            self.send_header("Content-Length", str(len(PAGE)))
+            self.end_headers()
+            self.wfile.write(PAGE)
+        else:
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server= http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.requests, server.statuses, server.etag= [], [], '"v1"'
+    thread= threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    os.makedirs(tmp_path / "processed")
+    return str(tmp_path) + "/"
+
+
+def fetch(server, data_path):
+    source= national.Source(
+        "NCDC", "http://127.0.0.1:{0}/".format(server.server_port),
+        national.parse_ncdc_table, national.ncdc_snapshot
+    )
+    reports= national.fetch_sources(data_path, [source], retries=3, backoff=0)
+    return reports[0]
+
+
+def test_fetch_retries_then_skips_unchanged_page(server, data_path):
+    # Two server errors are retried before the page is stored
+    server.statuses= [503, 503]
+    report= fetch(server, data_path)
+    assert report["status"] == "updated" and report["rows"] == 2
+    assert report["snapshot"]
+    assert len(server.requests) == 3
+
+    path= processed_path(data_path, "NCDC")
+    with open(path, "rb") as dataset_file:
+        content= dataset_file.read()
+    modified= os.stat(path).st_mtime_ns
+
+    # The ETag of the stored page is sent and the server answers 304
+    report= fetch(server, data_path)
+    assert report["status"] == "not_modified" and report["bytes_received"] == 0
+    assert server.requests[-1]["If-None-Match"] == '"v1"'
+    with open(path, "rb") as dataset_file:
+        assert dataset_file.read() == content
+    assert os.stat(path).st_mtime_ns == modified
+
+
+def test_failing_source_keeps_dataset_and_validators(server, data_path):
+    fetch(server, data_path)
+    path= processed_path(data_path, "NCDC")
+    modified= os.stat(path).st_mtime_ns
+    n_requests= len(server.requests)
+
+    server.statuses= [500]*10
+    report= fetch(server, data_path)
+
+    assert report["status"] == "failed" and "500" in report["error"]
+    # The first request and 3 retries
+    assert len(server.requests) - n_requests == 4
+    assert os.stat(path).st_mtime_ns == modified
+    with open(national.validators_path(data_path)) as validators_file:
+        assert json.load(validators_file)["NCDC"]["etag"] == '"v1"'
+
+
+def test_missing_dataset_is_fetched_unconditionally(server, data_path):
+    fetch(server, data_path)
+    os.remove(processed_path(data_path, "NCDC"))
+
+    report= fetch(server, data_path)
+
+    assert report["status"] == "updated"
+    assert "If-None-Match" not in server.requests[-1]
+    assert os.path.exists(processed_path(data_path, "NCDC"))
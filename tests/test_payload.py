@@ -0,0 +1,69 @@
+""" Downsampling of the traces sent to the browser
+"""
+import numpy as np
+import pytest
+
+from src.visualization.payload import downsample_trace, lttb_indices
+
+
+def lttb_reference(x, y, n_out):
+    """ Largest-Triangle-Three-Buckets, one bucket after the other """
+    n= len(x)
+    if(n_out >= n or n_out < 3):
+        return list(range(n))
+
+    edges= [int(edge) for edge in np.linspace(1, n-1, n_out-1)]
+    kept= [0]
+    for bucket in range(n_out-2):
+        lower, upper= edges[bucket], edges[bucket+1]
+        if(bucket+2 < len(edges)):
+            next_lower, next_upper= upper, edges[bucket+2]
+            next_x= np.mean(x[next_lower:next_upper])
+            next_y= np.mean(y[next_lower:next_upper])
+        else:
+            next_x, next_y= x[-1], y[-1]
+
+        areas= [
+            abs((x[kept[-1]] - next_x)*(y[pos] - y[kept[-1]])
+                - (x[kept[-1]] - x[pos])*(next_y - y[kept[-1]]))
+            for pos in range(lower, upper)
+        ]
+        kept.append(lower + int(np.argmax(areas)))
+
+    return kept + [n-1]
+
+
+@pytest.mark.parametrize("n, n_out", [
+    (1000, 50), (101, 10), (10, 9), (10, 3), (5, 10)
+])
+def test_lttb_matches_reference(n, n_out):
+    rng= np.random.default_rng(n)
+    x= np.cumsum(rng.uniform(0.5, 1.5, n))
+    y= np.cumsum(rng.normal(0, 1, n))
+
+    assert list(lttb_indices(x, y, n_out)) == lttb_reference(x, y, n_out)
+
+
+def test_lttb_keeps_a_spike():
+    x= np.arange(500, dtype=np.float64)
+    y= np.zeros(500)
+    y[317]= 100
+
+    assert 317 in lttb_indices(x, y, 20)
+
+
+def test_downsample_drops_gaps_and_keeps_the_zoom():
+    x= np.arange("2020-01-22", "2021-01-22", dtype="datetime64[D]")
+    y= np.arange(len(x), dtype=np.float64)
+    y[100:110]= np.nan
+
+    x_out, y_out= downsample_trace(x, y, 50)
+    assert len(x_out) == 50 and np.isfinite(y_out).all()
+    assert x_out[0] == x[0] and x_out[-1] == x[-1]
+
+    lower, upper= [
+        float(day.astype("datetime64[ms]").astype(np.int64))
+        for day in x[[200, 220]]
+    ]
+    x_zoom, _= downsample_trace(x, y, 50, x_range=(lower, upper))
+    assert x_zoom[0] == x[199] and x_zoom[-1] == x[221]
@@ -0,0 +1,56 @@
+""" Forecasts served from the fingerprint-keyed cache
+"""
+import numpy as np
+import pandas as pd
+
+from src.models.predict_model import forecast_regions
+
+
+def test_cache_returns_the_fits_of_a_fresh_run(dataset, tmp_path):
+    df_rollups= dataset["rollups"]
+    models_path= str(tmp_path) + "/"
+    n_regions= df_rollups["region"].nunique()
+
+    df_first, report= forecast_regions(
+        df_rollups, models_path=models_path, workers=1
+    )
+    assert report["poly"] == {"fitted": n_regions, "cached": 0}
+
+    df_cached, report= forecast_regions(
+        df_rollups, models_path=models_path, workers=1
+    )
+    assert report["poly"] == {"fitted": 0, "cached": n_regions}
+    pd.testing.assert_frame_equal(df_cached, df_first)
+
+    df_fresh, _= forecast_regions(
+        df_rollups, models_path=models_path, use_cache=False, workers=1
+    )
+    pd.testing.assert_frame_equal(df_fresh, df_first)
+
+
+def test_changed_series_is_fitted_again(dataset, tmp_path):
+    df_rollups= dataset["rollups"]
+    models_path= str(tmp_path) + "/"
+    n_regions= df_rollups["region"].nunique()
+    forecast_regions(df_rollups, models_path=models_path, workers=1)
+
+    # The last count of one region is revised
+    region= df_rollups["region"].iloc[0]
+    last= df_rollups.index[df_rollups["region"] == region][-1]
+    df_revised= df_rollups.copy()
+    df_revised.loc[last, "confirmed"]+= 1000
+
+    df_cached, report= forecast_regions(
+        df_revised, models_path=models_path, workers=1
+    )
+    assert report["loglinear"] == {"fitted": 1, "cached": n_regions-1}
+
+    df_fresh, _= forecast_regions(
+        df_revised, models_path=models_path, use_cache=False, workers=1
+    )
+    pd.testing.assert_frame_equal(df_cached, df_fresh)
+    changed= df_cached["region"] == region
+    df_before, _= forecast_regions(df_rollups, use_cache=False, workers=1)
+    assert not np.allclose(
+        df_cached.loc[changed, "forecast"], df_before.loc[changed, "forecast"]
+    )
@@ -0,0 +1,43 @@
+""" Streaming conversion compared with the in-memory join
+"""
+import os
+
+import pandas as pd
+
+from src.benchmark import synthetic_time_series
+from src.data.process_JH_data import relational_scope, stream_relational_scope
+from src.data.storage import TIME_SERIES, read_processed, time_series_path
+
+
+def test_stream_matches_join_when_secondary_dates_are_missing(tmp_path):
+    data_path= str(tmp_path) + "/"
+    os.makedirs(os.path.dirname(time_series_path(data_path, "x")))
+    os.makedirs(data_path + "processed")
+
+    metrics= TIME_SERIES["global"]
+    raw= {
+        metric: synthetic_time_series(9, 20, metric=metric)
+        for metric, _ in metrics
+    }
+    date_cols= [col for col in raw["confirmed"].columns if col[0].isdigit()]
+    # Same rows, last dates not yet reported: read in lockstep
+    raw["deaths"]= raw["deaths"].drop(columns=date_cols[-3:])
+    # Other row order and first dates missing: aligned by key
+    raw["recovered"]= raw["recovered"].drop(columns=date_cols[:2]).iloc[::-1]
+    for metric, file_name in metrics:
+        raw[metric].to_csv(time_series_path(data_path, file_name), index=False)
+
+    relational_scope(data_path, "global", metrics, "joined")
+    stream_relational_scope(
+        data_path, "global", metrics, "streamed", memory_budget=0.01
+    )
+
+    keys= ["date", "state", "country"]
+    df_joined= read_processed(data_path, "joined").sort_values(keys) \
+        .reset_index(drop=True)
+    df_streamed= read_processed(data_path, "streamed").sort_values(keys) \
+        .reset_index(drop=True)
+
+    assert df_streamed["deaths"].isna().sum() == 3*9
+    assert df_streamed["recovered"].isna().sum() == 2*9
+    pd.testing.assert_frame_equal(df_streamed, df_joined)
@@ -0,0 +1,69 @@
+""" Publishing processed datasets as versions
+"""
+import os
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from src.data import publish
+from src.data.storage import read_processed, write_processed
+
+
+class FrozenDatetime(datetime):
+    """ utcnow always returns the same instant """
+
+    @classmethod
+    def utcnow(cls):
+        return cls(2021, 3, 1, 12, 0, 0, 250000)
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    os.makedirs(tmp_path / "processed")
+    return str(tmp_path) + "/"
+
+
+def write(data_path, confirmed):
+    df_data= pd.DataFrame({
+        "date": pd.Timestamp("2020-03-01"), "state": None, "country": "Italy",
+        "confirmed": confirmed
+    }, index=[0])
+    write_processed(df_data, data_path, "COVID_final_set")
+
+
+def test_same_instant_and_content_is_published_once(data_path, monkeypatch):
+    monkeypatch.setattr(publish, "datetime", FrozenDatetime)
+    write(data_path, 1)
+
+    first= publish.publish_version(data_path)
+    second= publish.publish_version(data_path)
+
+    assert first == second and first.startswith("20210301T120000250000Z-")
+    assert publish.current_version(data_path) == first
+    assert not [each for each in os.listdir(publish.versions_path(data_path))
+        if each.startswith(".staging")]
+
+
+def test_same_instant_with_other_content_is_a_new_version(data_path,
+        monkeypatch):
+    monkeypatch.setattr(publish, "datetime", FrozenDatetime)
+    write(data_path, 1)
+    first= publish.publish_version(data_path)
+    write(data_path, 2)
+    second= publish.publish_version(data_path)
+
+    assert first != second and publish.current_version(data_path) == second
+    df_current= read_processed(
+        publish.version_data_path(data_path, second), "COVID_final_set"
+    )
+    assert list(df_current["confirmed"]) == [2]
+
+
+def test_quick_publishes_get_ordered_ids(data_path):
+    versions= []
+    for confirmed in range(3):
+        write(data_path, confirmed)
+        versions.append(publish.publish_version(data_path, keep_versions=5))
+
+    assert versions == sorted(versions) and len(set(versions)) == 3
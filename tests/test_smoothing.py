@@ -0,0 +1,77 @@
+""" Batched smoothers compared with per-region pandas and scipy
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import signal
+
+from src.features.smoothing import FILTER, Smoother, fill_gaps, smooth_panel
+
+
+@pytest.fixture
+def panel():
+    """ 30 dates of a growing region, one with a gap, a late start and an
+    all-zero one """
+    rng= np.random.default_rng(2)
+    panel= np.cumsum(rng.poisson(30, (30, 4)), axis=0).astype(np.float64)
+    panel[12:15, 1]= np.nan
+    panel[:26, 2]= np.nan
+    panel[:, 3]= 0
+
+    return panel
+
+
+def reference(series, smoother):
+    """ Smoother of one region with the gaps filled by pandas """
+    filled= series.ffill().bfill().fillna(0)
+    params= smoother.params
+    if(smoother.kind == 'savgol'):
+        window= min(params['window'], len(filled) - (len(filled)+1) % 2)
+        result= signal.savgol_filter(
+            filled.to_numpy(), window, min(params['degree'], window-1)
+        )
+    elif(smoother.kind == 'ewma'):
+        result= filled.ewm(span=params['span'], adjust=True).mean().to_numpy()
+    else:
+        result= filled.rolling(
+            params['window'], center=True, min_periods=1
+        ).mean().to_numpy()
+
+    return np.where(series.isna(), np.nan, result)
+
+
+SMOOTHERS= {
+    'filtered': FILTER,
+    'savgol7': Smoother('savgol', {'window': 7, 'degree': 2}),
+    'ewma': Smoother('ewma', {'span': 7.0}),
+    'ma': Smoother('ma', {'window': 7}),
+}
+
+
+def test_smoothers_match_per_region_reference(panel):
+    smoothed= smooth_panel(panel, SMOOTHERS)
+
+    for name, smoother in SMOOTHERS.items():
+        for col in range(panel.shape[1]):
+            expected= reference(pd.Series(panel[:, col]), smoother)
+            np.testing.assert_allclose(
+                smoothed[name][:, col], expected, rtol=1e-9, atol=1e-9
+            )
+
+
+def test_series_shorter_than_the_window(panel):
+    smoothed= smooth_panel(panel[:4], SMOOTHERS)
+
+    for name, smoother in SMOOTHERS.items():
+        expected= reference(pd.Series(panel[:4, 0]), smoother)
+        np.testing.assert_allclose(smoothed[name][:, 0], expected, rtol=1e-9)
+
+
+def test_fill_gaps(panel):
+    filled= fill_gaps(panel)
+
+    expected= pd.DataFrame(panel).ffill().bfill().fillna(0).to_numpy()
+    np.testing.assert_array_equal(filled, expected)
+    np.testing.assert_array_equal(
+        fill_gaps(np.full((3, 2), np.nan)), np.zeros((3, 2))
+    )
@@ -0,0 +1,73 @@
+""" Writing processed datasets into place
+"""
+import os
+
+import pandas as pd
+import pytest
+
+from src.data import storage
+
+
+def frame(countries):
+    return pd.DataFrame({
+        "date": pd.Timestamp("2020-03-01"), "state": None,
+        "country": countries, "confirmed": range(len(countries))
+    })
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    os.makedirs(tmp_path / "processed")
+    return str(tmp_path) + "/"
+
+
+def test_partitioned_dataset_ignores_stale_tmp(data_path):
+    storage.write_processed(
+        frame(["Italy"]), data_path, "rel", ["parquet"], "country"
+    )
+    path= storage.processed_path(data_path, "rel", "parquet")
+    # Left behind by a run that failed before moving it into place
+    storage.write_processed(
+        frame(["Spain"]), data_path, "stale", ["parquet"], "country"
+    )
+    os.replace(
+        storage.processed_path(data_path, "stale", "parquet"), path + ".tmp"
+    )
+
+    storage.write_processed(
+        frame(["France", "Chile"]), data_path, "rel", ["parquet"], "country"
+    )
+
+    df_out= storage.read_processed(data_path, "rel", "parquet")
+    assert sorted(df_out["country"].astype(str)) == ["Chile", "France"]
+    assert sorted(os.listdir(data_path + "processed")) == ["rel.parquet"]
+
+
+def test_partitioned_dataset_replaces_a_file(data_path):
+    storage.write_processed(frame(["Italy"]), data_path, "rel", ["parquet"])
+    storage.write_processed(
+        frame(["France"]), data_path, "rel", ["parquet"], "country"
+    )
+    assert os.path.isdir(storage.processed_path(data_path, "rel", "parquet"))
+
+    storage.write_processed(frame(["Chile"]), data_path, "rel", ["parquet"])
+
+    df_out= storage.read_processed(data_path, "rel", "parquet")
+    assert list(df_out["country"].astype(str)) == ["Chile"]
+    assert sorted(os.listdir(data_path + "processed")) == ["rel.parquet"]
+
+
+def test_processed_writer_ignores_stale_tmp(data_path):
+    for fmt in storage.FORMATS:
+        os.makedirs(storage.processed_path(data_path, "rel", fmt) + ".tmp")
+
+    writer= storage.ProcessedWriter(data_path, "rel", storage.FORMATS)
+    writer.write(frame(["Italy", "Spain"]))
+    writer.write(frame(["France"]))
+    writer.close()
+
+    for fmt in storage.FORMATS:
+        df_out= storage.read_processed(data_path, "rel", fmt)
+        assert list(df_out["country"].astype(str)) == \
+            ["Italy", "Spain", "France"]
+    assert len(os.listdir(data_path + "processed")) == len(storage.FORMATS)
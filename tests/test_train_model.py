@@ -0,0 +1,116 @@
+""" Batched SIR integration and fits compared with scipy per region
+"""
+import numpy as np
+from scipy import integrate, optimize
+
+from src.models.train_model import fit_countries, fit_sir, integrate_sir, \
+    read_population
+
+BETA= np.array([0.35, 0.25, 0.6])
+GAMMA= np.array([0.1, 0.15, 0.3])
+S0= np.array([0.999, 0.99, 0.9999])
+I0= np.array([5e-4, 4e-3, 5e-5])
+DAYS= 40
+
+
+def sir_reference(beta, gamma, s0, i0, days):
+    """ Susceptible fraction of one region by scipy's adaptive integrator """
+    def rhs(_, state):
+        s, i= state
+        return [-beta*s*i, beta*s*i - gamma*i]
+
+    solution= integrate.solve_ivp(
+        rhs, (0, days-1), [s0, i0], t_eval=np.arange(days), rtol=1e-11,
+        atol=1e-14
+    )
+    return solution.y[0]
+
+
+def test_integrate_sir_matches_solve_ivp():
+    s= integrate_sir(BETA, GAMMA, S0, I0, DAYS)
+    s_fine= integrate_sir(BETA, GAMMA, S0, I0, DAYS, substeps=32)
+
+    for region in range(len(BETA)):
+        expected= sir_reference(
+            BETA[region], GAMMA[region], S0[region], I0[region], DAYS
+        )
+        # Cumulative cases 1-S are what is fitted
+        np.testing.assert_allclose(1 - s[region], 1 - expected, rtol=1e-5)
+        np.testing.assert_allclose(1 - s_fine[region], 1 - expected, rtol=1e-9)
+
+
+def test_fit_sir_matches_least_squares_per_region():
+    rng= np.random.default_rng(3)
+    noise= rng.lognormal(0, 0.01, (3, DAYS))
+    observed= (1 - integrate_sir(BETA, GAMMA, S0, I0, DAYS))*noise
+    beta0, gamma0= np.full(3, 0.3), np.full(3, 0.1)
+
+    fit= fit_sir(observed, S0, I0, beta0, gamma0, max_iter=200, tol=1e-12)
+    assert fit["converged"].all()
+
+    for region in range(len(BETA)):
+        def residuals(theta):
+            s= integrate_sir(
+                np.exp(theta[:1]), np.exp(theta[1:]), S0[[region]],
+                I0[[region]], DAYS
+            )
+            return np.log(1 - s[0]) - np.log(observed[region])
+
+        expected= optimize.least_squares(
+            residuals, np.log([beta0[region], gamma0[region]]), method="lm",
+            xtol=1e-12
+        )
+        np.testing.assert_allclose(
+            [fit["beta"][region], fit["gamma"][region]], np.exp(expected.x),
+            rtol=1e-3
+        )
+        np.testing.assert_allclose(
+            fit["rmse"][region], np.sqrt(np.mean(expected.fun**2)), rtol=1e-3
+        )
+
+    # Fitting all regions at once gives the fit of every region alone
+    alone= fit_sir(
+        observed[:1], S0[:1], I0[:1], beta0[:1], gamma0[:1], max_iter=200,
+        tol=1e-12
+    )
+    np.testing.assert_allclose(alone["beta"], fit["beta"][:1], rtol=1e-9)
+
+
+def test_fit_countries_skips_countries_without_cases():
+    s= integrate_sir(BETA[:1], GAMMA[:1], S0[:1], I0[:1], DAYS)
+    confirmed= np.column_stack([
+        1e6*(1 - s[0]),                              # fitted
+        np.zeros(DAYS),                              # never has a case
+        np.r_[np.zeros(DAYS-5), np.full(5, 500.0)],  # few cases at the start
+        1e6*(1 - s[0]),                              # population unknown
+    ])
+
+    fits= fit_countries(
+        confirmed, np.array([1e6, 1e6, 1e6, np.nan]), [DAYS-2, DAYS-1],
+        np.full(4, 0.3), np.full(4, 0.1), window=28, min_cases=100
+    )
+
+    assert [end for end, _, _ in fits] == [DAYS-2, DAYS-1]
+    for _, cols, fit in fits:
+        assert list(cols) == [0]
+        assert np.isfinite(fit["beta"]).all()
+        assert np.isfinite(fit["gamma"]).all()
+
+
+def test_read_population(tmp_path):
+    import pandas as pd
+    from src.data.storage import CONTINENTS_PATH
+
+    # The shipped table covers every country of the rollups
+    countries= pd.read_csv(CONTINENTS_PATH, sep=";")["country"].to_numpy()
+    assert np.isfinite(read_population(None, countries)).all()
+
+    lookup= tmp_path / "UID_ISO_FIPS_LookUp_Table.csv"
+    lookup.write_text(
+        "UID,iso2,Province_State,Country_Region,Population\n"
+        "124,CA,,Canada,37855702\n"
+        "12401,CA,Alberta,Canada,4413146\n"
+        "516,NA,,Namibia,2540916\n"
+    )
+    population= read_population(str(lookup), ["Namibia", "Canada", "Atlantis"])
+    np.testing.assert_array_equal(population, [2540916, 37855702, np.nan])
@@ -0,0 +1,137 @@
+""" Figures of the dashboard callback
+"""
+import pandas as pd
+
+from src.visualization.visualize import update_view
+
+
+def zoom_into(dataset, first, last):
+    """ relayoutData of a zoom into the calendar dates between two
+    positions """
+    dates= pd.Series(dataset["rollups"]["date"].unique()).sort_values()
+    return {
+        "xaxis.range[0]": dates.iloc[first].strftime("%Y-%m-%d %H:%M:%S"),
+        "xaxis.range[1]": dates.iloc[last].strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def points(figure):
+    return [len(trace["x"]) for trace in figure["data"]]
+
+
+def test_zoom_is_dropped_when_views_switch(dataset):
+    regions= [
+        region for region, threshold in dataset["offsets"] if threshold == 100
+    ][:3]
+    full_dates, zoom= update_view(dataset, None, regions, "confirmed")
+    full_aligned, _= update_view(
+        dataset, None, regions, "confirmed", align=100
+    )
+    full_filtered, _= update_view(dataset, None, regions, "confirmed_filtered")
+
+    # Zoom into ten days of the calendar
+    relayout= zoom_into(dataset, 20, 30)
+    zoomed, zoom= update_view(
+        dataset, None, regions, "confirmed", relayout_data=relayout,
+        zoomed=True, zoom=zoom
+    )
+    assert all(count <= 13 for count in points(zoomed))
+
+    # Other inputs on the same axis keep the zoom
+    resized, zoom= update_view(
+        dataset, None, regions, "confirmed", y_scale="log",
+        relayout_data=relayout, zoom=zoom
+    )
+    assert points(resized) == points(zoomed)
+
+    # Aligned view: the stale calendar range must not crop days since the
+    # threshold
+    aligned, zoom= update_view(
+        dataset, None, regions, "confirmed", align=100,
+        relayout_data=relayout, zoom=zoom
+    )
+    assert points(aligned) == points(full_aligned)
+
+    # And back to dates, where the browser autoscaled
+    dates, zoom= update_view(
+        dataset, None, regions, "confirmed", relayout_data=relayout, zoom=zoom
+    )
+    assert points(dates) == points(full_dates)
+
+    # Another metric after a zoom
+    _, zoom= update_view(
+        dataset, None, regions, "confirmed", relayout_data=relayout,
+        zoomed=True, zoom=zoom
+    )
+    filtered, zoom= update_view(
+        dataset, None, regions, "confirmed_filtered", relayout_data=relayout,
+        zoom=zoom
+    )
+    assert points(filtered) == points(full_filtered)
+
+
+def test_autorange_resets_zoom(dataset):
+    regions= list(dataset["positions"])[:2]
+    full, zoom= update_view(dataset, None, regions, "confirmed")
+    _, zoom= update_view(
+        dataset, None, regions, "confirmed",
+        relayout_data=zoom_into(dataset, 5, 10), zoomed=True, zoom=zoom
+    )
+    reset, zoom= update_view(
+        dataset, None, regions, "confirmed",
+        relayout_data={"xaxis.autorange": True}, zoomed=True, zoom=zoom
+    )
+    assert points(reset) == points(full) and zoom["range"] is None
+
+
+def test_doubling_rate_title_follows_the_window(dataset, tmp_path):
+    from src.data.storage import write_processed
+    from src.features.build_features import feature_settings
+    from src.visualization.visualize import load_dataset
+
+    data_path= str(tmp_path) + "/"
+    (tmp_path / "processed").mkdir()
+    write_processed(dataset["rollups"], data_path, "COVID_final_set")
+    write_processed(
+        dataset["rollups"], data_path, "COVID_rollup_set",
+        settings=feature_settings(7)
+    )
+
+    current= load_dataset(data_path)
+    figure, _= update_view(current, None, ["World"], "confirmed_DR")
+
+    assert current["dr_window"] == 7
+    assert figure["layout"]["yaxis"]["title"] == \
+        "Approximated doubling rate over 7 days (log-scale)"
+
+
+def test_reloaded_csv_is_read_through_one_feather_copy(dataset, tmp_path):
+    import os
+    from src.data.storage import processed_path, write_processed
+    from src.visualization.visualize import load_dataset
+
+    data_path= str(tmp_path) + "/"
+    (tmp_path / "processed").mkdir()
+    for name in ["COVID_final_set", "COVID_rollup_set"]:
+        write_processed(dataset["rollups"], data_path, name)
+
+    parsed= load_dataset(data_path)
+    mapped= load_dataset(data_path, share_csv=True)
+    copy_path= data_path + "cache/datasets/" + mapped["version"] + "/"
+
+    assert mapped["version"] == parsed["version"]
+    assert os.path.exists(
+        processed_path(copy_path, "COVID_rollup_set", fmt="feather")
+    )
+    pd.testing.assert_frame_equal(mapped["rollups"], parsed["rollups"])
+    assert mapped["offsets"] == parsed["offsets"]
+    # Later loads map the same copy
+    assert load_dataset(data_path, share_csv=True)["version"] == \
+        mapped["version"]
+
+    # A new version replaces the copy
+    for name in ["COVID_rollup_set", "COVID_final_set"]:
+        write_processed(dataset["rollups"].iloc[:-1], data_path, name)
+    reloaded= load_dataset(data_path, share_csv=True)
+    assert os.listdir(data_path + "cache/datasets/") == [reloaded["version"]]
+    assert len(reloaded["rollups"]) < len(mapped["rollups"])